@@ -0,0 +1,634 @@
+"""
+In-process stand-in for a redis server
+
+Speaks enough of the RESP protocol and the redis commands used by
+redis_cloudclient to run the client against it on a plain Linux box, with
+an optional simulated network latency.
+"""
+import select
+import socket
+import threading
+import time
+
+
+class FakeRedisError(Exception):
+    pass
+
+
+class FakeRedis(object):
+    """
+    Fake redis server running in a background thread
+
+    Parameters
+    ----------
+    latency : float, optional
+        Seconds to delay the delivery of replies after the commands are
+        received.  Commands are still processed as they arrive, so pipelined
+        commands overlap the delay the same way they would on a network
+        with this round trip time, default=0
+
+    command_latency : float, optional
+        Additional seconds to delay each command, default=0
+
+    host : str, optional
+        The address to listen on, default='127.0.0.1'
+
+    port : int, optional
+        The port to listen on, default picks a free port
+    """
+    def __init__(self, latency=0, command_latency=0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.command_latency = command_latency
+        self.data = {}
+        self.expires = {}
+        self.commands = []
+        self._condition = threading.Condition()
+        self._sequence = 0
+        self._socket = socket.socket()
+        self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._socket.bind((host, port))
+        self._socket.listen(16)
+        self.host, self.port = self._socket.getsockname()
+        self._running = True
+        self._thread = threading.Thread(target=self._serve)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        """
+        Stop the server
+        """
+        self._running = False
+        try:
+            self._socket.close()
+        except OSError:
+            pass
+        with self._condition:
+            self._condition.notify_all()
+
+    def _serve(self):
+        while self._running:
+            try:
+                connection, address = self._socket.accept()
+            except OSError:
+                return
+            thread = threading.Thread(target=self._handle, args=(connection,))
+            thread.daemon = True
+            thread.start()
+
+    def _handle(self, connection):
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        outgoing = []
+        condition = threading.Condition()
+        sender = threading.Thread(target=self._send, args=(connection, outgoing, condition))
+        sender.daemon = True
+        sender.start()
+        buffer = b''
+        transaction = None
+        try:
+            while self._running:
+                try:
+                    data = connection.recv(65536)
+                except OSError:
+                    return
+                if not data:
+                    return
+                received = time.time()
+                buffer += data
+                replies = []
+                while True:
+                    command, buffer = self._parse(buffer)
+                    if command is None:
+                        break
+                    name = command[0].upper()
+                    if name == b'MULTI':
+                        transaction = []
+                        reply = 'OK'
+                    elif name == b'EXEC':
+                        reply = self.execute_transaction(transaction)
+                        transaction = None
+                    elif name == b'DISCARD':
+                        transaction = None
+                        reply = 'OK'
+                    elif transaction is not None:
+                        transaction.append(command)
+                        reply = 'QUEUED'
+                    else:
+                        if name == b'BLPOP' and replies:
+                            # Like redis, send the replies so far before blocking
+                            with condition:
+                                outgoing.append((received + self.latency, b''.join(replies)))
+                                condition.notify()
+                            replies = []
+                        reply = self.execute(command)
+                    replies.append(self._encode(reply))
+                if replies:
+                    with condition:
+                        outgoing.append((received + self.latency, b''.join(replies)))
+                        condition.notify()
+        finally:
+            with condition:
+                outgoing.append((None, None))
+                condition.notify()
+
+    def _send(self, connection, outgoing, condition):
+        """
+        Deliver replies once their simulated latency has passed
+        """
+        while True:
+            with condition:
+                while not outgoing:
+                    condition.wait()
+                due, data = outgoing.pop(0)
+            if data is None:
+                return
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            try:
+                connection.sendall(data)
+            except OSError:
+                return
+
+    def _parse(self, buffer):
+        """
+        Parse one command from the buffer
+
+        Returns
+        -------
+        tuple
+            The command (or None if the buffer doesn't hold a complete
+            command yet) and the remaining buffer
+        """
+        if not buffer.startswith(b'*'):
+            return None, buffer
+        end = buffer.find(b'\r\n')
+        if end < 0:
+            return None, buffer
+        count = int(buffer[1:end])
+        position = end + 2
+        command = []
+        for index in range(count):
+            end = buffer.find(b'\r\n', position)
+            if end < 0:
+                return None, buffer
+            length = int(buffer[position + 1:end])
+            start = end + 2
+            if len(buffer) < start + length + 2:
+                return None, buffer
+            command.append(buffer[start:start + length])
+            position = start + length + 2
+        return command, buffer[position:]
+
+    def _encode(self, value):
+        if isinstance(value, FakeRedisError):
+            return b'-' + str(value).encode() + b'\r\n'
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, bool):
+            value = int(value)
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, str):
+            return b'+' + value.encode() + b'\r\n'
+        if isinstance(value, (bytes, bytearray)):
+            return b'$%d\r\n%s\r\n' % (len(value), bytes(value))
+        if isinstance(value, (list, tuple)):
+            return b'*%d\r\n' % len(value) + b''.join(self._encode(item) for item in value)
+        raise TypeError('Cannot encode %r' % value)
+
+    def execute(self, command):
+        """
+        Run a command against the fake data
+
+        Parameters
+        ----------
+        command : list
+            The command name followed by the arguments as bytes
+
+        Returns
+        -------
+        The reply value
+        """
+        self.commands.append(command)
+        if self.command_latency:
+            time.sleep(self.command_latency)
+        name = command[0].decode().upper()
+        method = getattr(self, 'cmd_' + name, None)
+        if method is None:
+            return FakeRedisError('ERR unknown command %r' % name)
+        if name == 'BLPOP':
+            return method(*command[1:])
+        with self._condition:
+            self._expire()
+            try:
+                reply = method(*command[1:])
+            except FakeRedisError as exc:
+                return exc
+            self._condition.notify_all()
+            return reply
+
+    def execute_transaction(self, commands):
+        """
+        Run the commands queued by MULTI atomically
+
+        Parameters
+        ----------
+        commands : list
+            The queued commands, None if there was no MULTI
+
+        Returns
+        -------
+        list
+            The replies of the commands
+        """
+        if commands is None:
+            return FakeRedisError('ERR EXEC without MULTI')
+        with self._condition:
+            replies = []
+            for command in commands:
+                replies.append(self.execute(command))
+            return replies
+
+    def _expire(self):
+        now = time.time()
+        for key, expire in list(self.expires.items()):
+            if expire <= now:
+                self.data.pop(key, None)
+                del self.expires[key]
+
+    def _get(self, key, kind, default=None):
+        value = self.data.get(key, default)
+        if value is not None and not isinstance(value, kind):
+            raise FakeRedisError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    # Generic commands
+    def cmd_PING(self, *args):
+        return 'PONG'
+
+    def cmd_DEL(self, *keys):
+        count = 0
+        for key in keys:
+            if self.data.pop(key, None) is not None:
+                count += 1
+            self.expires.pop(key, None)
+        return count
+
+    def cmd_EXISTS(self, *keys):
+        return sum(1 for key in keys if key in self.data)
+
+    def cmd_EXPIRE(self, key, seconds):
+        if key not in self.data:
+            return 0
+        self.expires[key] = time.time() + int(seconds)
+        return 1
+
+    def cmd_TTL(self, key):
+        if key not in self.data:
+            return -2
+        if key not in self.expires:
+            return -1
+        return int(self.expires[key] - time.time())
+
+    def cmd_KEYS(self, pattern):
+        import fnmatch
+        return [key for key in self.data if fnmatch.fnmatchcase(key, pattern)]
+
+    # String commands
+    def cmd_GET(self, key):
+        return self._get(key, bytes)
+
+    def cmd_SET(self, key, value, *args):
+        self.data[key] = value
+        self.expires.pop(key, None)
+        return 'OK'
+
+    def cmd_SETEX(self, key, seconds, value):
+        self.data[key] = value
+        self.expires[key] = time.time() + int(seconds)
+        return 'OK'
+
+    def cmd_APPEND(self, key, value):
+        self.data[key] = self._get(key, bytes, b'') + value
+        return len(self.data[key])
+
+    def cmd_STRLEN(self, key):
+        return len(self._get(key, bytes, b''))
+
+    def cmd_GETRANGE(self, key, start, end):
+        value = self._get(key, bytes, b'')
+        start, end = int(start), int(end)
+        if start < 0:
+            start = max(len(value) + start, 0)
+        if end < 0:
+            end = len(value) + end
+        return value[start:end + 1]
+
+    def cmd_INCR(self, key):
+        value = int(self._get(key, bytes, b'0')) + 1
+        self.data[key] = str(value).encode()
+        return value
+
+    # Hash commands
+    def cmd_HSET(self, key, *pairs):
+        hash_value = self._get(key, dict, {})
+        added = 0
+        for index in range(0, len(pairs), 2):
+            if pairs[index] not in hash_value:
+                added += 1
+            hash_value[pairs[index]] = pairs[index + 1]
+        self.data[key] = hash_value
+        return added
+
+    cmd_HMSET = cmd_HSET
+
+    def cmd_HGET(self, key, field):
+        return self._get(key, dict, {}).get(field)
+
+    def cmd_HMGET(self, key, *fields):
+        hash_value = self._get(key, dict, {})
+        return [hash_value.get(field) for field in fields]
+
+    def cmd_HGETALL(self, key):
+        result = []
+        for field, value in self._get(key, dict, {}).items():
+            result += [field, value]
+        return result
+
+    def cmd_HINCRBY(self, key, field, amount):
+        hash_value = self._get(key, dict, {})
+        hash_value[field] = str(int(hash_value.get(field, b'0')) + int(amount)).encode()
+        self.data[key] = hash_value
+        return int(hash_value[field])
+
+    # List commands
+    def cmd_RPUSH(self, key, *values):
+        list_value = self._get(key, list, [])
+        list_value.extend(values)
+        self.data[key] = list_value
+        return len(list_value)
+
+    def cmd_LPUSH(self, key, *values):
+        list_value = self._get(key, list, [])
+        for value in values:
+            list_value.insert(0, value)
+        self.data[key] = list_value
+        return len(list_value)
+
+    def cmd_LPOP(self, key, count=None):
+        list_value = self._get(key, list, [])
+        if count is None:
+            value = list_value.pop(0) if list_value else None
+            if not list_value:
+                self.data.pop(key, None)
+            return value
+        if not list_value:
+            return None
+        values = list_value[:int(count)]
+        del list_value[:int(count)]
+        if not list_value:
+            self.data.pop(key, None)
+        return values
+
+    def cmd_LLEN(self, key):
+        return len(self._get(key, list, []))
+
+    def cmd_LRANGE(self, key, start, end):
+        list_value = self._get(key, list, [])
+        start, end = int(start), int(end)
+        if end < 0:
+            end = len(list_value) + end
+        return list_value[start:end + 1]
+
+    def cmd_LTRIM(self, key, start, end):
+        list_value = self._get(key, list, [])
+        start, end = int(start), int(end)
+        if end < 0:
+            end = len(list_value) + end
+        list_value[:] = list_value[start:end + 1]
+        if not list_value:
+            self.data.pop(key, None)
+        return 'OK'
+
+    def cmd_BLPOP(self, *args):
+        keys, timeout = args[:-1], float(args[-1])
+        deadline = time.time() + timeout if timeout else None
+        with self._condition:
+            while self._running:
+                self._expire()
+                for key in keys:
+                    try:
+                        list_value = self._get(key, list, [])
+                    except FakeRedisError as exc:
+                        return exc
+                    if list_value:
+                        value = list_value.pop(0)
+                        if not list_value:
+                            self.data.pop(key, None)
+                        return [key, value]
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return None
+                self._condition.wait(remaining)
+
+    # Sorted set commands
+    def cmd_TIME(self):
+        now = time.time()
+        return [str(int(now)).encode(), str(int(now % 1 * 1000000)).encode()]
+
+    def cmd_ZADD(self, key, *pairs):
+        zset = self._get(key, ZSet, ZSet())
+        added = 0
+        for index in range(0, len(pairs), 2):
+            if pairs[index + 1] not in zset:
+                added += 1
+            zset[pairs[index + 1]] = float(pairs[index])
+        self.data[key] = zset
+        return added
+
+    def cmd_ZREM(self, key, *members):
+        zset = self._get(key, ZSet, ZSet())
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+
+    def cmd_ZRANGEBYSCORE(self, key, minimum, maximum):
+        zset = self._get(key, ZSet, ZSet())
+        minimum = float('-inf') if minimum == b'-inf' else float(minimum)
+        maximum = float('inf') if maximum == b'+inf' else float(maximum)
+        members = [(score, member) for member, score in zset.items() if minimum <= score <= maximum]
+        return [member for score, member in sorted(members)]
+
+    def cmd_ZREMRANGEBYSCORE(self, key, minimum, maximum):
+        zset = self._get(key, ZSet, ZSet())
+        members = self.cmd_ZRANGEBYSCORE(key, minimum, maximum)
+        for member in members:
+            del zset[member]
+        return len(members)
+
+    def cmd_ZSCORE(self, key, member):
+        score = self._get(key, ZSet, ZSet()).get(member)
+        if score is None:
+            return None
+        return repr(score).encode()
+
+    # Set commands
+    def cmd_SADD(self, key, *members):
+        set_value = self._get(key, set, set())
+        added = len(set(members) - set_value)
+        set_value.update(members)
+        self.data[key] = set_value
+        return added
+
+    def cmd_SMEMBERS(self, key):
+        return sorted(self._get(key, set, set()))
+
+    # Stream commands
+    def cmd_XADD(self, key, *args):
+        args = list(args)
+        maxlen = None
+        if args[0].upper() == b'MAXLEN':
+            if args[1] in (b'~', b'='):
+                del args[1]
+            maxlen = int(args[1])
+            args = args[2:]
+        stream = self._get(key, Stream, Stream())
+        self._sequence += 1
+        entry_id = b'%d-%d' % (int(time.time() * 1000), self._sequence)
+        stream.append((entry_id, list(args[1:])))
+        if maxlen is not None and len(stream) > maxlen:
+            del stream[:len(stream) - maxlen]
+        self.data[key] = stream
+        return entry_id
+
+    def cmd_XLEN(self, key):
+        return len(self._get(key, Stream, Stream()))
+
+    def cmd_XRANGE(self, key, start, end, *args):
+        return [[entry_id, fields] for entry_id, fields in self._get(key, Stream, Stream())]
+
+    def cmd_XREVRANGE(self, key, end, start, *args):
+        count = int(args[1]) if args and args[0].upper() == b'COUNT' else None
+        entries = [[entry_id, fields] for entry_id, fields in reversed(self._get(key, Stream, Stream()))]
+        return entries if count is None else entries[:count]
+
+    def cmd_XREAD(self, *args):
+        # Non-blocking reads only
+        args = list(args)
+        count = None
+        if args[0].upper() == b'COUNT':
+            count = int(args[1])
+            args = args[2:]
+        args = args[1:]
+        half = len(args) // 2
+        reply = []
+        for key, last_id in zip(args[:half], args[half:]):
+            if last_id == b'$':
+                continue
+            last_id = stream_id(last_id)
+            entries = [
+                [entry_id, fields] for entry_id, fields in self._get(key, Stream, Stream())
+                if stream_id(entry_id) > last_id
+            ]
+            if count is not None:
+                entries = entries[:count]
+            if entries:
+                reply.append([key, entries])
+        return reply or None
+
+
+def stream_id(entry_id):
+    milliseconds, sequence = entry_id.split(b'-')
+    return int(milliseconds), int(sequence)
+
+
+class ZSet(dict):
+    pass
+
+
+class Stream(list):
+    pass
+
+
+class CountingSocket(object):
+    """
+    Socket wrapper that counts the bytes sent and received and the number of
+    network round trips.  A round trip is counted each time the client
+    starts receiving after sending and has to wait for the reply, reading
+    replies that are already in flight is not counted.  The replies of a
+    server without latency can arrive before the client waits for them, so
+    round trips are only counted reliably when the server adds latency.
+    """
+    def __init__(self, sock):
+        self._socket = sock
+        self.reset()
+
+    def reset(self):
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.round_trips = 0
+        self._sending = False
+
+    def send(self, data):
+        sent = self._socket.send(data)
+        self.bytes_sent += sent
+        self._sending = True
+        return sent
+
+    def sendall(self, data):
+        self._socket.sendall(data)
+        self.bytes_sent += len(data)
+        self._sending = True
+
+    def write(self, data):
+        return self.send(data)
+
+    def _waiting(self):
+        if self._sending:
+            readable = select.select([self._socket], [], [], 0)[0]
+            if not readable:
+                self.round_trips += 1
+            self._sending = False
+
+    def recv(self, size):
+        self._waiting()
+        data = self._socket.recv(size)
+        self.bytes_received += len(data)
+        return data
+
+    def recv_into(self, buffer):
+        self._waiting()
+        received = self._socket.recv_into(buffer)
+        self.bytes_received += received
+        return received
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+def counting_client(server):
+    """
+    Get a redis client connected to the fake server through a CountingSocket
+
+    Parameters
+    ----------
+    server : FakeRedis
+        The server to connect to
+
+    Returns
+    -------
+    uredis_modular.client.Client
+        The client, its connection.socket is the CountingSocket
+    """
+    from uredis_modular.client import Client
+    client = Client(server.host, server.port)
+    client.connection.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    client.connection.socket = CountingSocket(client.connection.socket)
+    return client
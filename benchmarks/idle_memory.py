@@ -0,0 +1,172 @@
+"""
+Idle loop memory benchmark
+
+Runs idle eventloop iterations (scheduler pass, heartbeat refresh and a
+one second BLPOP that times out) and reports the heap allocated per iteration.  Exits
+with a non-zero status if it is above the limit, so it can be used as a
+regression check.
+
+On micropython the allocations are measured with gc.mem_free() with the
+garbage collector disabled, against the redis server given on the command
+line:
+
+    micropython benchmarks/idle_memory.py HOST [PORT] [LIMIT]
+
+On cpython it runs against the fake redis server in a child process and
+measures the peak memory allocated during each iteration with tracemalloc:
+
+    python benchmarks/idle_memory.py [LIMIT]
+"""
+import gc
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from redis_cloudclient.clock import mem_free  # noqa: E402
+from redis_cloudclient.eventloop import EventLoop  # noqa: E402
+
+
+CONFIG = {
+    'name': 'benchmark',
+    'cloudmanager_reset_after': '',
+    'cloudmanager_debug_exec': '',
+}
+ITERATIONS = 20
+
+# Bytes per idle iteration.  The iteration reuses its encoded commands,
+# reply buffers and reply list, on micropython it shouldn't allocate at
+# all.  What cpython measures is mostly the int objects of the tick counts,
+# which are small ints on micropython.
+DEFAULT_LIMIT = 384
+
+
+def idle_iteration(eventloop, pipeline, timeout=1):
+    """
+    Run one pass of the eventloop that has nothing to do except refresh
+    the heartbeat
+    """
+    eventloop.scheduler.reschedule('heartbeat', delay=0)
+    eventloop.scheduler.run(pipeline)
+    eventloop.handle_queues(timeout=timeout, pipeline=pipeline)
+
+
+def measure_mem_free(eventloop, pipeline, iterations=ITERATIONS):
+    """
+    Measure the heap allocated per idle iteration with gc.mem_free()
+
+    Returns
+    -------
+    float
+        Bytes allocated per iteration
+    """
+    # Warm up the cached commands
+    idle_iteration(eventloop, pipeline)
+    gc.collect()
+    gc.disable()
+    try:
+        before = mem_free()
+        for count in range(iterations):
+            idle_iteration(eventloop, pipeline)
+        after = mem_free()
+    finally:
+        gc.enable()
+    return (before - after) / iterations
+
+
+def measure_tracemalloc(eventloop, pipeline, iterations=5):
+    """
+    Measure the peak memory allocated during an idle iteration with
+    tracemalloc
+
+    Returns
+    -------
+    float
+        Bytes allocated per iteration
+    """
+    import tracemalloc
+
+    idle_iteration(eventloop, pipeline)
+    total = 0
+    tracemalloc.start()
+    try:
+        for count in range(iterations):
+            gc.disable()
+            start = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            idle_iteration(eventloop, pipeline)
+            total += tracemalloc.get_traced_memory()[1] - start
+            gc.enable()
+    finally:
+        tracemalloc.stop()
+    return total / float(iterations)
+
+
+def serve(connection):
+    """
+    Run the fake redis server until anything is received on the connection
+    """
+    from fakeredis import FakeRedis
+
+    with FakeRedis() as server:
+        connection.send(server.port)
+        connection.recv()
+
+
+def measure_fake_server():
+    """
+    Measure the heap allocated per idle iteration on cpython against the
+    fake redis server
+
+    Returns
+    -------
+    float
+        Bytes allocated per iteration
+    """
+    import multiprocessing
+
+    stdout = sys.stdout
+    # The server runs in another process so its allocations aren't
+    # measured
+    connection, child_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=serve, args=(child_connection,))
+    process.start()
+    try:
+        port = connection.recv()
+        eventloop = EventLoop(redis_server='127.0.0.1', redis_port=port, config=dict(CONFIG))
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            eventloop.connect()
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        eventloop.heartbeat()
+        return measure_tracemalloc(eventloop, eventloop.pipeline())
+    finally:
+        connection.send(None)
+        process.join()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if mem_free() is None:
+        limit = int(argv[0]) if argv else DEFAULT_LIMIT
+        allocated = measure_fake_server()
+    else:
+        host = argv[0]
+        port = int(argv[1]) if len(argv) > 1 else 18266
+        limit = int(argv[2]) if len(argv) > 2 else DEFAULT_LIMIT
+        eventloop = EventLoop(redis_server=host, redis_port=port, config=dict(CONFIG))
+        eventloop.connect()
+        eventloop.heartbeat()
+        allocated = measure_mem_free(eventloop, eventloop.pipeline())
+
+    print('idle iteration allocates %.1f bytes (limit %d)' % (allocated, limit))
+    if allocated > limit:
+        print('FAIL')
+        sys.exit(1)
+    print('OK')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,244 @@
+"""
+Round trip benchmarks
+
+Runs the client operations against the in-process fake redis server and
+reports the number of network round trips, the bytes sent and received and
+the wall time of each one.
+
+Usage:
+
+    python benchmarks/roundtrips.py [--latency MS]
+
+The simulated latency defaults to 1 ms, see fakeredis.CountingSocket.
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fakeredis import FakeRedis, counting_client  # noqa: E402
+from redis_cloudclient.codecache import code_digest, code_key, handle_exec_hash  # noqa: E402
+from redis_cloudclient.console import RedisStream  # noqa: E402
+from redis_cloudclient.eventloop import EventLoop  # noqa: E402
+from redis_cloudclient.transfer import handle_upload  # noqa: E402
+
+
+CONFIG = {
+    'name': 'benchmark',
+    'cloudmanager_reset_after': '',
+    'cloudmanager_debug_exec': '',
+}
+
+
+class Measurement(object):
+    """
+    Context manager that records the round trips, bytes and wall time used
+    by the client inside it
+    """
+    def __init__(self, name, client, repeat=1):
+        self.name = name
+        self.socket = client.connection.socket
+        self.repeat = repeat
+
+    def __enter__(self):
+        self.socket.reset()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.elapsed = time.time() - self.start
+        self.round_trips = self.socket.round_trips
+        self.bytes_sent = self.socket.bytes_sent
+        self.bytes_received = self.socket.bytes_received
+
+    def report(self):
+        return '%-34s %10.1f %10.1f %10.1f %10.2f' % (
+            self.name,
+            self.round_trips / float(self.repeat),
+            self.bytes_sent / float(self.repeat),
+            self.bytes_received / float(self.repeat),
+            self.elapsed * 1000 / self.repeat,
+        )
+
+
+def new_eventloop(server, config=None):
+    """
+    Create an EventLoop connected to the fake server
+
+    Returns
+    -------
+    EventLoop
+        The connected eventloop
+    """
+    client = counting_client(server)
+    eventloop = EventLoop(
+        redis_server=server.host, redis_port=server.port, redis_connection=client, config=dict(config or CONFIG)
+    )
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        eventloop.connect()
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+    return eventloop
+
+
+def bench_heartbeat(server, repeat):
+    eventloop = new_eventloop(server)
+    with Measurement('heartbeat', eventloop.redis_connection, repeat) as measurement:
+        for count in range(repeat):
+            eventloop.heartbeat()
+    return [measurement]
+
+
+def bench_idle(server, repeat):
+    eventloop = new_eventloop(server)
+    # Give the BLPOP something to return so it doesn't wait for the timeout
+    noop_key = eventloop.base_key + b'.noop'
+    eventloop.handlers[noop_key] = lambda value: None
+    eventloop.heartbeat()
+    pipeline = eventloop.pipeline()
+    with Measurement('idle iteration', eventloop.redis_connection, repeat) as measurement:
+        for count in range(repeat):
+            # Every iteration includes a heartbeat refresh
+            eventloop.scheduler.reschedule('heartbeat', delay=0)
+            eventloop.scheduler.run(pipeline)
+            server.execute([b'RPUSH', noop_key, b''])
+            eventloop.handle_queues(pipeline=pipeline)
+    return [measurement]
+
+
+def bench_exec_command(server, repeat):
+    eventloop = new_eventloop(server)
+    measurements = []
+    for name, command in [
+        ('exec_command pass', b'pass'),
+        ('exec_command print x100', b'for i in range(100):\n    print("line", i)'),
+    ]:
+        stdout = sys.stdout
+        sys.stdout = eventloop.console
+        try:
+            with Measurement(name, eventloop.redis_connection, repeat) as measurement:
+                for count in range(repeat):
+                    eventloop.exec_command(command)
+        finally:
+            sys.stdout = stdout
+        measurements.append(measurement)
+    command = b'for i in range(100):\n    print("line", i)'
+    digest = code_digest(command)
+    server.data[code_key(digest)] = command
+    stdout = sys.stdout
+    sys.stdout = eventloop.console
+    try:
+        with Measurement('exec_hash print x100', eventloop.redis_connection, repeat) as measurement:
+            for count in range(repeat):
+                handle_exec_hash(eventloop, digest)
+    finally:
+        sys.stdout = stdout
+    measurements.append(measurement)
+    return measurements
+
+
+def bench_drain(server, repeat):
+    measurements = []
+    for drain_limit in ['1', '16']:
+        config = dict(CONFIG, cloudmanager_drain_limit=drain_limit)
+        eventloop = new_eventloop(server, config)
+        command_key = eventloop.base_key + b'.command'
+        pipeline = eventloop.pipeline()
+        stdout = sys.stdout
+        sys.stdout = eventloop.console
+        try:
+            name = 'queued pass x16 drain_limit=%s' % drain_limit
+            with Measurement(name, eventloop.redis_connection, repeat) as measurement:
+                for count in range(repeat):
+                    server.execute([b'RPUSH', command_key] + [b'pass'] * 16)
+                    while server.data.get(command_key):
+                        eventloop.handle_queues(pipeline=pipeline)
+        finally:
+            sys.stdout = stdout
+        measurements.append(measurement)
+    return measurements
+
+
+def bench_copy_file(server, repeat):
+    eventloop = new_eventloop(server)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'copy.bin').encode()
+    measurements = []
+    for size in [1024, 16 * 1024, 100 * 1024]:
+        server.data[b'bench:source'] = os.urandom(size)
+        stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            with Measurement('copy_file %dKB' % (size // 1024), eventloop.redis_connection, repeat) as measurement:
+                for count in range(repeat):
+                    server.data[b'bench:copy'] = {b'source': b'bench:source', b'dest': filename}
+                    eventloop.copy_file(b'bench:copy')
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+        measurements.append(measurement)
+    os.remove(filename)
+    os.rmdir(directory)
+    return measurements
+
+
+def bench_upload_file(server, repeat):
+    eventloop = new_eventloop(server)
+    directory = tempfile.mkdtemp()
+    filename = os.path.join(directory, 'upload.bin')
+    measurements = []
+    for size in [1024, 16 * 1024, 100 * 1024]:
+        with open(filename, 'wb') as file_handle:
+            file_handle.write(os.urandom(size))
+        with Measurement('upload_file %dKB' % (size // 1024), eventloop.redis_connection, repeat) as measurement:
+            for count in range(repeat):
+                server.data[b'bench:upload'] = {b'source': filename.encode(), b'dest': b'bench:uploaded'}
+                handle_upload(eventloop, b'bench:upload')
+        measurements.append(measurement)
+    os.remove(filename)
+    os.rmdir(directory)
+    return measurements
+
+
+def bench_console(server, repeat):
+    client = counting_client(server)
+    measurements = []
+    for buffer_size in [0, 80, 256, 1024]:
+        stream = RedisStream(client, b'bench:console', buffer_size=buffer_size)
+        with Measurement('RedisStream buffer_size=%d' % buffer_size, client, repeat) as measurement:
+            for count in range(repeat):
+                for line in range(100):
+                    stream.write(b'line %d\n' % line)
+                stream.flush()
+        measurements.append(measurement)
+    return measurements
+
+
+BENCHMARKS = [
+    bench_heartbeat, bench_idle, bench_exec_command, bench_drain, bench_copy_file, bench_upload_file, bench_console,
+]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    # Without latency the replies arrive before the client waits for them and
+    # the round trips are undercounted, see CountingSocket
+    parser.add_argument('--latency', type=float, default=1, help='Simulated round trip latency in milliseconds')
+    parser.add_argument('--repeat', type=int, default=5, help='Number of times to repeat each operation')
+    args = parser.parse_args(argv)
+
+    print('%-34s %10s %10s %10s %10s' % ('operation', 'trips', 'sent', 'received', 'ms'))
+    with FakeRedis(latency=args.latency / 1000) as server:
+        for benchmark in BENCHMARKS:
+            for measurement in benchmark(server, args.repeat):
+                print(measurement.report())
+
+
+if __name__ == '__main__':
+    main()
@@ -4,4 +4,8 @@ from .eventloop import start
 __version__ = '0.0.80'
 
 
-all = ['console', 'eventloop', 'logging', 'service']
\ No newline at end of file
+__all__ = [
+    'asyncclient', 'asynceventloop', 'bundle', 'clock', 'codecache', 'compression', 'console', 'delta', 'eventloop',
+    'exceptions', 'fleet', 'groups', 'jobs', 'liveness', 'pipeline', 'registry', 'scheduler', 'service', 'stats',
+    'telemetry', 'transfer', 'start',
+]
@@ -0,0 +1,141 @@
+"""
+Non-blocking redis client functionality for uasyncio/asyncio
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from .pipeline import encode_command
+
+
+class AsyncClient(object):
+    """
+    Minimal redis client that runs commands over asyncio streams
+
+    Commands from different tasks are serialized with a lock, so a
+    blocking command such as BLPOP should get its own client.
+
+    Parameters
+    ----------
+    reader : StreamReader
+        The stream to read replies from
+
+    writer : StreamWriter
+        The stream to send commands on
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._lock = asyncio.Lock()
+
+    async def execute_command(self, command, *args):
+        """
+        Run a redis command
+
+        Parameters
+        ----------
+        command : str
+            The redis command
+
+        args
+            The command arguments
+
+        Returns
+        -------
+        The reply from the server
+        """
+        return (await self.execute_pipeline([(command,) + args]))[0]
+
+    async def execute_pipeline(self, commands):
+        """
+        Send several commands in one write and read all of the replies
+
+        Parameters
+        ----------
+        commands : list
+            List of command tuples
+
+        Returns
+        -------
+        list
+            The replies in the order of the commands
+        """
+        from uredis_modular.client import RedisError
+
+        stream = bytearray()
+        for command in commands:
+            encode_command(stream, command)
+        async with self._lock:
+            self.writer.write(stream)
+            await self.writer.drain()
+            responses = []
+            error = None
+            for command in commands:
+                try:
+                    responses.append(await self._read_response())
+                except RedisError as exc:
+                    # Keep reading so the connection stays in sync
+                    responses.append(exc)
+                    if error is None:
+                        error = exc
+        if error is not None:
+            raise error
+        return responses
+
+    async def _read_response(self):
+        from uredis_modular.client import InvalidResponse, RedisError
+
+        line = await self.reader.readline()
+        if not line:
+            raise OSError('Connection closed by the server')
+        response_type = line[:1]
+        response_value = line[1:-2]
+        if response_type == b'+':
+            return response_value
+        elif response_type == b'-':
+            raise RedisError(response_value)
+        elif response_type == b':':
+            return int(response_value)
+        elif response_type == b'$':
+            length = int(response_value)
+            if length == -1:
+                return None
+            return (await self.reader.readexactly(length + 2))[:-2]
+        elif response_type == b'*':
+            length = int(response_value)
+            if length == -1:
+                return None
+            items = []
+            for item in range(length):
+                items.append(await self._read_response())
+            return items
+        raise InvalidResponse('Protocol Error: %s' % line.decode())
+
+    async def close(self):
+        """
+        Close the connection
+        """
+        self.writer.close()
+        await self.writer.wait_closed()
+
+
+async def open_client(host, port=6379):
+    """
+    Connect to a redis server
+
+    Parameters
+    ----------
+    host : str
+        Hostname or IP address of the redis server
+
+    port : int, optional
+        Port number of the redis server, default=6379
+
+    Returns
+    -------
+    AsyncClient
+        The connected client
+    """
+    reader, writer = await asyncio.open_connection(host, int(port))
+    return AsyncClient(reader, writer)
@@ -0,0 +1,233 @@
+"""
+Asynchronous eventloop functionality
+
+Only the wait for events is non-blocking.  The BLPOP and the group stream
+reads are sent on an AsyncClient, everything else still uses the blocking
+redis Client of the EventLoop: the scheduled tasks (heartbeat and liveness
+refreshes, stats, telemetry, clock syncs), console output and the replies
+of the handlers.  These are short round trips, but while one of them waits
+for the server no other task runs, so on a slow link they hold up the
+asyncio loop for a round trip each time.
+"""
+try:
+    import uasyncio as asyncio
+except ImportError:
+    import asyncio
+
+from uredis_modular.client import InvalidResponse
+from .asyncclient import open_client
+from .codecache import code_digest
+from .eventloop import EventLoop, start as start_eventloop
+from .exceptions import RedisNotRunning
+
+
+class AsyncEventLoop(EventLoop):
+    """
+    Eventloop that runs on uasyncio (asyncio on cpython)
+
+    Queue consumption, the scheduled heartbeat refreshes and console
+    flushing run as separate tasks.  The BLPOP is sent on its own
+    non-blocking connection so waiting for events doesn't stop the other
+    tasks.  The scheduler and console tasks send their commands on the
+    blocking connection, see the module documentation.
+
+    Commands that only compile inside an async function, because they use
+    await, are started as a task so they can yield with
+    ``await asyncio.sleep()``.  The board keeps handling its queues and
+    sending heartbeats while they run, the output of commands that run at
+    the same time is mixed on the console.  The command is indented into
+    the body of an async function, so multi-line string literals in it get
+    indented too.  The names ``eventloop`` and ``asyncio`` are available to
+    the command.
+
+    The group streams are read in the same round trip as the BLPOP.
+
+    If the connection to the server is lost the board reconnects the same
+    way as the EventLoop, keeping its state, and opens a new queue
+    connection.
+    """
+    queue_timeout = 5
+
+    def __init__(self, *args, **kwargs):
+        self._command_tasks = []
+        super().__init__(*args, **kwargs)
+
+    def run(self):
+        """
+        Start the eventloop
+        """
+        asyncio.run(self.run_async())
+
+    async def run_async(self):
+        """
+        Coroutine that runs the eventloop
+        """
+        self.connect()
+        self.queue_connection = None
+        try:
+            await self._open_queue_connection()
+            while True:
+                try:
+                    await self._run_tasks()
+                except (OSError, InvalidResponse) as exc:
+                    # A closed socket shows up as an invalid (empty) response
+                    print('Lost connection to the cloudmanager server: %s' % exc)
+                    self.reconnect()
+                    await self._open_queue_connection()
+        finally:
+            if self.queue_connection is not None:
+                await self._close_queue_connection()
+
+    async def _open_queue_connection(self):
+        """
+        Open the connection the BLPOP is sent on, replacing the current one
+        """
+        if self.queue_connection is not None:
+            await self._close_queue_connection()
+        try:
+            self.queue_connection = await open_client(self.redis_server, self.redis_port)
+        except OSError:
+            raise RedisNotRunning(
+                'The Cloudmanager service is not running at %s:%s' % (self.redis_server, self.redis_port)
+            )
+
+    async def _close_queue_connection(self):
+        try:
+            await self.queue_connection.close()
+        except OSError:
+            pass
+        self.queue_connection = None
+
+    async def _run_tasks(self):
+        """
+        Run the eventloop tasks until one of them fails
+        """
+        self.heartbeat(state=b'idle')
+        tasks = [
+            asyncio.create_task(self._queue_task()),
+            asyncio.create_task(self._scheduler_task()),
+            asyncio.create_task(self._console_task()),
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _queue_task(self):
+        """
+        Task that waits for events and calls the handlers
+        """
+        while True:
+            if self._handler_count != len(self.handlers):
+                self._handlers_changed()
+            timeout = self._limit_timeout(self.queue_timeout)
+            commands = [('BLPOP',) + self._queue_keys + (timeout,)]
+            if self._group_keys:
+                commands.insert(0, self._group_read_command())
+            responses = await self.queue_connection.execute_pipeline(commands)
+            if len(responses) > 1 and responses[0]:
+                self._run_group_entries(responses[0])
+            response = responses[-1]
+            if response:
+                queuekey, value = response
+                self._dispatch(queuekey, self.handlers.get(queuekey, self.not_implemented), value)
+            await asyncio.sleep(0)
+
+    def _dispatch(self, queuekey, handler, value):
+        """
+        Call a handler, async handlers are started as a task so the queues
+        are still read while they run
+        """
+        result = super()._dispatch(queuekey, handler, value)
+        if hasattr(result, 'send'):
+            # Keep a reference to the running tasks so they aren't collected
+            self._command_tasks = [task for task in self._command_tasks if not task.done()]
+            self._command_tasks.append(asyncio.create_task(result))
+        return result
+
+    async def _scheduler_task(self):
+        """
+        Task that runs the scheduled operations such as heartbeat refreshes,
+        their commands are sent on the blocking connection
+        """
+        pipeline = self.pipeline()
+        while True:
+            self.scheduler.run(pipeline)
+            pipeline.execute()
+            await asyncio.sleep(self.scheduler.timeout(1000) / 1000)
+
+    async def _console_task(self):
+        """
+        Task that sends console output that has been buffered for longer
+        than the console flush interval, on the blocking connection
+        """
+        while True:
+            await asyncio.sleep(self.console.flush_interval / 1000)
+            self.console.poll()
+
+    def exec_command(self, command, digest=None):
+        """
+        Execute a single command.
+
+        Commands that use await outside of a function don't compile on their
+        own, they are run as a coroutine.  Other commands run the same way as
+        on the EventLoop.
+
+        Parameters
+        ----------
+        command: bytes
+            The command to execute, may be None if its compiled code is in
+            the code cache
+
+        digest: bytes, optional
+            The digest of the command source, calculated if not specified
+
+        Returns
+        -------
+        int or coroutine
+            The return code of the command, or a coroutine returning it for
+            commands that use await.
+        """
+        if command is None:
+            return super().exec_command(command, digest)
+        if digest is None:
+            digest = code_digest(command)
+        try:
+            # Caches the code for the EventLoop to run
+            self.code_cache.compile(command, digest)
+        except SyntaxError:
+            pass
+        else:
+            return super().exec_command(command, digest)
+        # The coroutine runs after the group entry is dispatched, so it
+        # keeps the completion list of the entry
+        return self._exec_async(command, self._group_completion)
+
+    async def _exec_async(self, command, group_completion=None):
+        self._begin_command(command)
+        profile = self._start_profile()
+        lines = ['async def _command():']
+        for line in command.decode().split('\n'):
+            lines.append('    ' + line)
+        namespace = {'eventloop': self, 'asyncio': asyncio}
+        try:
+            exec('\n'.join(lines), namespace)
+            await namespace['_command']()
+            rc = 0
+        except Exception as exc:
+            from sys import print_exception
+            print_exception(exc)
+            rc = 1
+        self._group_completion = group_completion
+        try:
+            return self._end_command(rc, profile, code_digest(command))
+        finally:
+            self._group_completion = None
+
+
+def start():
+    """
+    Start the asynchronous event loop
+    """
+    start_eventloop(AsyncEventLoop)
@@ -0,0 +1,159 @@
+"""
+Multi-file bundle functionality
+
+A bundle holds any number of files in a single redis value so they can be
+deployed in one transaction.
+
+Bundle format:
+
+    b'RCB1'
+    name length (2 bytes) name data length (4 bytes) data
+    ...
+    name length of 0 marks the end of the bundle
+
+All integers are unsigned big endian, names are utf-8 paths using '/' as
+the separator.
+"""
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+
+
+BUNDLE_MAGIC = b'RCB1'
+
+
+class BundleError(Exception):
+    pass
+
+
+def make_bundle(files):
+    """
+    Create a bundle
+
+    This is intended to run on the server side.
+
+    Parameters
+    ----------
+    files : list
+        List of (filename, data) tuples
+
+    Returns
+    -------
+    bytes
+        The bundle
+    """
+    bundle = bytearray(BUNDLE_MAGIC)
+    for filename, data in files:
+        if isinstance(filename, str):
+            filename = filename.encode()
+        bundle.extend(struct.pack('>H', len(filename)) + filename)
+        bundle.extend(struct.pack('>I', len(data)))
+        bundle.extend(data)
+    bundle.extend(struct.pack('>H', 0))
+    return bytes(bundle)
+
+
+def handle_bundle(eventloop, transaction_key, buffer_size=256):
+    """
+    Eventloop handler that unpacks a bundle of files to the filesystem.
+
+    The transaction hash has the bundle key in the 'source' field and
+    the optional 'compression' field works the same as for copy_file.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the operation
+
+    transaction_key : bytes
+        The transaction hash key
+
+    buffer_size : int, optional
+        The size of the chunks read from the server, default=256
+    """
+    from .compression import DecompressError, DecompressReader, UnsupportedCompression
+    from .transfer import ValueReader
+
+    pipeline = eventloop.pipeline()
+    eventloop.heartbeat(state=b'copying', ttl=60, pipeline=pipeline)
+    pipeline.execute_command('HGET', transaction_key, 'source')
+    pipeline.execute_command('HGET', transaction_key, 'compression')
+    bundle_key, compression = pipeline.execute()[-2:]
+    rc = 1
+    source = stream = ValueReader(eventloop.redis_connection, bundle_key, chunk_size=buffer_size)
+    try:
+        if compression:
+            stream = DecompressReader(stream, method=compression, chunk_size=buffer_size)
+        filenames = extract_bundle(stream, makedirs=eventloop.makedirs, buffer_size=buffer_size)
+        print('Unpacked %d files' % len(filenames))
+        rc = 0
+    except (DecompressError, UnsupportedCompression) as exc:
+        print('Could not decompress bundle: %s' % exc)
+    except BundleError as exc:
+        print('Could not unpack bundle: %s' % exc)
+    except OSError as exc:
+        if source.error is not None:
+            # The connection failed, leave it to run() to reconnect
+            raise
+        print('Could not unpack bundle: %s' % exc)
+    finally:
+        source.drain()
+    pipeline.execute_command('DEL', transaction_key)
+    eventloop.signal_completion(rc, pipeline=pipeline)
+    eventloop.heartbeat(state=b'idle', pipeline=pipeline)
+    pipeline.execute()
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    while len(data) < size:
+        # Decompressing streams can return less than was asked for
+        more = stream.read(size - len(data))
+        if not more:
+            raise BundleError('Truncated bundle')
+        data += more
+    return data
+
+
+def extract_bundle(stream, makedirs=None, buffer_size=256):
+    """
+    Unpack a bundle to the filesystem in a single pass
+
+    Parameters
+    ----------
+    stream : file
+        File like object to read the bundle from
+
+    makedirs : callable, optional
+        Function called with the filename (bytes) to create the parent
+        directories of a file, it is called once per directory.
+
+    buffer_size : int, optional
+        The amount of file data to hold in memory at once, default=256
+
+    Returns
+    -------
+    list
+        The names of the files written
+    """
+    if _read_exactly(stream, 4) != BUNDLE_MAGIC:
+        raise BundleError('Not a bundle')
+    directories = set()
+    written = []
+    while True:
+        name_length = struct.unpack('>H', _read_exactly(stream, 2))[0]
+        if not name_length:
+            return written
+        filename = _read_exactly(stream, name_length)
+        remaining = struct.unpack('>I', _read_exactly(stream, 4))[0]
+        directory = filename[:filename.rfind(b'/') + 1]
+        if makedirs and directory and directory not in directories:
+            makedirs(filename)
+            directories.add(directory)
+        with open(filename.decode(), 'wb') as file_handle:
+            while remaining:
+                data = _read_exactly(stream, min(remaining, buffer_size))
+                file_handle.write(data)
+                remaining -= len(data)
+        written.append(filename)
@@ -0,0 +1,129 @@
+"""
+Time and memory helpers that work on both micropython and cpython
+"""
+import time
+
+# Looked up once, trying them on every call raises an AttributeError each
+# time on cpython
+try:
+    _ticks_ms = time.ticks_ms
+    _ticks_diff = time.ticks_diff
+except AttributeError:
+    _ticks_ms = None
+    _ticks_diff = None
+
+
+def ticks_ms():
+    """
+    Get a millisecond counter for measuring intervals
+
+    Returns
+    -------
+    int
+        Milliseconds from an arbitrary starting point
+    """
+    if _ticks_ms is not None:
+        return _ticks_ms()
+    return int(time.time() * 1000)
+
+
+def ticks_diff(end, start):
+    """
+    Get the number of milliseconds between two ticks_ms() values
+
+    Parameters
+    ----------
+    end : int
+        The later ticks value
+
+    start : int
+        The earlier ticks value
+
+    Returns
+    -------
+    int
+        Milliseconds between start and end
+    """
+    if _ticks_diff is not None:
+        return _ticks_diff(end, start)
+    return end - start
+
+
+def mem_free():
+    """
+    Get the amount of free heap memory
+
+    Returns
+    -------
+    int
+        Free heap in bytes or None if the platform can't report it
+    """
+    import gc
+    try:
+        return gc.mem_free()
+    except AttributeError:
+        return None
+
+
+class ServerClock(object):
+    """
+    Time on the redis server, for boards that don't have a synchronised
+    clock
+
+    The server time is read with TIME by sync() and the time since then is
+    measured with ticks_ms(), so it should be synced again well within the
+    ticks_ms() wrap around period.
+    """
+    def __init__(self):
+        # The whole seconds of the server time read by sync()
+        self.base = None
+        self._milliseconds = 0
+        self._ticks = 0
+
+    @property
+    def synced(self):
+        return self.base is not None
+
+    def sync(self, redis):
+        """
+        Read the current time from the redis server
+
+        Parameters
+        ----------
+        redis : uredis_modular.client.Client
+            The redis connection
+        """
+        seconds, microseconds = redis.execute_command('TIME')
+        self._ticks = ticks_ms()
+        self.base = int(seconds)
+        self._milliseconds = int(microseconds) // 1000
+
+    def elapsed(self):
+        """
+        Get the whole seconds the server time has moved on from base
+
+        Unlike the server time this stays a small int on micropython, so
+        it can be read without allocating.
+
+        Returns
+        -------
+        int
+            Seconds since base, None if the clock hasn't been synced
+        """
+        if self.base is None:
+            return None
+        return (self._milliseconds + ticks_diff(ticks_ms(), self._ticks)) // 1000
+
+    def time(self):
+        """
+        Get the server time
+
+        Returns
+        -------
+        int
+            The server time in whole seconds since the epoch, None if the
+            clock hasn't been synced
+        """
+        if self.base is None:
+            return None
+        return self.base + self.elapsed()
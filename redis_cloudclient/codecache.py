@@ -0,0 +1,194 @@
+"""
+Compiled code cache
+
+Commands are compiled once and the code objects are kept in a small least
+recently used cache keyed by the sha256 digest of the source.  The server
+can store the source under ``code:<digest>`` and send only the digest to
+the exec_hash operation, the source is then fetched only when the board
+doesn't have the code cached, the same way redis EVALSHA works.  The
+exec_hash operation is handled by handle_exec_hash().
+"""
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+
+
+def code_digest(source):
+    """
+    Get the digest that identifies a command
+
+    Parameters
+    ----------
+    source : bytes
+        The python source
+
+    Returns
+    -------
+    bytes
+        The hex encoded sha256 digest of the source
+    """
+    if isinstance(source, str):
+        source = source.encode()
+    return binascii.hexlify(hashlib.sha256(source).digest())
+
+
+def code_key(digest):
+    """
+    Get the redis key the source of a command is stored under
+
+    Parameters
+    ----------
+    digest : bytes
+        The hex digest of the source
+
+    Returns
+    -------
+    bytes
+        The key name
+    """
+    return b'code:' + digest
+
+
+def handle_exec_hash(eventloop, digest):
+    """
+    Eventloop handler that executes a command by the digest of its source.
+
+    The compiled command is taken from the code cache, the source is only
+    read from the code:<digest> key when it isn't cached.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the operation
+
+    digest : bytes
+        The hex sha256 digest of the command source
+
+    Returns
+    -------
+    int
+        The return code of the command, 1 if the source is missing or
+        doesn't match the digest.
+    """
+    source = None
+    if digest not in eventloop.code_cache:
+        source = eventloop.redis_connection.execute_command('GET', code_key(digest))
+        if source is not None and code_digest(source) != digest:
+            # Don't cache the code under the wrong digest
+            source = None
+    return eventloop.exec_command(source, digest)
+
+
+class CodeCache(object):
+    """
+    Least recently used cache of compiled code objects
+
+    Parameters
+    ----------
+    size : int, optional
+        The maximum number of code objects to keep, default=8
+    """
+    def __init__(self, size=8):
+        self.size = size
+        self.code = {}
+        # Digests from least to most recently used
+        self.order = []
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.code)
+
+    def __contains__(self, digest):
+        return digest in self.code
+
+    def get(self, digest):
+        """
+        Get a cached code object
+
+        Parameters
+        ----------
+        digest : bytes
+            The hex digest of the source
+
+        Returns
+        -------
+        code or None
+            The code object or None if it isn't cached
+        """
+        code = self.code.get(digest)
+        if code is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        if self.order[-1] != digest:
+            self.order.remove(digest)
+            self.order.append(digest)
+        return code
+
+    def put(self, digest, code):
+        """
+        Add a code object, dropping the least recently used one if the cache
+        is full
+
+        Parameters
+        ----------
+        digest : bytes
+            The hex digest of the source
+
+        code : code
+            The compiled code
+        """
+        if self.size < 1:
+            return
+        if digest in self.code:
+            self.order.remove(digest)
+        elif len(self.order) >= self.size:
+            del self.code[self.order.pop(0)]
+        self.code[digest] = code
+        self.order.append(digest)
+
+    def compile(self, source, digest=None):
+        """
+        Get the code object for source, compiling and caching it if it isn't
+        cached yet
+
+        Parameters
+        ----------
+        source : bytes
+            The python source, may be None if the code is cached
+
+        digest : bytes, optional
+            The digest of the source if it is already known
+
+        Returns
+        -------
+        code
+            The compiled code
+
+        Raises
+        ------
+        ValueError
+            If there is no source and the code isn't cached
+        """
+        if digest is None:
+            digest = code_digest(source)
+        code = self.get(digest)
+        if code is None:
+            if source is None:
+                raise ValueError('No command stored for %r' % digest)
+            code = compile(source, '<command>', 'exec')
+            self.put(digest, code)
+        return code
+
+    def clear(self):
+        """
+        Remove all of the cached code
+        """
+        self.code = {}
+        self.order = []
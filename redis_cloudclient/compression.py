@@ -0,0 +1,283 @@
+"""
+Compressed transfer functionality
+
+Uses the deflate module on newer micropython ports, uzlib on older ones and
+zlib on cpython.  Compression needs the deflate module with compression
+support or cpython zlib.
+"""
+WBITS = {
+    b'deflate': -15,
+    b'zlib': 15,
+    b'gzip': 31,
+}
+
+
+class UnsupportedCompression(Exception):
+    pass
+
+
+class DecompressError(ValueError):
+    """
+    The compressed data is corrupt
+    """
+    pass
+
+
+def _wbits(method):
+    if isinstance(method, str):
+        method = method.encode()
+    try:
+        return WBITS[method.lower()]
+    except KeyError:
+        raise UnsupportedCompression('Unsupported compression %r' % method)
+
+
+def _deflate_format(deflate, wbits):
+    if wbits < 0:
+        return deflate.RAW
+    elif wbits > 15:
+        return deflate.GZIP
+    return deflate.ZLIB
+
+
+class DecompressReader(object):
+    """
+    File like object that decompresses data read from another stream
+    without buffering all of it.
+
+    Parameters
+    ----------
+    stream : file
+        The stream to read compressed data from
+
+    method : bytes, optional
+        The compression format, one of b'deflate', b'zlib' or b'gzip',
+        default=b'zlib'
+
+    chunk_size : int, optional
+        How much compressed data to read from the stream at a time when
+        using cpython zlib, default=256
+
+    Corrupt data raises DecompressError, errors reading the stream are
+    raised as they are.  On micropython the native decompressors report
+    both as OSError, so they are told apart by the error attribute of the
+    stream (see transfer.ValueReader) if it has one.
+    """
+    def __init__(self, stream, method=b'zlib', chunk_size=256):
+        wbits = _wbits(method)
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self._decompressor = None
+        self._decompio = None
+        self._zlib = None
+        try:
+            import deflate
+            self._decompio = deflate.DeflateIO(stream, _deflate_format(deflate, wbits))
+            return
+        except ImportError:
+            pass
+        try:
+            import uzlib
+            self._decompio = uzlib.DecompIO(stream, wbits)
+            return
+        except ImportError:
+            pass
+        import zlib
+        if not hasattr(zlib, 'decompressobj'):
+            raise UnsupportedCompression('No streaming decompression available')
+        self._zlib = zlib
+        self._decompressor = zlib.decompressobj(wbits)
+
+    def read(self, size=-1):
+        """
+        Read decompressed data
+
+        Parameters
+        ----------
+        size : int, optional
+            The maximum number of bytes to read, reads everything if not
+            specified
+
+        Returns
+        -------
+        bytes
+            The decompressed data, empty at the end of the stream
+        """
+        if self._decompio:
+            try:
+                if size is None or size < 0:
+                    return self._decompio.read()
+                return self._decompio.read(size)
+            except OSError as exc:
+                if getattr(self.stream, 'error', None) is not None:
+                    raise
+                raise DecompressError('Corrupt compressed data: %s' % exc)
+
+        try:
+            return self._read(size)
+        except self._zlib.error as exc:
+            raise DecompressError('Corrupt compressed data: %s' % exc)
+
+    def _read(self, size):
+        decompressor = self._decompressor
+        if size is None or size < 0:
+            parts = []
+            while True:
+                data = self._read(self.chunk_size)
+                if not data:
+                    return b''.join(parts)
+                parts.append(data)
+
+        while True:
+            if decompressor.unconsumed_tail:
+                data = decompressor.decompress(decompressor.unconsumed_tail, size)
+            else:
+                compressed = self.stream.read(self.chunk_size)
+                if not compressed:
+                    return decompressor.flush()[:size]
+                data = decompressor.decompress(compressed, size)
+            if data:
+                return data
+
+
+class Compressor(object):
+    """
+    Compress blocks of data, each block is compressed into a complete
+    stream of its own so it can be decompressed as soon as it is received.
+    decompress_members() decompresses the blocks written one after the
+    other.
+
+    Uses the deflate module on micropython ports built with compression
+    support and zlib on cpython.
+
+    Parameters
+    ----------
+    method : bytes, optional
+        The compression format, one of b'deflate', b'zlib' or b'gzip',
+        default=b'zlib'
+
+    Raises
+    ------
+    UnsupportedCompression
+        If the port can't compress
+    """
+    def __init__(self, method=b'zlib'):
+        self.method = method
+        self._wbits = _wbits(method)
+        self._deflate = None
+        self._zlib = None
+        try:
+            import deflate
+            self._deflate = deflate
+            try:
+                self.compress(b'')
+            except (AttributeError, OSError, NotImplementedError):
+                raise UnsupportedCompression('The deflate module was built without compression')
+            return
+        except ImportError:
+            pass
+        try:
+            import zlib
+        except ImportError:
+            raise UnsupportedCompression('No compression available')
+        if not hasattr(zlib, 'compressobj'):
+            raise UnsupportedCompression('No compression available')
+        self._zlib = zlib
+
+    def compress(self, data):
+        """
+        Compress a block of data
+
+        Parameters
+        ----------
+        data : bytes
+            The data to compress
+
+        Returns
+        -------
+        bytes
+            The block as a complete compressed stream
+        """
+        if self._deflate is not None:
+            try:
+                from uio import BytesIO
+            except ImportError:
+                from io import BytesIO
+            output = BytesIO()
+            compressor = self._deflate.DeflateIO(output, _deflate_format(self._deflate, self._wbits))
+            compressor.write(data)
+            compressor.close()
+            return output.getvalue()
+        compressor = self._zlib.compressobj(9, self._zlib.DEFLATED, self._wbits)
+        return compressor.compress(data) + compressor.flush()
+
+
+def decompress_members(data, method=b'zlib'):
+    """
+    Decompress data written by a Compressor, made up of compressed streams
+    one after the other
+
+    Parameters
+    ----------
+    data : bytes
+        The compressed data
+
+    method : bytes, optional
+        The compression format, default=b'zlib'
+
+    Returns
+    -------
+    bytes
+        The decompressed data
+
+    Raises
+    ------
+    DecompressError
+        If the data is corrupt
+    """
+    import zlib
+    wbits = _wbits(method)
+    parts = []
+    try:
+        while data:
+            decompressor = zlib.decompressobj(wbits)
+            parts.append(decompressor.decompress(data))
+            if not decompressor.eof:
+                raise DecompressError('Truncated compressed data')
+            data = decompressor.unused_data
+    except zlib.error as exc:
+        raise DecompressError('Corrupt compressed data: %s' % exc)
+    return b''.join(parts)
+
+
+def copy_to_file(stream, file_handle, method=b'zlib', buffer_size=256):
+    """
+    Decompress a stream into an open file
+
+    Parameters
+    ----------
+    stream : file
+        The stream to read compressed data from
+
+    file_handle : file
+        The file to write to, opened in binary mode
+
+    method : bytes, optional
+        The compression format, default=b'zlib'
+
+    buffer_size : int, optional
+        How much decompressed data to write at a time, default=256
+
+    Returns
+    -------
+    int
+        The number of bytes written
+    """
+    reader = DecompressReader(stream, method=method, chunk_size=buffer_size)
+    written = 0
+    while True:
+        data = reader.read(buffer_size)
+        if not data:
+            return written
+        file_handle.write(data)
+        written += len(data)
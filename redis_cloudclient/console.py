@@ -1,32 +1,160 @@
 """
 Console functionality
 """
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+from .clock import ticks_diff, ticks_ms
+from .pipeline import Pipeline
 
 
 class RedisStream(object):
     """
     File I/O object that streams data to/from redis keys (strings)
 
+    Output is collected in a preallocated buffer of buffer_size bytes, so
+    steady state writes don't allocate.  The buffer is sent when it is full,
+    when it has held data for flush_interval milliseconds or on flush().
+
+    Input is fetched into a local read-ahead buffer, each fetch pulls
+    everything available so polling with any(), read() and readinto() only
+    goes to the server when the buffer is empty, at most every
+    read_interval milliseconds.
+
+    If compression is set every write to the server is a complete
+    compressed stream, so the output can be decompressed as it arrives with
+    compression.decompress_members().  The compression method is stored in
+    the redis_key.stdout.encoding key.  Compression is disabled if the port
+    cannot compress.
+
+    bytes_written and peak_buffered count the output and the largest amount
+    of it held in the buffer, they are reset by the execution profile.
+
+    Only the thread that created the stream uses its redis connection.
+    Output written by other threads (such as the job workers) is held until
+    the next write, poll() or flush() from the owning thread, up to
+    foreign_limit bytes, anything past that is dropped.  Other threads read
+    no input and their flushes do nothing.
     """
     _read_position = 0
     _connection = None
     redis_heartbeat_key = None
+    bytes_written = 0
+    peak_buffered = 0
+    foreign_limit = 1024
 
-    def __init__(self, redis, redis_key, heartbeat_key=None, buffer_size=80, ttl=30):
+    def __init__(
+        self, redis, redis_key, heartbeat_key=None, buffer_size=256, ttl=30, compression=None, flush_interval=100,
+        read_interval=100
+    ):
+        if isinstance(redis_key, str):
+            redis_key = redis_key.encode()
         self._connection = redis
+        self._pipeline = Pipeline(redis)
         self.redis = redis
         self.redis_key = redis_key
         self.redis_heartbeat_key = heartbeat_key
-        self.redis_stdout_key = redis_key + '.stdout'
-        self.redis_stdin_key = redis_key + '.stdin'
+        self.redis_stdout_key = redis_key + b'.stdout'
+        self.redis_stdin_key = redis_key + b'.stdin'
         self._buffer_size = buffer_size
+        self._buffer = bytearray(buffer_size)
+        self._view = memoryview(self._buffer)
+        self._length = 0
+        self._buffer_start = 0
+        self.flush_interval = flush_interval
+        self.read_interval = read_interval
+        self._input = b''
+        self._input_offset = 0
+        self._last_fetch = 0
         self.ttl = ttl
+        self.compression = compression
+        self._compressor = None
+        self._owner = None
+        self._foreign = []
+        self._foreign_size = 0
+        if _thread is not None:
+            self._owner = _thread.get_ident()
+            self._lock = _thread.allocate_lock()
+        if compression:
+            from .compression import Compressor, UnsupportedCompression
+            try:
+                Compressor(compression)
+            except (ImportError, UnsupportedCompression):
+                self.compression = None
         self.clear()
 
+    def set_connection(self, redis):
+        """
+        Switch to a new redis connection, keeping any buffered data
+
+        Parameters
+        ----------
+        redis : uredis_modular.client.Client
+            The new connection
+        """
+        self._connection = redis
+        self.redis = redis
+        self._pipeline = Pipeline(redis)
+
+    def _fetch(self):
+        """
+        Read everything available in the input key past the data already
+        fetched into the local read-ahead buffer.
+
+        Returns
+        -------
+        int
+            The number of bytes fetched
+        """
+        if self._foreign_thread():
+            return 0
+        self._last_fetch = ticks_ms()
+        data = self._connection.execute_command('GETRANGE', self.redis_stdin_key, self._read_position, -1)
+        if not data:
+            return 0
+        self._read_position += len(data)
+        if self._input_offset >= len(self._input):
+            self._input = data
+        else:
+            self._input = self._input[self._input_offset:] + data
+        self._input_offset = 0
+        return len(data)
+
+    def _buffered(self):
+        return len(self._input) - self._input_offset
+
+    def _fetch_due(self):
+        return ticks_diff(ticks_ms(), self._last_fetch) >= self.read_interval
+
+    def _consume(self, size):
+        """
+        Remove up to size bytes from the read-ahead buffer
+
+        Returns
+        -------
+        bytes
+            The data removed from the buffer
+        """
+        end = self._input_offset + size
+        data = self._input[self._input_offset:end]
+        if end >= len(self._input):
+            self._input = b''
+            self._input_offset = 0
+        else:
+            self._input_offset = end
+        return data
+
     def read(self, size=None):
         """
         Read from the input key stored in the redis server
 
+        Data is returned from the local read-ahead buffer, the server is only
+        asked for more if the buffer doesn't hold enough and read_interval
+        milliseconds have passed since it was last asked.  Nothing is
+        returned if the buffer is empty in between.
+
         Parameters
         ----------
         size: int, optional
@@ -37,18 +165,20 @@ class RedisStream(object):
         bytes:
             Data read
         """
-        if size:
-            end = self._read_position + size
-        else:
-            end = -1
-        data = self._connection.execute_command('GETRANGE', self.redis_stdin_key, self._read_position, end)
-        self._read_position += len(data)
-        return data
+        if (not size or size < 0 or self._buffered() < size) and self._fetch_due():
+            self._fetch()
+        if not size or size < 0:
+            size = self._buffered()
+        return self._consume(size)
 
     def write(self, data):
         """
         Write data bytestring to a string in the output redis key
 
+        Data is collected in a fixed size buffer and sent to the server when
+        the buffer fills, when it has held data for longer than the
+        flush_interval or when flush() is called.
+
         Parameters
         ----------
         data : bytes
@@ -58,41 +188,148 @@ class RedisStream(object):
         -------
         The number of bytes written
         """
+        if isinstance(data, str):
+            data = data.encode()
+        if self._foreign_thread():
+            return self._hold(data)
+        if self._foreign:
+            self._adopt()
+        length = self._write(data)
+        self.poll()
+        return length
+
+    def claim(self):
+        """
+        Make the calling thread the one that uses the redis connection
+        """
+        if _thread is not None:
+            self._owner = _thread.get_ident()
+
+    def _foreign_thread(self):
+        """
+        Check if the caller is a thread that must not use the connection
+        """
+        return self._owner is not None and _thread.get_ident() != self._owner
+
+    def _hold(self, data):
+        """
+        Keep output written by another thread for the owning thread to send
+        """
+        length = len(data)
+        with self._lock:
+            if self._foreign_size + length <= self.foreign_limit:
+                # Copy it, the caller may reuse a buffer
+                self._foreign.append(bytes(data))
+                self._foreign_size += length
+        return length
+
+    def _adopt(self):
+        """
+        Add the output held for other threads to the buffer
+        """
+        with self._lock:
+            foreign = self._foreign
+            self._foreign = []
+            self._foreign_size = 0
+        for data in foreign:
+            self._write(data)
+
+    def _write(self, data):
+        """
+        Add data to the buffer, sending it if the buffer fills
+        """
+        length = len(data)
+        self.bytes_written += length
         if not self._buffer_size:
-            self._connection.execute_command('APPEND', self.redis_stdout_key, bytes(data))
-            return len(data)
-
-        if '\n' in data:
-            self.flush()
-
-        buffer_remaining = self._buffer_size - len(self._buffer)
-        if len(data) > buffer_remaining:
-            self.flush()
-        if len(data) > self._buffer_size:
-            self._connection.execute_command('APPEND', self.redis_stdout_key, bytes(data))
-            if self.redis_heartbeat_key:
-                self._connection.execute_command('SETEX', self.heartbeat_key, self.ttl, b'running')
-        else:
-            self._buffer += bytes(data)
+            if length > self.peak_buffered:
+                self.peak_buffered = length
+            self._append(data)
+            return length
 
-        return len(data)
+        if not self._length:
+            self._buffer_start = ticks_ms()
+        view = memoryview(data)
+        while view:
+            count = min(len(view), self._buffer_size - self._length)
+            self._view[self._length:self._length + count] = view[:count]
+            self._length += count
+            if self._length > self.peak_buffered:
+                self.peak_buffered = self._length
+            view = view[count:]
+            if self._length == self._buffer_size:
+                self.flush(heartbeat=True)
+                self._buffer_start = ticks_ms()
+        return length
 
-    def flush(self):
+    def poll(self):
+        """
+        Flush the buffer if it has held data for longer than the
+        flush_interval.
+        """
+        if self._foreign_thread():
+            return
+        if self._foreign:
+            self._adopt()
+        if self._length and ticks_diff(ticks_ms(), self._buffer_start) >= self.flush_interval:
+            self.flush(heartbeat=True)
+
+    def flush(self, heartbeat=False):
         """
         Write buffered data to the output key on the redis server and reset the buffer.
+
+        Parameters
+        ----------
+        heartbeat : bool, optional
+            Also refresh the heartbeat key with a running state
         """
-        if not self._buffer:
+        if self._foreign_thread():
             return
-        self._connection.execute_command('APPEND', self.redis_stdout_key, self._buffer)
-        self._buffer = bytes()
+        if self._foreign:
+            self._adopt()
+        if not self._length:
+            return
+        self._append(self._view[:self._length], heartbeat=heartbeat)
+        self._length = 0
+
+    def _append(self, data, heartbeat=False):
+        """
+        Append data to the output key, compressing it if enabled
+        """
+        if self._compressor:
+            data = self._compressor.compress(data)
+        pipeline = self._pipeline
+        self._queue_output(pipeline, data)
+        if heartbeat and self.redis_heartbeat_key:
+            pipeline.execute_command('SETEX', self.redis_heartbeat_key, self.ttl, b'running')
+        pipeline.execute()
+
+    def _queue_output(self, pipeline, data):
+        """
+        Queue the command that writes a chunk of output to the server
+        """
+        pipeline.execute_command('APPEND', self.redis_stdout_key, data)
 
     def clear(self):
         """
         Clear all data from the redis output key on the redis server
         """
-        self._buffer = bytes()
-        self._connection.execute_command('DEL', self.redis_stdout_key)
-        self._connection.execute_command('DEL', self.redis_stdin_key)
+        self._length = 0
+        self._read_position = 0
+        self._input = b''
+        self._input_offset = 0
+        if self.compression:
+            from .compression import Compressor
+            self._compressor = Compressor(self.compression)
+        self._queue_clear(self._pipeline)
+        self._pipeline.execute()
+
+    def _queue_clear(self, pipeline):
+        """
+        Queue the commands that reset the keys on the server
+        """
+        pipeline.execute_command('DEL', self.redis_stdout_key, self.redis_stdin_key)
+        if self.compression:
+            pipeline.execute_command('SET', self.redis_stdout_key + b'.encoding', self.compression)
 
     def init(self):
         pass
@@ -101,8 +338,16 @@ class RedisStream(object):
         pass
 
     def any(self):
-        strlen = int(self._connection.execute_command('STRLEN', self.redis_stdin_key))
-        return strlen - self._read_position
+        """
+        Get the number of bytes available to read
+
+        This is answered from the read-ahead buffer, the server is only
+        checked if the buffer is empty and read_interval milliseconds have
+        passed since the last check.
+        """
+        if not self._buffered() and self._fetch_due():
+            self._fetch()
+        return self._buffered()
 
     def sendbreak(self):
         pass
@@ -110,11 +355,86 @@ class RedisStream(object):
     def readall(self):
         return self.read()
 
-    def readinto(buf, nbytes=0):
-        pass
+    def readinto(self, buf, nbytes=None):
+        """
+        Read data into a buffer
+
+        Parameters
+        ----------
+        buf : bytearray
+            The buffer to read into
+
+        nbytes : int, optional
+            The maximum number of bytes to read, default is len(buf)
+
+        Returns
+        -------
+        int
+            The number of bytes read
+        """
+        if not nbytes:
+            nbytes = len(buf)
+        data = self.read(nbytes)
+        buf[:len(data)] = data
+        return len(data)
 
     def readline(self):
-        pass
+        """
+        Read a line of input
+
+        Returns
+        -------
+        bytes
+            The line including the newline, or whatever input is available
+            if there is no complete line
+        """
+        end = self._input.find(b'\n', self._input_offset)
+        if end < 0:
+            self._fetch()
+            end = self._input.find(b'\n', self._input_offset)
+        if end < 0:
+            return self._consume(self._buffered())
+        return self._consume(end + 1 - self._input_offset)
+
+
+class RedisStreamLog(RedisStream):
+    """
+    RedisStream that writes output as entries in a redis stream instead of
+    appending to a string.
+
+    Each chunk of output is added with XADD as an entry with a 'data'
+    field, so readers can tail the output incrementally by entry id with
+    XREAD BLOCK.  The stream is trimmed to roughly maxlen entries to cap
+    the memory used on the server.  Instead of deleting the output, clear()
+    adds an entry with an 'event' field of b'clear' (and the 'encoding' if
+    the output is compressed) to mark the start of new output.
+
+    Parameters
+    ----------
+    maxlen : int, optional
+        The approximate number of entries to keep, default=1000
+
+    The other parameters are the same as RedisStream.
+    """
+    _started = False
+
+    def __init__(self, redis, redis_key, maxlen=1000, **kwargs):
+        self.maxlen = maxlen
+        super().__init__(redis, redis_key, **kwargs)
+
+    def _queue_output(self, pipeline, data):
+        pipeline.execute_command('XADD', self.redis_stdout_key, 'MAXLEN', '~', self.maxlen, '*', 'data', data)
+
+    def _queue_clear(self, pipeline):
+        if not self._started:
+            # Remove any output left by a previous session or backend
+            pipeline.execute_command('DEL', self.redis_stdout_key)
+            self._started = True
+        pipeline.execute_command('DEL', self.redis_stdin_key)
+        command = ['XADD', self.redis_stdout_key, 'MAXLEN', '~', self.maxlen, '*', 'event', b'clear']
+        if self.compression:
+            command += ['encoding', self.compression]
+        pipeline.execute_command(*command)
 
 
 class NullIO(object):
@@ -135,4 +455,3 @@ class NullIO(object):
 
     def readall(self):
         return b''
-
@@ -0,0 +1,397 @@
+"""
+Block level delta functionality
+
+The device sends the signature of an existing file, a list of checksums of
+each fixed size block in the file.  The server uses the signature to build a
+delta that references the blocks the device already has and only includes
+the data that changed.  The device then rebuilds the file from its existing
+copy and the delta.
+
+Signature format, one record per block:
+
+    weak checksum (4 bytes) strong checksum (8 bytes)
+
+Delta format:
+
+    b'RCD1' block size (4 bytes) file size (4 bytes)
+    b'C' first block index (4 bytes) block count (4 bytes)
+    b'D' length (4 bytes) data
+
+All integers are unsigned big endian.
+
+The signature and delta operations are handled by handle_signature() and
+handle_delta(), which the eventloop imports when they are first used.
+"""
+import os
+
+try:
+    import ustruct as struct
+except ImportError:
+    import struct
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+
+
+DELTA_MAGIC = b'RCD1'
+SIGNATURE_RECORD_SIZE = 12
+
+
+class DeltaError(Exception):
+    pass
+
+
+def weak_checksum(data):
+    """
+    Calculate the rolling checksum of a block of data
+
+    Parameters
+    ----------
+    data : bytes
+        The data block
+
+    Returns
+    -------
+    int
+        The 32 bit rolling checksum
+    """
+    a = 0
+    b = 0
+    length = len(data)
+    for index in range(length):
+        a += data[index]
+        b += (length - index) * data[index]
+    return (a & 0xffff) | ((b & 0xffff) << 16)
+
+
+def strong_checksum(data):
+    """
+    Calculate the strong checksum of a block of data
+
+    Parameters
+    ----------
+    data : bytes
+        The data block
+
+    Returns
+    -------
+    bytes
+        The first 8 bytes of the sha256 digest of the data
+    """
+    return hashlib.sha256(data).digest()[:8]
+
+
+def file_signature(file_handle, block_size=512):
+    """
+    Calculate the signature of a file
+
+    Parameters
+    ----------
+    file_handle : file
+        The file to generate the signature of, opened in binary mode
+
+    block_size : int, optional
+        The block size in bytes, default=512
+
+    Returns
+    -------
+    bytes
+        The file signature
+    """
+    signature = bytearray()
+    while True:
+        block = file_handle.read(block_size)
+        if not block:
+            break
+        signature += struct.pack('>I', weak_checksum(block))
+        signature += strong_checksum(block)
+        if len(block) < block_size:
+            break
+    return bytes(signature)
+
+
+def parse_signature(signature):
+    """
+    Convert a signature into a lookup table
+
+    Parameters
+    ----------
+    signature : bytes
+        The file signature
+
+    Returns
+    -------
+    dict
+        Dictionary mapping the weak checksum to a list of
+        (strong checksum, block index) tuples
+    """
+    table = {}
+    for index in range(len(signature) // SIGNATURE_RECORD_SIZE):
+        offset = index * SIGNATURE_RECORD_SIZE
+        weak = struct.unpack('>I', signature[offset:offset + 4])[0]
+        strong = bytes(signature[offset + 4:offset + SIGNATURE_RECORD_SIZE])
+        table.setdefault(weak, []).append((strong, index))
+    return table
+
+
+def make_delta(signature, data, block_size=512):
+    """
+    Generate a delta that rebuilds data from a file with the signature
+
+    This is intended to run on the server side.
+
+    Parameters
+    ----------
+    signature : bytes
+        The signature of the file on the device
+
+    data : bytes
+        The new file contents
+
+    block_size : int, optional
+        The block size the signature was generated with, default=512
+
+    Returns
+    -------
+    bytes
+        The delta
+    """
+    table = parse_signature(signature)
+    delta = bytearray(DELTA_MAGIC + struct.pack('>II', block_size, len(data)))
+    copy_start = copy_count = 0
+    literal_start = position = 0
+    length = len(data)
+
+    def emit_literal(end):
+        if end > literal_start:
+            delta.extend(b'D' + struct.pack('>I', end - literal_start))
+            delta.extend(data[literal_start:end])
+
+    def emit_copy():
+        if copy_count:
+            delta.extend(b'C' + struct.pack('>II', copy_start, copy_count))
+
+    weak = None
+    a = b = 0
+    while position + block_size <= length:
+        if weak is None:
+            weak = weak_checksum(data[position:position + block_size])
+            a = weak & 0xffff
+            b = weak >> 16
+        match = None
+        for strong, index in table.get(weak, ()):
+            if strong == strong_checksum(data[position:position + block_size]):
+                match = index
+                break
+        if match is not None:
+            if literal_start < position:
+                emit_copy()
+                copy_count = 0
+                emit_literal(position)
+            if copy_count and match == copy_start + copy_count:
+                copy_count += 1
+            else:
+                emit_copy()
+                copy_start = match
+                copy_count = 1
+            position += block_size
+            literal_start = position
+            weak = None
+            continue
+        # Roll the checksum forward one byte
+        if position + block_size < length:
+            old = data[position]
+            new = data[position + block_size]
+            a = (a - old + new) & 0xffff
+            b = (b - block_size * old + a) & 0xffff
+            weak = a | (b << 16)
+        position += 1
+
+    # A short final block can still match the short last block of the file
+    if literal_start < length and length - literal_start < block_size:
+        tail = data[literal_start:]
+        for strong, index in table.get(weak_checksum(tail), ()):
+            if strong == strong_checksum(tail):
+                if not (copy_count and index == copy_start + copy_count):
+                    emit_copy()
+                    copy_start = index
+                    copy_count = 0
+                copy_count += 1
+                literal_start = length
+                break
+    if literal_start < length:
+        emit_copy()
+        copy_count = 0
+        emit_literal(length)
+    emit_copy()
+    return bytes(delta)
+
+
+def _read_exactly(stream, size):
+    data = stream.read(size)
+    if len(data) != size:
+        raise DeltaError('Truncated delta')
+    return data
+
+
+def apply_delta(delta, old_handle, new_handle, buffer_size=512):
+    """
+    Rebuild a file from the existing file and a delta
+
+    Parameters
+    ----------
+    delta : file
+        File like object to read the delta from
+
+    old_handle : file
+        The existing file, opened for reading in binary mode, may be None if
+        the delta has no block references
+
+    new_handle : file
+        The file to write the new contents to, opened in binary mode
+
+    buffer_size : int, optional
+        The largest amount of literal data to hold in memory at once,
+        default=512
+
+    Returns
+    -------
+    int
+        The number of bytes written
+    """
+    header = _read_exactly(delta, 12)
+    if header[:4] != DELTA_MAGIC:
+        raise DeltaError('Not a delta')
+    block_size, file_size = struct.unpack('>II', header[4:])
+    written = 0
+    while True:
+        operation = delta.read(1)
+        if not operation:
+            break
+        if operation == b'C':
+            start, count = struct.unpack('>II', _read_exactly(delta, 8))
+            if old_handle is None:
+                raise DeltaError('Delta references a missing file')
+            old_handle.seek(start * block_size)
+            for index in range(count):
+                block = old_handle.read(block_size)
+                if not block:
+                    raise DeltaError('Delta references a missing block')
+                new_handle.write(block)
+                written += len(block)
+        elif operation == b'D':
+            remaining = struct.unpack('>I', _read_exactly(delta, 4))[0]
+            while remaining:
+                data = _read_exactly(delta, min(remaining, buffer_size))
+                new_handle.write(data)
+                written += len(data)
+                remaining -= len(data)
+        else:
+            raise DeltaError('Invalid delta operation %r' % operation)
+    if written != file_size:
+        raise DeltaError('Delta produced %d bytes, expected %d' % (written, file_size))
+    return written
+
+
+def handle_signature(eventloop, transaction_key):
+    """
+    Eventloop handler that stores the block signature of a file in the
+    transaction hash so the server can generate a delta for it.
+
+    The transaction hash has the file to sign in the 'dest' field and
+    an optional 'block_size' field.  The signature is written to the
+    'signature' field, it is empty if the file does not exist.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the operation
+
+    transaction_key : bytes
+        The transaction hash key
+    """
+    pipeline = eventloop.pipeline()
+    eventloop.heartbeat(state=b'signing', ttl=60, pipeline=pipeline)
+    pipeline.execute_command('HGET', transaction_key, 'dest')
+    pipeline.execute_command('HGET', transaction_key, 'block_size')
+    filename, block_size = pipeline.execute()[-2:]
+    block_size = int(block_size or 512)
+    signature = b''
+    try:
+        with open(filename, 'rb') as file_handle:
+            signature = file_signature(file_handle, block_size=block_size)
+    except (OSError, TypeError):
+        pass
+    pipeline.execute_command('HSET', transaction_key, 'signature', signature)
+    eventloop.signal_completion(0, pipeline=pipeline)
+    eventloop.heartbeat(state=b'idle', pipeline=pipeline)
+    pipeline.execute()
+
+
+def handle_delta(eventloop, transaction_key):
+    """
+    Eventloop handler that rebuilds a file from its existing contents and a
+    delta generated from its signature.
+
+    The transaction hash has the delta key in the 'source' field and
+    the file to update in the 'dest' field.  The new file is written
+    to a temporary file which replaces the existing one when it is
+    complete.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the operation
+
+    transaction_key : bytes
+        The transaction hash key
+    """
+    from .transfer import ValueReader
+
+    pipeline = eventloop.pipeline()
+    eventloop.heartbeat(state=b'copying', ttl=60, pipeline=pipeline)
+    pipeline.execute_command('HGET', transaction_key, 'source')
+    pipeline.execute_command('HGET', transaction_key, 'dest')
+    delta_key, filename = pipeline.execute()[-2:]
+    rc = 1
+    if filename:
+        filename = filename.decode()
+        temp_filename = filename + '.delta'
+        print('Updating file: %s' % filename)
+        try:
+            old_handle = open(filename, 'rb')
+        except OSError:
+            old_handle = None
+        source = ValueReader(eventloop.redis_connection, delta_key)
+        try:
+            with open(temp_filename, 'wb') as new_handle:
+                apply_delta(source, old_handle, new_handle)
+            rc = 0
+        except DeltaError as exc:
+            print('Delta update of %s failed: %s' % (filename, exc))
+        except OSError as exc:
+            if source.error is not None:
+                # The connection failed, leave it to run() to reconnect
+                raise
+            print('Delta update of %s failed: %s' % (filename, exc))
+        finally:
+            # Read the replies still in flight so the connection stays in sync
+            source.drain()
+            if old_handle:
+                old_handle.close()
+        if rc == 0:
+            try:
+                os.remove(filename)
+            except OSError:
+                pass
+            os.rename(temp_filename, filename)
+        else:
+            try:
+                os.remove(temp_filename)
+            except OSError:
+                pass
+    pipeline.execute_command('DEL', transaction_key)
+    eventloop.signal_completion(rc, pipeline=pipeline)
+    eventloop.heartbeat(state=b'idle', pipeline=pipeline)
+    pipeline.execute()
@@ -5,26 +5,139 @@ import os
 import sys
 import time
 
-from uredis_modular.client import Client
+from uredis_modular.client import Client, InvalidResponse
 from .exceptions import RedisNotRunning
+from .groups import COMPLETE_TTL, complete_key, stream_key
+from .pipeline import EncodedCommands, Pipeline, to_bytes
+from .clock import ServerClock, ticks_diff, ticks_ms
+from .codecache import CodeCache, code_digest
+from .liveness import index_keys, parse_tags
+from .registry import LazyHandler, is_lazy_spec, parse_handler_setting
+from .scheduler import Scheduler
 
 
 class EventLoop(object):
     """
     Main eventloop object to handle various events on the device
+
+    Parameters
+    ----------
+    name : bytes, optional
+        The board name, read from the configuration if not specified
+
+    redis_server : str, optional
+        The redis server, read from the configuration if not specified
+
+    redis_port : int, optional
+        The redis server port, default=18266
+
+    reset_after : bool, optional
+        Reset the board after running each command
+
+    redis_connection : uredis_modular.client.Client, optional
+        An existing redis connection to use instead of connecting to the
+        redis server
+
+    config : dict, optional
+        Configuration settings to use instead of the bootconfig settings.
+        Changes to an explicit config are kept in memory only.  Without it
+        the bootconfig settings are read once when the eventloop is created
+        and written back only when a setting changes.
+
+    Attributes
+    ----------
+    handlers : dict
+        Operation name to handler.  The handler is either the name of an
+        EventLoop method or a module:function string for handlers that are
+        imported when their queue is first used, see registry.LazyHandler.
+        The optional operations are lazy so their modules only use memory
+        on boards that use them.  Further lazy handlers can be declared
+        with the cloudmanager_handlers setting as comma separated
+        operation=module:function entries.
+
+    clock : clock.ServerClock
+        The redis server time, used to score the liveness index entries
+        that are refreshed with every heartbeat.  The index can be disabled
+        with the cloudmanager_liveness_index setting and extra tag indexes
+        are declared with the cloudmanager_tags setting, see liveness.
+
+    groups : list
+        The groups the board is a member of, from the comma separated
+        cloudmanager_groups setting.  The group streams are read with every
+        BLPOP, which then waits at most cloudmanager_group_poll seconds
+        (default 1), see groups.
+
+    jobs : jobs.JobRunner
+        Runs the operations from the repl:<name>.job queue on up to
+        cloudmanager_workers threads, None if there are no workers and the
+        jobs run in the eventloop.  While every worker is busy the job
+        queue isn't read, so the other operations are still handled.
     """
     handlers = {
+        b'bundle': b'redis_cloudclient.bundle:handle_bundle',
         b'command': b'exec_command',
         b'copy': b'copy_file',
+        b'delta': b'redis_cloudclient.delta:handle_delta',
+        b'exec_hash': b'redis_cloudclient.codecache:handle_exec_hash',
+        b'job': b'redis_cloudclient.jobs:handle_job',
         b'rename': b'rename_board',
         b'reset': b'reset_board',
+        b'signature': b'redis_cloudclient.delta:handle_signature',
+        b'upload': b'redis_cloudclient.transfer:handle_upload',
     }
-    def __init__(self, name=None, redis_server=None, redis_port=18266, reset_after=None):
+    # Seconds the execution profile hashes are kept
+    profile_ttl = 3600
+    # Seconds between reads of the redis server time
+    clock_interval = 3600
+    # Seconds the job output and completion keys are kept
+    job_ttl = 3600
+
+    def __init__(
+        self, name=None, redis_server=None, redis_port=18266, reset_after=None, redis_connection=None, config=None
+    ):
         self.name = name
+        self.redis_connection = redis_connection
+        self._save_config = config is None
+        if config is None:
+            from bootconfig.config import load
+            config = load()
+        self.config = config
         self.redis_server = redis_server
         self.redis_port = redis_port
         self.reset_after = reset_after
         self.debug_exec = None
+        self.console_compression = None
+        self.console_backend = None
+        self.console_maxlen = 1000
+        self.scheduler = Scheduler()
+        self.stats = None
+        self.stats_interval = None
+        self.telemetry = None
+        self.drain_limit = None
+        self.code_cache_size = None
+        self.handler_idle_unload = None
+        self.profile = None
+        self.telemetry_interval = None
+        self.liveness_index = None
+        self.tags = None
+        self.groups = None
+        self.group_poll = None
+        self._group_ids = []
+        self._group_completion = None
+        self.workers = None
+        self.jobs = None
+        self._paused_keys = ()
+        self.clock = ServerClock()
+        self._encoded_liveness = None
+        self._batch = None
+        self._batch_started = False
+        # A rename waiting for the batch of drained operations to finish
+        self._pending_rename = None
+        self._busy = False
+        # Reused by handle_queues() for the replies of every pass
+        self._responses = []
+        self._heartbeat_state = b'idle'
+        self._heartbeat_ttl = 5
 
         self._get_redis_host_and_port()
         self._determine_keys()
@@ -38,58 +151,228 @@ class EventLoop(object):
         """
         Clear the redis keys for this eventloop
         """
-        for key in [self.command_key, self.complete_key, self.console_key]:
-            self.redis_connection.execute_command('DEL', key)
+        self.redis_connection.execute_command('DEL', self.command_key, self.complete_key, self.console_key)
+
+    def get_setting(self, key):
+        """
+        Get a configuration setting
+
+        Parameters
+        ----------
+        key : str
+            The setting name
+
+        Returns
+        -------
+        str
+            The setting value or an empty string if it is not set
+        """
+        return self.config.get(key, '')
+
+    def set_setting(self, key, value):
+        """
+        Change a configuration setting
+
+        Parameters
+        ----------
+        key : str
+            The setting name
+
+        value : str
+            The new value
+        """
+        self.set_settings({key: value})
+
+    def set_settings(self, values):
+        """
+        Change several configuration settings with a single write
+
+        Parameters
+        ----------
+        values : dict
+            The setting names and their new values
+        """
+        changed = False
+        for key, value in values.items():
+            if self.config.get(key) != value:
+                self.config[key] = value
+                changed = True
+        if changed and self._save_config:
+            from bootconfig.config import save
+            save(self.config)
 
     def _parse_settings(self):
         if self.reset_after is None:
-            from bootconfig.config import get
-            self.reset_after = self.is_true(get('cloudmanager_reset_after'))
+            self.reset_after = self.is_true(self.get_setting('cloudmanager_reset_after'))
         if self.debug_exec is None:
-            from bootconfig.config import get
-            self.debug_exec = self.is_true(get('cloudmanager_debug_exec'))
+            self.debug_exec = self.is_true(self.get_setting('cloudmanager_debug_exec'))
+        if self.console_compression is None:
+            self.console_compression = self.get_setting('cloudmanager_console_compression') or None
+        if self.console_backend is None:
+            self.console_backend = self.get_setting('cloudmanager_console_backend') or 'string'
+            self.console_maxlen = int(self.get_setting('cloudmanager_console_maxlen') or 1000)
+        if self.drain_limit is None:
+            self.drain_limit = int(self.get_setting('cloudmanager_drain_limit') or 16)
+        if self.code_cache_size is None:
+            self.code_cache_size = int(self.get_setting('cloudmanager_code_cache') or 8)
+        self.code_cache = CodeCache(self.code_cache_size)
+        if self.stats_interval is None:
+            self.stats_interval = int(self.get_setting('cloudmanager_stats_interval') or 0)
+        if self.telemetry_interval is None:
+            self.telemetry_interval = int(self.get_setting('cloudmanager_telemetry_interval') or 10)
+            self.telemetry_size = int(self.get_setting('cloudmanager_telemetry_size') or 64)
+            self.telemetry_backend = self.get_setting('cloudmanager_telemetry_backend') or 'stream'
+        if self.profile is None:
+            self.profile = self.is_true(self.get_setting('cloudmanager_profile'))
+        if self.handler_idle_unload is None:
+            self.handler_idle_unload = int(self.get_setting('cloudmanager_handler_idle_unload') or 0)
+        if self.liveness_index is None:
+            self.liveness_index = self.is_true(self.get_setting('cloudmanager_liveness_index') or 'true')
+        if self.tags is None:
+            self.tags = parse_tags(self.get_setting('cloudmanager_tags'))
+        if self.groups is None:
+            self.groups = parse_tags(self.get_setting('cloudmanager_groups'))
+        if self.group_poll is None:
+            self.group_poll = int(self.get_setting('cloudmanager_group_poll') or 1)
+        self._group_keys = [stream_key(group) for group in self.groups]
+        if self.workers is None:
+            self.workers = int(self.get_setting('cloudmanager_workers') or 0)
+        if self.workers and self.jobs is None:
+            from .jobs import JobRunner
+            try:
+                self.jobs = JobRunner(self._open_connection, self.workers, self.job_ttl)
+            except ImportError:
+                print('Threads are not supported, jobs run in the eventloop')
+        self._index_keys = index_keys(sys.platform, self.tags, self.groups) if self.liveness_index else []
 
     def _determine_keys(self):
         """
         Calculate the redis key names to use for different operations.
         """
         if not self.name:
-            from bootconfig.config import get
-            self.name = get('name').encode()
+            self.name = self.get_setting('name').encode()
             if not self.name:
-                self.name = 'unregistered'
+                self.name = b'unregistered'
         self.base_key = b'repl:' + self.name
+        self._handler_prefix = self.base_key + b'.'
+        self._encoded_heartbeats = {}
+        self._encoded_liveness = None
+        self._liveness_member = self.name
         self.command_key = self.base_key + b'.command'
         self.console_key = self.base_key + b'.console'
         self.complete_key = self.base_key + b'.complete'
         self.heartbeat_key = b'board:' + self.name
+        self.stats_key = b'stats:' + self.name
+        self.telemetry_key = self.base_key + b'.telemetry'
         self.boardinfo_key = b'boardinfo:' + self.name
 
 
-    def _remove_keys(self):
-        self.redis_connection.execute_command('DEL', self.base_key)
-        self.redis_connection.execute_command('DEL', self.command_key)
-        self.redis_connection.execute_command('DEL', self.console_key)
-        self.redis_connection.execute_command('DEL', self.complete_key)
-        self.redis_connection.execute_command('DEL', self.heartbeat_key)
-        self.redis_connection.execute_command('DEL', self.boardinfo_key)
+    def _remove_keys(self, keep_completions=False):
+        pipeline = self.pipeline()
+        pipeline.execute_command(
+            'DEL', self.base_key, self.command_key, self.console_key, self.heartbeat_key, self.boardinfo_key
+        )
+        if keep_completions:
+            # Whoever waits for the completions can still read them
+            pipeline.execute_command('EXPIRE', self.complete_key, self.job_ttl)
+        else:
+            pipeline.execute_command('DEL', self.complete_key)
+        for key in self._index_keys:
+            pipeline.execute_command('ZREM', key, self._liveness_member)
+        pipeline.execute()
 
     def _find_handlers(self):
         """
         Iterate the handlers dictionary and replace string handler names with
-        the method
+        the method, or a LazyHandler for module:function names
         """
-        for key, value in self.handlers.items():
-            if isinstance(self.handlers[key], bytes):
+        declared = dict(self.handlers)
+        declared.update(parse_handler_setting(self.get_setting('cloudmanager_handlers')))
+        handlers = {}
+        for key, value in declared.items():
+            if is_lazy_spec(value):
+                value = LazyHandler(self, value)
+                key = self.base_key + b'.' + key
+            elif isinstance(value, bytes):
                 try:
-                    operation = getattr(self, self.handlers[key].decode())
+                    value = getattr(self, value.decode())
                 except AttributeError:
                     # No method with the specified name
-                    print('No method %r found' % self.handlers[key])
+                    print('No method %r found' % value)
                     continue
-                del self.handlers[key]
-                new_key = self.base_key + b'.' + key
-                self.handlers[new_key] = operation
+                key = self.base_key + b'.' + key
+            handlers[key] = value
+        # Build a new dictionary so the class level handlers are not changed
+        self.handlers = handlers
+        self._handlers_changed()
+
+    def register_handler(self, operation, handler):
+        """
+        Add or replace the handler of an operation
+
+        Parameters
+        ----------
+        operation : bytes
+            The operation name, the handler listens on repl:<name>.<operation>
+
+        handler : callable or str
+            A function called with the queue value, or a module:function
+            string for a handler that is imported when it is first used
+        """
+        if isinstance(operation, str):
+            operation = operation.encode()
+        if is_lazy_spec(handler):
+            handler = LazyHandler(self, handler)
+        key = self.base_key + b'.' + operation
+        self.unregister_handler(operation)
+        self.handlers[key] = handler
+        self._handlers_changed()
+
+    def unregister_handler(self, operation):
+        """
+        Stop handling an operation, unloading its module if it was lazily
+        loaded
+
+        Parameters
+        ----------
+        operation : bytes
+            The operation name
+        """
+        if isinstance(operation, str):
+            operation = operation.encode()
+        handler = self.handlers.pop(self.base_key + b'.' + operation, None)
+        if isinstance(handler, LazyHandler):
+            handler.unload()
+        self._handlers_changed()
+
+    def unload_handlers(self, idle=None):
+        """
+        Unload the modules of lazily loaded handlers, they are imported again
+        when their queue is next used.
+
+        Parameters
+        ----------
+        idle : int, optional
+            Only unload handlers that haven't been called for this many
+            milliseconds, by default all of them are unloaded
+
+        Returns
+        -------
+        int
+            The number of handlers unloaded
+        """
+        unloaded = 0
+        for handler in self.handlers.values():
+            if not isinstance(handler, LazyHandler) or not handler.loaded:
+                continue
+            if idle is not None and (handler.idle() or 0) < idle:
+                continue
+            handler.unload()
+            unloaded += 1
+        return unloaded
+
+    def _unload_idle_handlers(self, pipeline=None):
+        self.unload_handlers(idle=self.handler_idle_unload * 1000)
 
     def _get_redis_host_and_port(self):
         """
@@ -97,9 +380,8 @@ class EventLoop(object):
         bootconfig configuration if they aren't set.
         """
         if not self.redis_server:
-            from bootconfig.config import get
-            self.redis_server = get('redis_server')
-            redis_port = get('redis_port')
+            self.redis_server = self.get_setting('redis_server')
+            redis_port = self.get_setting('redis_port')
             if redis_port:
                 self.redis_port = int(redis_port)
 
@@ -107,10 +389,17 @@ class EventLoop(object):
         """
         Initialize the console redirection for the event loop
         """
-        from .console import RedisStream
-        self.console = RedisStream(
-            redis=self.redis_connection, redis_key=self.console_key, heartbeat_key=self.heartbeat_key
-        )
+        from .console import RedisStream, RedisStreamLog
+        if self.console_backend == 'stream':
+            self.console = RedisStreamLog(
+                redis=self.redis_connection, redis_key=self.console_key, heartbeat_key=self.heartbeat_key,
+                compression=self.console_compression, maxlen=self.console_maxlen
+            )
+        else:
+            self.console = RedisStream(
+                redis=self.redis_connection, redis_key=self.console_key, heartbeat_key=self.heartbeat_key,
+                compression=self.console_compression
+            )
         if sys.platform not in [
             'WiPy',
             'linux'
@@ -129,16 +418,125 @@ class EventLoop(object):
         name = sys.platform.lower() + '-' + str(self.redis_connection.execute_command('INCR', registry_key))
         return name.encode()
 
-    def clear_completion_queue(self):
-        self.redis_connection.execute_command('DEL', self.complete_key)
+    def enable_stats(self, interval=60):
+        """
+        Record the count, bytes and latency of every redis command and
+        handler and publish them to the stats:<name> hash.
+
+        This is enabled at connect if the cloudmanager_stats_interval
+        setting is set.
+
+        Parameters
+        ----------
+        interval : int, optional
+            Seconds between publishing the stats, default=60
+        """
+        from .stats import InstrumentedClient, Stats
+        if self.stats is None:
+            self.stats = Stats()
+            self.redis_connection = InstrumentedClient(self.redis_connection, self.stats)
+        self.scheduler.add('stats', interval * 1000, self.publish_stats)
+
+    def publish_stats(self, pipeline=None):
+        """
+        Write the recorded stats to the stats:<name> hash
+        """
+        if self.stats is None:
+            return
+        if pipeline is None:
+            self.stats.publish(self.redis_connection, self.stats_key)
+        else:
+            self.stats.publish(pipeline, self.stats_key)
+
+    def record(self, name, value):
+        """
+        Record a telemetry sample
+
+        Samples are kept in a ring buffer of cloudmanager_telemetry_size
+        samples and sent to the repl:<name>.telemetry stream (or list if
+        cloudmanager_telemetry_backend is 'list') in one batch every
+        cloudmanager_telemetry_interval seconds, along with the eventloop's
+        other commands.  Recording doesn't use the network.
+
+        Parameters
+        ----------
+        name : str
+            The sample name, for example 'temperature'
+
+        value : int, float, str or bytes
+            The sample value
+        """
+        if self.telemetry is None:
+            from .telemetry import Telemetry
+            self.telemetry = Telemetry(
+                self.telemetry_key, size=self.telemetry_size, backend=self.telemetry_backend,
+                maxlen=self.console_maxlen
+            )
+        if 'telemetry' not in self.scheduler.tasks:
+            self.scheduler.add('telemetry', self.telemetry_interval * 1000, self.flush_telemetry)
+        self.telemetry.record(name, value)
+
+    def flush_telemetry(self, pipeline=None):
+        """
+        Send the recorded telemetry samples
+
+        The scheduled flush stops once there is nothing left to send, it is
+        started again by the next record().
+
+        Parameters
+        ----------
+        pipeline : Pipeline, optional
+            Queue the commands on this pipeline instead of sending them
+        """
+        if self.telemetry is None:
+            return
+        pipe = self.pipeline() if pipeline is None else pipeline
+        if not self.telemetry.flush(pipe):
+            self.scheduler.remove('telemetry')
+        if pipeline is None:
+            pipe.execute()
+
+    def pipeline(self):
+        """
+        Get a new command pipeline on the redis connection
 
-    def signal_completion(self, rc):
+        Returns
+        -------
+        Pipeline
+            A pipeline that sends all queued commands in one round trip
+        """
+        return Pipeline(self.redis_connection)
+
+    def clear_completion_queue(self, pipeline=None):
+        if pipeline is None:
+            pipeline = self.redis_connection
+        pipeline.execute_command('DEL', self.complete_key)
+
+    def signal_completion(self, rc, pipeline=None):
         """
         Put the return code in the completion queue
+
+        Parameters
+        ----------
+        rc : int
+            The return code
+
+        pipeline : Pipeline, optional
+            Queue the command on this pipeline instead of sending it.  While
+            a batch of drained operations runs the completion is always
+            queued on the batch.
         """
-        self.redis_connection.execute_command('RPUSH', self.complete_key, rc)
+        if self._batch is not None:
+            pipeline = self._batch
+        elif pipeline is None:
+            pipeline = self.redis_connection
+        if self._group_completion is not None:
+            pipeline.execute_command('RPUSH', self._group_completion, self.name + b' ' + to_bytes(rc))
+            pipeline.execute_command('EXPIRE', self._group_completion, COMPLETE_TTL)
+            return
+        pipeline.execute_command('RPUSH', self.complete_key, rc)
 
-    def heartbeat(self, state=b'idle', ttl=5):
+    def heartbeat(self, state=b'idle', ttl=5, pipeline=None):
         """
         Update the board heartbeat key (and it's time to live)
 
@@ -151,9 +549,117 @@ class EventLoop(object):
             The time to live in seconds for the key.  After
             the ttl expires the key is removed from the redis
             server.  Default: 30 seconds
+
+        pipeline : Pipeline, optional
+            Queue the commands on this pipeline instead of sending them,
+            the caller is responsible for executing the pipeline.
+        """
+        pipe = self.pipeline() if pipeline is None else pipeline
+        pipe.execute_command(self._heartbeat_commands(state, ttl))
+        self._queue_liveness(pipe)
+        if pipeline is None:
+            pipe.execute()
+        self._heartbeat_state = state
+        self._heartbeat_ttl = ttl
+        # Refresh the keys shortly before they expire
+        interval = ttl * 1000 - max(1000, ttl * 200)
+        self.scheduler.add('heartbeat', interval, self._refresh_heartbeat)
+
+    def _heartbeat_commands(self, state, ttl):
+        """
+        Get the encoded heartbeat commands for a state, they are encoded
+        once per state and reused
+        """
+        cached = self._encoded_heartbeats.get(state)
+        if cached is None or cached[0] != ttl:
+            cached = (ttl, EncodedCommands(
+                ('SETEX', self.heartbeat_key, ttl, state),
+                ('SETEX', self.boardinfo_key, ttl, sys.platform),
+            ))
+            self._encoded_heartbeats[state] = cached
+        return cached[1]
+
+    def _refresh_heartbeat(self, pipeline=None):
         """
-        self.redis_connection.execute_command('SETEX', self.heartbeat_key, ttl, state)
-        self.redis_connection.execute_command('SETEX', self.boardinfo_key, ttl, sys.platform)
+        Scheduled task that resends the current heartbeat state
+        """
+        if pipeline is None:
+            self.heartbeat(state=self._heartbeat_state, ttl=self._heartbeat_ttl)
+            return
+        # The scheduler has already moved the next refresh, only the
+        # commands need to be queued
+        pipeline.execute_command(self._heartbeat_commands(self._heartbeat_state, self._heartbeat_ttl))
+        self._queue_liveness(pipeline)
+
+    def _queue_liveness(self, pipeline):
+        """
+        Queue the commands that move the board to the current server time in
+        the liveness indexes
+
+        The commands are encoded once per clock sync, after that only the
+        digits of the score that changed are written over the encoded
+        commands so refreshing the liveness doesn't allocate.
+        """
+        if not self._index_keys:
+            return
+        elapsed = self.clock.elapsed()
+        if elapsed is None:
+            return
+        cached = self._encoded_liveness
+        if cached is None or cached[0] != self.clock.base:
+            cached = self._encode_liveness(elapsed)
+        elif cached[2] != elapsed and not 0 <= cached[1] + elapsed < 1000000:
+            cached = self._encode_liveness(elapsed)
+        elif cached[2] != elapsed:
+            # Only the low six digits of a ten digit score move before the
+            # commands are encoded again
+            data = cached[3].data
+            for end in cached[4]:
+                value = cached[1] + elapsed
+                position = end
+                while position > end - 6:
+                    position -= 1
+                    data[position] = 48 + value % 10
+                    value //= 10
+            cached[2] = elapsed
+        pipeline.execute_command(cached[3])
+
+    def _encode_liveness(self, elapsed):
+        """
+        Encode the liveness commands for a score of the clock base plus
+        elapsed seconds
+
+        Returns
+        -------
+        list
+            The clock base, the low six digits of the score less elapsed,
+            elapsed, the EncodedCommands and the end position of each score
+            in their data
+        """
+        now = self.clock.base + elapsed
+        score = str(now).encode()
+        commands = EncodedCommands(*[('ZADD', key, score, self._liveness_member) for key in self._index_keys])
+        ends = []
+        if len(score) == 10:
+            start = 0
+            for key in self._index_keys:
+                start = commands.data.find(b'\r\n' + score + b'\r\n', start) + 2 + len(score)
+                ends.append(start)
+            commands.data = bytearray(commands.data)
+            low = now % 1000000 - elapsed
+        else:
+            # Never patched, any other elapsed value encodes them again
+            low = 1000000
+        cached = [self.clock.base, low, elapsed, commands, ends]
+        self._encoded_liveness = cached
+        return cached
+
+    def sync_clock(self, pipeline=None):
+        """
+        Scheduled task that reads the redis server time, the pipeline is
+        not used because the reply is needed straight away
+        """
+        self.clock.sync(self.redis_connection)
 
     def keyname_to_handler(self, key):
         """
@@ -169,46 +675,415 @@ class EventLoop(object):
         bytes
             The handler name or None if no such handler
         """
-        if key.startswith(self.base_key + b'.'):
-            handler = key[len(self.base_key)+1:]
-            print(handler, self.handlers.keys())
-            if self.handlers.get(handler, None):
-                return handler
+        if key.startswith(self._handler_prefix) and key in self.handlers:
+            return key[len(self._handler_prefix):]
 
-    def handle_queues(self, timeout=1):
+    def handle_queues(self, timeout=None, pipeline=None):
         """
         Check for and execute commands from the command queue
 
         This willl listen to all the handler queues and call the handler
         with the value from the associated queue.
+
+        Unless drain_limit is 1 (or the board resets after each command), a
+        BLPOP that follows one that returned an item also removes up to
+        drain_limit - 1 further items per queue in the same round trip.  An
+        idle board only sends the BLPOP.  They are run back to back and their
+        completions are sent together in one pipeline.
+        If a handler raises, the drained items that haven't run yet are put
+        back at the front of their queues.  So are the items drained after a
+        reset, before the board resets.
+
+        If the board is in any groups the new group stream entries are read
+        in the same round trip, before the BLPOP, and run first.
+
+        Parameters
+        ----------
+        timeout : int, optional
+            Seconds to block waiting for an event, defaults to the time
+            until the next scheduled task is due
+
+        pipeline : Pipeline, optional
+            A pipeline holding commands (such as the heartbeat) to send in
+            the same round trip as the BLPOP.
         """
-        command = ['BLPOP'] + list(self.handlers.keys()) + [timeout]
-        response = self.redis_connection.execute_command(*command)
+        pipe = self.pipeline() if pipeline is None else pipeline
+        if timeout is None:
+            timeout = self.scheduler.timeout()
+            # BLPOP treats 0 as block forever
+            timeout = 1 if timeout is None else max(timeout // 1000, 1)
+        timeout = self._limit_timeout(timeout)
+        drain = self._drain and self._busy
+        groups = self._group_keys
+        if groups:
+            pipe.execute_command(*self._group_read_command())
+        pipe.execute_command(self._queue_commands(timeout, drain))
+        # The keys the commands were built with, running a handler can
+        # change them
+        keys = self._queue_keys
+        responses = pipe.execute(self._responses)
+        # The replies are taken out of the reused list before anything runs
+        entries = None
+        if groups:
+            entries = responses[-2] if not drain else responses[-4 - 2 * len(keys)]
+        if not drain:
+            response = responses[-1]
+        else:
+            response = responses[-3 - 2 * len(keys)]
+            drained = responses[-1]
+        responses.clear()
+        if entries:
+            self._run_group_entries(entries)
+        if not drain:
+            self._busy = bool(response)
+            if response:
+                queuekey, value = response
+                self._dispatch(queuekey, self.handlers.get(queuekey, self.not_implemented), value)
+            return
+
+        count = 1 if response else 0
+        for index in range(0, len(drained), 2):
+            count += len(drained[index])
+        self._busy = count > 0
+        if not count:
+            return
+        items = []
         if response:
-            queuekey, value = response
-            handler = self.handlers.get(queuekey, self.not_implemented)
-            rc = handler(value)
+            items.append(response)
+        for index in range(len(keys)):
+            for value in drained[index * 2]:
+                items.append((keys[index], value))
+        for index in range(len(items)):
+            if self.handlers.get(items[index][0]) == self.reset_board:
+                # Resetting doesn't return, put back what would run after it
+                self._queue_requeue(self.pipeline(), items[index + 1:]).execute()
+                del items[index + 1:]
+                break
+        if len(items) == 1:
+            queuekey, value = items[0]
+            self._dispatch(queuekey, self.handlers.get(queuekey, self.not_implemented), value)
+            return
 
-    def run(self):
+        # Run everything that was waiting back to back and send all of the
+        # completions in one batch
+        self._batch = self.pipeline()
+        self._batch_started = False
+        remaining = len(items)
+        try:
+            for queuekey, value in items:
+                remaining -= 1
+                self._dispatch(queuekey, self.handlers.get(queuekey, self.not_implemented), value)
+        finally:
+            batch = self._batch
+            self._batch = None
+            if remaining:
+                # A handler failed, the items that didn't run go back on
+                # their queues
+                self._queue_requeue(batch, items[-remaining:])
+            if self._batch_started:
+                self.console.flush()
+                self.heartbeat(state=b'idle', pipeline=batch)
+            batch.execute()
+            if self._pending_rename is not None:
+                name = self._pending_rename
+                self._pending_rename = None
+                self.rename_board(name)
+
+    def _queue_commands(self, timeout, drain=False):
         """
-        Start the eventloop
+        Get the encoded BLPOP (and drain) commands for a timeout
+
+        The commands are encoded once per timeout value and reused until the
+        handlers change, so waiting for events doesn't build any new command
+        arguments.
+
+        Parameters
+        ----------
+        timeout : int
+            The BLPOP timeout in seconds
+
+        drain : bool, optional
+            Add the commands that remove the other waiting items
+
+        Returns
+        -------
+        EncodedCommands
+            The commands to queue on the pipeline
         """
-        print('Connecting to cloudmanager server at %s:%d' % (self.redis_server, self.redis_port))
-        try:
-            self.redis_connection = Client(self.redis_server, self.redis_port)
-        except OSError:
-            raise RedisNotRunning(
-                'The Cloudmanager service is not running at %s:%s' % (self.redis_server, self.redis_port)
-            )
+        if self._handler_count != len(self.handlers):
+            self._handlers_changed()
+        cache = self._encoded_drain_commands if drain else self._encoded_queue_commands
+        commands = cache.get(timeout)
+        if commands is not None:
+            return commands
+        keys = self._queue_keys
+        blpop = ('BLPOP',) + keys + (timeout,)
+        if drain:
+            # Whatever else is already waiting is removed in the same round
+            # trip, the commands after the BLPOP run once it returns.
+            drain = [('MULTI',)]
+            for key in keys:
+                drain.append(('LRANGE', key, 0, self.drain_limit - 2))
+                drain.append(('LTRIM', key, self.drain_limit - 1, -1))
+            drain.append(('EXEC',))
+            commands = EncodedCommands(blpop, *drain)
+        else:
+            commands = EncodedCommands(blpop)
+        if len(cache) >= 8:
+            cache.clear()
+        cache[timeout] = commands
+        return commands
+
+    def _handlers_changed(self):
+        """
+        Update the queue keys after the handlers changed
+        """
+        self._handler_count = len(self.handlers)
+        self._queue_keys = tuple(key for key in self.handlers if key not in self._paused_keys)
+        self._encoded_queue_commands = {}
+        self._encoded_drain_commands = {}
+        self._drain = self.drain_limit > 1 and not self.reset_after
+
+    def pause_queue(self, operation):
+        """
+        Stop reading the queue of an operation until a job worker is free
+
+        Parameters
+        ----------
+        operation : bytes
+            The operation name
+        """
+        self._paused_keys = (self._handler_prefix + operation,)
+        self._handlers_changed()
+
+    def _queue_requeue(self, pipeline, items):
+        """
+        Queue the commands that put drained items back at the front of
+        their queues, in their original order
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to queue the commands on
+
+        items : list
+            The (queuekey, value) items
+
+        Returns
+        -------
+        Pipeline
+            The pipeline
+        """
+        values = {}
+        for queuekey, value in items:
+            values.setdefault(queuekey, []).append(value)
+        for queuekey, queued in values.items():
+            queued.reverse()
+            pipeline.execute_command('LPUSH', queuekey, *queued)
+        return pipeline
+
+    def _limit_timeout(self, timeout):
+        """
+        Shorten the BLPOP timeout so the work that isn't signalled on the
+        queues (free workers, worker output and the group streams) is
+        checked in time
+
+        Parameters
+        ----------
+        timeout : int
+            The BLPOP timeout in seconds
+
+        Returns
+        -------
+        int
+            The timeout to use
+        """
+        if self._paused_keys:
+            if self.jobs.available:
+                self._paused_keys = ()
+                self._handlers_changed()
+            else:
+                # Check for a free worker every second
+                timeout = 1
+        elif self.jobs is not None and self.jobs.running:
+            # Send the console output of the workers every second
+            timeout = 1
+        if self._group_keys:
+            timeout = min(timeout, self.group_poll)
+        return timeout
+
+    def _group_read_command(self):
+        """
+        Get the command that reads the new entries of the group streams
+        """
+        return ('XREAD', 'COUNT', self.drain_limit, 'STREAMS') + tuple(self._group_keys + self._group_ids)
+
+    def _run_group_entries(self, entries):
+        """
+        Run the entries read from the group streams, the completions go to
+        the completion list of each entry instead of the board's
+        """
+        for key, items in entries:
+            index = self._group_keys.index(key)
+            group = self.groups[index]
+            for entry_id, fields in items:
+                self._group_ids[index] = entry_id
+                operation = value = None
+                for field in range(0, len(fields), 2):
+                    if fields[field] == b'operation':
+                        operation = fields[field + 1]
+                    elif fields[field] == b'value':
+                        value = fields[field + 1]
+                if operation is None:
+                    continue
+                queuekey = self._handler_prefix + operation
+                self._group_completion = complete_key(group, entry_id)
+                try:
+                    self._dispatch(queuekey, self.handlers.get(queuekey, self.not_implemented), value)
+                finally:
+                    self._group_completion = None
+
+    def _init_group_ids(self):
+        """
+        Start reading the group streams after their newest entries, so
+        operations sent before the board joined aren't run
+        """
+        if not self._group_keys:
+            return
+        pipeline = self.pipeline()
+        for key in self._group_keys:
+            pipeline.execute_command('XREVRANGE', key, '+', '-', 'COUNT', 1)
+        self._group_ids = [newest[0][0] if newest else b'0-0' for newest in pipeline.execute()]
+
+    def _dispatch(self, queuekey, handler, value):
+        """
+        Call a handler, recording its latency if stats are enabled
+
+        Returns
+        -------
+        The value returned by the handler
+        """
+        if self.stats is None:
+            return handler(value)
+        start = ticks_ms()
+        result = handler(value)
+        operation = queuekey[len(self.base_key) + 1:]
+        name = self.__class__.handlers.get(operation, operation)
+        if is_lazy_spec(name):
+            name = operation
+        self.stats.record('handler.' + name.decode(), ticks_diff(ticks_ms(), start))
+        return result
+
+    def connect(self):
+        """
+        Connect to the redis server and register the board
+        """
+        if self.redis_connection is None:
+            print('Connecting to cloudmanager server at %s:%d' % (self.redis_server, self.redis_port))
+            try:
+                self.redis_connection = self._open_connection()
+            except OSError:
+                raise RedisNotRunning(
+                    'The Cloudmanager service is not running at %s:%s' % (self.redis_server, self.redis_port)
+                )
+        if self.stats_interval:
+            self.enable_stats(self.stats_interval)
+        if self.handler_idle_unload:
+            self.scheduler.add('unload', self.handler_idle_unload * 1000, self._unload_idle_handlers)
+        if self._index_keys:
+            self.sync_clock()
+            self.scheduler.add('clock', self.clock_interval * 1000, self.sync_clock)
+        self._init_group_ids()
         self._remove_keys()
-        if self.name == 'unregistered':
+        if self.name == b'unregistered':
             self.rename_board(self._generate_name())
         self._initialize_console()
         print('Registering with the server as %r' % self.name.decode())
 
+    def _open_connection(self):
+        """
+        Open a new connection to the redis server
+        """
+        connection = Client(self.redis_server, self.redis_port)
+        if self.stats is not None:
+            from .stats import InstrumentedClient
+            connection = InstrumentedClient(connection, self.stats)
+        return connection
+
+    def reconnect(self, timeout=300, max_delay=30):
+        """
+        Reconnect to the redis server after the connection was lost.
+
+        Unlike connect() this keeps the board state, the keys and any queued
+        operations are left on the server and the console keeps its
+        buffered output.  Attempts are retried with a jittered exponential
+        backoff.
+
+        Parameters
+        ----------
+        timeout : int, optional
+            Seconds to keep trying before giving up, default=300
+
+        max_delay : int, optional
+            The largest delay in seconds between attempts, default=30
+
+        Raises
+        ------
+        RedisNotRunning
+            If the server could not be reached before the timeout
+        """
+        try:
+            from urandom import getrandbits
+        except ImportError:
+            from random import getrandbits
+        try:
+            self.redis_connection.connection.disconnect()
+        except (AttributeError, OSError):
+            pass
+        start = ticks_ms()
+        delay = 250
         while True:
-            self.heartbeat(state=b'idle')
-            self.handle_queues()
+            try:
+                self.redis_connection = self._open_connection()
+                break
+            except OSError:
+                pass
+            if ticks_diff(ticks_ms(), start) > timeout * 1000:
+                self.redis_connection = None
+                raise RedisNotRunning(
+                    'The Cloudmanager service is not running at %s:%s' % (self.redis_server, self.redis_port)
+                )
+            # Sleep between half and all of the current delay
+            time.sleep((delay // 2 + delay * getrandbits(8) // 512) / 1000)
+            delay = min(delay * 2, max_delay * 1000)
+        print('Reconnected to cloudmanager server at %s:%d' % (self.redis_server, self.redis_port))
+        self.console.set_connection(self.redis_connection)
+        if self._index_keys:
+            self.sync_clock()
+
+    def run(self):
+        """
+        Start the eventloop
+        """
+        self.connect()
+        while True:
+            try:
+                self._run_loop()
+            except (OSError, InvalidResponse) as exc:
+                # A closed socket shows up as an invalid (empty) response
+                print('Lost connection to the cloudmanager server: %s' % exc)
+                self.reconnect()
+
+    def _run_loop(self):
+        # Output from other threads is sent by this one
+        self.console.claim()
+        pipeline = self.pipeline()
+        self.heartbeat(state=b'idle', pipeline=pipeline)
+        while True:
+            # Due tasks such as the heartbeat refresh go out in the same
+            # round trip as the BLPOP, which blocks until the next one is due
+            self.scheduler.run(pipeline)
+            self.handle_queues(pipeline=pipeline)
 
     # Operations handlers
     def not_implemented(self, queuekey):
@@ -230,39 +1105,71 @@ class EventLoop(object):
                 pass
 
     def copy_file(self, transaction_key, buffer_size=256):
-        self.heartbeat(state=b'copying', ttl=60)
-        file_key = self.redis_connection.execute_command('HGET', transaction_key, 'source')
-        filename = self.redis_connection.execute_command('HGET', transaction_key, 'dest')
+        """
+        Copy the contents of a redis key to a file.
+
+        The transaction hash has the key to copy in the 'source' field and
+        the file to write in the 'dest' field.  If the optional
+        'compression' field is set to b'zlib', b'deflate' or b'gzip' the
+        source is decompressed as it is written to the file.
+
+        If profiling is enabled the profile is written to the
+        <transaction_key>.result hash.
+        """
+        profile = self._start_profile()
+        pipeline = self.pipeline()
+        self.heartbeat(state=b'copying', ttl=60, pipeline=pipeline)
+        pipeline.execute_command('HGET', transaction_key, 'source')
+        pipeline.execute_command('HGET', transaction_key, 'dest')
+        pipeline.execute_command('HGET', transaction_key, 'compression')
+        file_key, filename, compression = pipeline.execute()[-3:]
+        rc = 0
         if filename:
+            from .compression import DecompressError, UnsupportedCompression
+            from .transfer import ValueReader
+
             self.makedirs(filename)
             message = 'Copying file to: %s' % filename
             print(message)
-            # file_size = int(self.redis_connection.execute_command('STRLEN', file_key))
-            position = 0
+            source = ValueReader(self.redis_connection, file_key, chunk_size=buffer_size)
             try:
                 with open(filename, 'wb') as file_handle:
-                    while True:
-                        end = position + buffer_size
-                        data = self.redis_connection.execute_command('GETRANGE', file_key, position, end)
-                        if data:
+                    if compression:
+                        from . import compression as compression_module
+                        compression_module.copy_to_file(
+                            source, file_handle, method=compression, buffer_size=buffer_size
+                        )
+                    else:
+                        for data in source.reader:
                             file_handle.write(data)
-                        if len(data) < buffer_size:
-                            break
-                        position += len(data)
+            except (DecompressError, UnsupportedCompression) as exc:
+                print('Could not decompress %s: %s' % (filename, exc))
+                rc = 1
             except OSError:
+                if source.error is not None:
+                    # The connection failed, leave it to run() to reconnect
+                    raise
                 print('No such file %s' % filename)
-        self.redis_connection.execute_command('DEL', transaction_key)
-        self.signal_completion(0)
-        self.heartbeat(state=b'idle')
+            finally:
+                source.drain()
+        pipeline.execute_command('DEL', transaction_key)
+        self._queue_profile(profile, rc, transaction_key + b'.result', pipeline)
+        self.signal_completion(rc, pipeline=pipeline)
+        self.heartbeat(state=b'idle', pipeline=pipeline)
+        pipeline.execute()
 
-    def exec_command(self, command):
+    def exec_command(self, command, digest=None):
         """
         Execute a single command.
 
         Parameters
         ----------
         command: bytes
-            The command to execute
+            The command to execute, may be None if its compiled code is in
+            the code cache
+
+        digest: bytes, optional
+            The digest of the command source, calculated if not specified
 
         Returns
         -------
@@ -270,24 +1177,112 @@ class EventLoop(object):
             The return code of the command, will be 0 if the command completed
             sucessfully and 1 if it generated an exception.
         """
-        self.console.clear()
-        self.clear_completion_queue()
-        self.heartbeat(state=b'running', ttl=30)
-
-        if self.debug_exec:
-            print('Running')
-            print(command)
+        if digest is None:
+            digest = code_digest(command)
+        self._begin_command(digest if command is None else command)
+        profile = self._start_profile()
         try:
-            exec(command)
+            exec(self.code_cache.compile(command, digest))
             rc = 0
         except Exception as exc:
             from sys import print_exception
             print_exception(exc)
             rc = 1
+        return self._end_command(rc, profile, digest)
+
+    def result_key(self, name):
+        """
+        Get the key of the execution profile hash of an operation
+
+        Parameters
+        ----------
+        name : bytes
+            The operation identifier, the digest of a command
+
+        Returns
+        -------
+        bytes
+            The key name, repl:<name>.result.<name>
+        """
+        return self.base_key + b'.result.' + name
 
+    def _start_profile(self):
+        """
+        Start an execution profile if profiling is enabled
+
+        Returns
+        -------
+        ExecutionProfile or None
+            The started profile, None if profiling is disabled
+        """
+        if not self.profile:
+            return None
+        from .stats import CountingSocket, ExecutionProfile
+        connection = self.redis_connection.connection
+        if not hasattr(connection.socket, 'bytes_sent'):
+            connection.socket = CountingSocket(connection.socket)
+        return ExecutionProfile(connection.socket, self.console).begin()
+
+    def _queue_profile(self, profile, rc, key, pipeline):
+        """
+        Queue writing an execution profile to its hash, ahead of the
+        completion so the hash is there when the completion arrives
+        """
+        if profile is None:
+            return
+        if self._batch is not None:
+            pipeline = self._batch
+        pipeline.execute_command('HSET', key, *profile.end().fields(rc))
+        pipeline.execute_command('EXPIRE', key, self.profile_ttl)
+
+    def _begin_command(self, command):
+        """
+        Reset the console and completion queue and mark the board as running
+        before executing a command
+
+        Within a batch of drained commands this is only done for the first
+        command, the output of the whole batch is collected together.
+        """
+        if self._batch is not None:
+            if self._batch_started:
+                if self.debug_exec:
+                    print('Running')
+                    print(command)
+                return
+            self._batch_started = True
+        self.console.clear()
+        pipeline = self.pipeline()
+        self.clear_completion_queue(pipeline=pipeline)
+        self.heartbeat(state=b'running', ttl=30, pipeline=pipeline)
+        pipeline.execute()
+
+        if self.debug_exec:
+            print('Running')
+            print(command)
+
+    def _end_command(self, rc, profile=None, digest=None):
+        """
+        Send the console output and the return code of a command and return
+        the board to idle
+
+        Within a batch of drained commands only the completion is queued,
+        the rest is done when the batch finishes.
+
+        If the command was profiled the profile is written to the
+        repl:<name>.result.<digest> hash in the same round trip.
+        """
+        if self._batch is not None:
+            if profile is not None:
+                self._queue_profile(profile, rc, self.result_key(digest), self._batch)
+            self.signal_completion(rc)
+            return rc
         self.console.flush()
-        self.signal_completion(rc)
-        self.heartbeat(state=b'idle')
+        pipeline = self.pipeline()
+        if profile is not None:
+            self._queue_profile(profile, rc, self.result_key(digest), pipeline)
+        self.signal_completion(rc, pipeline=pipeline)
+        self.heartbeat(state=b'idle', pipeline=pipeline)
+        pipeline.execute()
         if self.reset_after:
             self.reset_board('After running command')
 
@@ -296,29 +1291,68 @@ class EventLoop(object):
     def rename_handlers(self):
         """
         Change the handler keys
+
+        The operations waiting on the queues of the old keys are moved to
+        the front of the new queues.
         """
+        handlers = {}
+        renamed = []
         for handler_name, handler in self.handlers.items():
             handler_operation = handler_name.decode()
             handler_operation = handler_operation.split('.')[-1].encode()
-            self.handlers[b'repl:' + self.name + b'.' + handler_operation] = handler
-            self.redis_connection.execute_command('DEL', handler_name)
+            key = b'repl:' + self.name + b'.' + handler_operation
+            handlers[key] = handler
+            renamed.append((handler_name, key))
+        self._move_queues(renamed)
+        self._paused_keys = tuple(key for old_key, key in renamed if old_key in self._paused_keys)
+        self.handlers = handlers
+        self._handlers_changed()
+
+    def _move_queues(self, renamed):
+        """
+        Move the items of queues to other queues, ahead of the items already
+        waiting there
+
+        Parameters
+        ----------
+        renamed : list
+            The (old key, new key) pairs
+        """
+        pipeline = self.pipeline()
+        pipeline.execute_command('MULTI')
+        for old_key, key in renamed:
+            pipeline.execute_command('LRANGE', old_key, 0, -1)
+        pipeline.execute_command('DEL', *[old_key for old_key, key in renamed])
+        pipeline.execute_command('EXEC')
+        waiting = pipeline.execute()[-1]
+        for index in range(len(renamed)):
+            if waiting[index]:
+                waiting[index].reverse()
+                pipeline.execute_command('LPUSH', renamed[index][1], *waiting[index])
+        pipeline.execute()
 
     def rename_board(self, name):
         """
         Change the name of the current board
 
+        The operations waiting on the queues of the board are moved to the
+        queues of the new name.  If the rename is part of a batch of drained
+        operations the rest of the batch runs under the current name first.
+
         Parameters
         ----------
         name : str
         """
+        if self._batch is not None:
+            # handle_queues() renames the board once the batch is sent
+            self._pending_rename = name
+            return
         print('Renaming board to %s' % name)
-        name = name
-        from bootconfig.config import set
         self.heartbeat(state=b'renaming', ttl=3)
         self.name = name
-        set('name', name)
-        self._remove_keys()
+        self.set_setting('name', name.decode() if isinstance(name, bytes) else name)
         self.rename_handlers()
+        self._remove_keys(keep_completions=True)
         self._determine_keys()
         self.heartbeat(state=b'idle')
 
@@ -335,13 +1369,18 @@ class EventLoop(object):
         return False
 
 
-def start():
+def start(eventloop_class=EventLoop):
     """
     Start the event loop
+
+    Parameters
+    ----------
+    eventloop_class : class, optional
+        The eventloop class to run, default=EventLoop
     """
     print('Redis CloudClient starting')
     retry_time = 5
-    eventloop = EventLoop()
+    eventloop = eventloop_class()
     while True:
         try:
             eventloop.run()
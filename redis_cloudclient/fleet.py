@@ -0,0 +1,773 @@
+"""
+Server side functionality for controlling many boards at once
+
+This runs on the host (cpython), it drives boards through the same redis
+keys the EventLoop listens on:
+
+    repl:<name>.command          commands to execute
+    repl:<name>.exec_hash        digests of stored commands to execute
+    repl:<name>.copy             copy transactions
+    repl:<name>.upload           upload transactions
+    repl:<name>.job              jobs to run in the background, see jobs
+    repl:<name>.complete         return codes of completed operations
+    repl:<name>.console.stdout   console output (string or stream)
+    repl:<name>.result.<digest>  execution profile of a command
+    repl:<name>.telemetry        telemetry samples (stream or list)
+    board:<name>                 heartbeat
+    boards:seen                  liveness index, see liveness
+    group:<group>                group operations stream, see groups
+    code:<digest>                command source for exec_hash
+"""
+import binascii
+import os
+import time
+
+from .codecache import code_digest, code_key
+from .compression import decompress_members
+from .groups import complete_key, parse_completion, stream_key
+from .liveness import SEEN_KEY, group_key, platform_key, tag_key
+from .pipeline import Pipeline
+from .transfer import ChunkReader
+
+
+class Result(object):
+    """
+    The result of an operation on a board
+
+    Attributes
+    ----------
+    name : bytes
+        The board name
+
+    rc : int
+        The return code, None if the board didn't complete in time
+
+    output : bytes
+        The console output, None if it wasn't collected
+
+    profile : dict
+        The execution profile fields, None if it wasn't collected
+    """
+    def __init__(self, name, rc=None, output=None, profile=None):
+        self.name = name
+        self.rc = rc
+        self.output = output
+        self.profile = profile
+
+    def __repr__(self):
+        return 'Result(%r, rc=%r)' % (self.name, self.rc)
+
+
+def board_keys(name):
+    """
+    Get the redis keys used by a board
+
+    Parameters
+    ----------
+    name : bytes
+        The board name
+
+    Returns
+    -------
+    dict
+        Dictionary of the key names
+    """
+    if isinstance(name, str):
+        name = name.encode()
+    base_key = b'repl:' + name
+    return {
+        'base': base_key,
+        'command': base_key + b'.command',
+        'complete': base_key + b'.complete',
+        'stdout': base_key + b'.console.stdout',
+        'heartbeat': b'board:' + name,
+        'boardinfo': b'boardinfo:' + name,
+    }
+
+
+def console_entries_output(entries):
+    """
+    Get the output of the last command from the entries of a stream console
+
+    Parameters
+    ----------
+    entries : list
+        The stream entries as returned by XRANGE
+
+    Returns
+    -------
+    tuple
+        The output (bytes, None if there are no entries) and its
+        compression method (None if it isn't compressed)
+    """
+    if not entries:
+        return None, None
+    chunks = []
+    encoding = None
+    for entry_id, fields in entries:
+        fields = dict(zip(fields[::2], fields[1::2]))
+        if fields.get(b'event') == b'clear':
+            # The start of the output of a new command
+            chunks = []
+            encoding = fields.get(b'encoding')
+        elif b'data' in fields:
+            chunks.append(fields[b'data'])
+    return b''.join(chunks), encoding
+
+
+class Fleet(object):
+    """
+    Send operations to many boards concurrently
+
+    Every operation is pushed to all of the boards with a single pipelined
+    round trip, the completions are collected with BLPOP calls that wait on
+    all of the outstanding boards at once, and the console output is read
+    back with one more round trip.
+
+    Parameters
+    ----------
+    host : str, optional
+        The redis server, default='localhost'
+
+    port : int, optional
+        The redis server port, default=18266
+
+    redis : uredis_modular.client.Client, optional
+        An existing connection to use instead of connecting to host:port
+    """
+    def __init__(self, host='localhost', port=18266, redis=None):
+        if redis is None:
+            from uredis_modular.client import Client
+            redis = Client(host, port)
+        self.redis = redis
+
+    def pipeline(self):
+        return Pipeline(self.redis)
+
+    def _names(self, boards):
+        return [board.encode() if isinstance(board, str) else board for board in boards]
+
+    def server_time(self):
+        """
+        Get the redis server time, the liveness indexes are scored with it
+
+        Returns
+        -------
+        int
+            Seconds since the epoch
+        """
+        return int(self.redis.execute_command('TIME')[0])
+
+    def alive(self, within=10, platform=None, tag=None, group=None):
+        """
+        Find the boards that have sent a heartbeat recently
+
+        Parameters
+        ----------
+        within : int, optional
+            Seconds since the last heartbeat, default=10
+
+        platform : str, optional
+            Only boards running on this platform, for example 'esp8266'
+
+        tag : str, optional
+            Only boards with this tag in their cloudmanager_tags setting
+
+        group : str, optional
+            Only members of this group
+
+        Returns
+        -------
+        list
+            The board names, sorted by the time they were last seen
+        """
+        keys = []
+        if platform:
+            keys.append(platform_key(platform))
+        if tag:
+            keys.append(tag_key(tag))
+        if group:
+            keys.append(group_key(group))
+        if not keys:
+            keys.append(SEEN_KEY)
+        minimum = self.server_time() - within
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.execute_command('ZRANGEBYSCORE', key, minimum, '+inf')
+        responses = pipeline.execute()
+        names = responses[0]
+        for response in responses[1:]:
+            response = set(response)
+            names = [name for name in names if name in response]
+        return names
+
+    def last_seen(self, boards):
+        """
+        Get the time the boards last sent a heartbeat
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to server time in seconds, None for
+            boards that aren't in the index
+        """
+        boards = self._names(boards)
+        pipeline = self.pipeline()
+        for name in boards:
+            pipeline.execute_command('ZSCORE', SEEN_KEY, name)
+        seen = {}
+        for name, score in zip(boards, pipeline.execute()):
+            seen[name] = None if score is None else int(float(score))
+        return seen
+
+    def prune(self, older_than=86400, platforms=(), tags=()):
+        """
+        Remove boards that haven't sent a heartbeat for a long time from the
+        liveness indexes
+
+        Parameters
+        ----------
+        older_than : int, optional
+            Seconds since the last heartbeat, default=86400
+
+        platforms : list, optional
+            The platform indexes to prune as well as boards:seen
+
+        tags : list, optional
+            The tag indexes to prune as well as boards:seen
+
+        Returns
+        -------
+        int
+            The number of boards removed from boards:seen
+        """
+        maximum = self.server_time() - older_than
+        keys = [SEEN_KEY] + [platform_key(platform) for platform in platforms] + [tag_key(tag) for tag in tags]
+        pipeline = self.pipeline()
+        for key in keys:
+            pipeline.execute_command('ZREMRANGEBYSCORE', key, '-inf', maximum)
+        return int(pipeline.execute()[0])
+
+    def push(self, boards, operation, values):
+        """
+        Push a value onto an operation queue of every board in one round
+        trip, clearing their completion queues first.
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        operation : bytes
+            The operation name, for example b'command' or b'copy'
+
+        values : list
+            The value to push for each board, in the same order as boards
+        """
+        if isinstance(operation, str):
+            operation = operation.encode()
+        pipeline = self.pipeline()
+        for name, value in zip(self._names(boards), values):
+            keys = board_keys(name)
+            pipeline.execute_command('DEL', keys['complete'])
+            pipeline.execute_command('RPUSH', keys['base'] + b'.' + operation, value)
+        pipeline.execute()
+
+    def push_group(self, group, operation, value, maxlen=1000):
+        """
+        Send an operation to every member of a group with a single write
+
+        Parameters
+        ----------
+        group : str
+            The group name
+
+        operation : bytes
+            The operation name, for example b'command' or b'exec_hash'
+
+        value : bytes
+            The value passed to the handler on each board
+
+        maxlen : int, optional
+            The approximate number of entries to keep in the group stream,
+            default=1000
+
+        Returns
+        -------
+        bytes
+            The stream entry id, used to wait for the completions
+        """
+        return self.redis.execute_command(
+            'XADD', stream_key(group), 'MAXLEN', '~', maxlen, '*', 'operation', operation, 'value', value
+        )
+
+    def wait_group(self, group, entry_id, boards, timeout=30):
+        """
+        Wait for the members of a group to complete an operation
+
+        Parameters
+        ----------
+        group : str
+            The group name
+
+        entry_id : bytes
+            The entry id returned by push_group()
+
+        boards : list
+            The boards expected to complete the operation, boards that
+            aren't listed are added to the results if they complete
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result, the rc is None for boards
+            that didn't complete in time
+        """
+        key = complete_key(group, entry_id)
+        results = {}
+        for name in self._names(boards):
+            results[name] = Result(name)
+        pending = len(results)
+        deadline = time.time() + timeout
+        while pending:
+            remaining = int(deadline - time.time())
+            if remaining < 1:
+                break
+            response = self.redis.execute_command('BLPOP', key, remaining)
+            if not response:
+                break
+            name, rc = parse_completion(response[1])
+            result = results.get(name)
+            if result is None:
+                results[name] = Result(name, rc)
+                continue
+            if result.rc is None:
+                pending -= 1
+            result.rc = rc
+        self.redis.execute_command('DEL', key)
+        return results
+
+    def run_group(self, group, command, timeout=30, within=10, output=False):
+        """
+        Run a command on every live member of a group
+
+        Parameters
+        ----------
+        group : str
+            The group name
+
+        command : str
+            The python code to run
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        within : int, optional
+            Members that have sent a heartbeat in the last within seconds
+            are expected to complete, default=10
+
+        output : bool, optional
+            Collect the console output of the boards, default=False
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result
+        """
+        boards = self.alive(within=within, group=group)
+        entry_id = self.push_group(group, b'command', command)
+        results = self.wait_group(group, entry_id, boards, timeout=timeout)
+        if output:
+            self.collect_output(results)
+        return results
+
+    def wait(self, boards, timeout=30):
+        """
+        Wait for all of the boards to signal completion
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result, the rc is None for boards
+            that didn't complete in time
+        """
+        results = {}
+        pending = {}
+        for name in self._names(boards):
+            results[name] = Result(name)
+            pending[board_keys(name)['complete']] = name
+        self._wait_completions(pending, results, timeout)
+        return results
+
+    def _wait_completions(self, pending, results, timeout):
+        """
+        Pop the return codes from the completion lists into the results
+
+        Parameters
+        ----------
+        pending : dict
+            Dictionary of completion list key to board name
+
+        results : dict
+            Dictionary of board name to Result
+
+        timeout : int
+            Seconds to wait for all of the completions
+        """
+        deadline = time.time() + timeout
+        while pending:
+            remaining = int(deadline - time.time())
+            if remaining < 1:
+                break
+            response = self.redis.execute_command('BLPOP', *(list(pending.keys()) + [remaining]))
+            if not response:
+                break
+            key, rc = response
+            results[pending.pop(key)].rc = int(rc)
+
+    def run_job(self, boards, command, timeout=30, output=True):
+        """
+        Run python code as a background job on all of the boards
+
+        Unlike run_command() the boards keep handling other operations
+        while the job runs if they have workers (see jobs).
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        command : str
+            The python code to run
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        output : bool, optional
+            Collect the job output of the boards, default=True
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result
+        """
+        boards = self._names(boards)
+        job_id = binascii.hexlify(os.urandom(6))
+        pipeline = self.pipeline()
+        results = {}
+        pending = {}
+        for name in boards:
+            job_key = b'fleet:job:' + job_id + b':' + name
+            pipeline.execute_command('HSET', job_key, 'command', command)
+            pipeline.execute_command('EXPIRE', job_key, timeout + 60)
+            pipeline.execute_command('RPUSH', board_keys(name)['base'] + b'.job', job_key)
+            results[name] = Result(name)
+            pending[job_key + b'.complete'] = name
+        pipeline.execute()
+        job_keys = list(pending.keys())
+        self._wait_completions(pending, results, timeout)
+        pipeline = self.pipeline()
+        for job_complete_key in job_keys:
+            job_key = job_complete_key[:-len(b'.complete')]
+            if output:
+                pipeline.execute_command('GET', job_key + b'.stdout')
+            pipeline.execute_command('DEL', job_key, job_complete_key, job_key + b'.stdout')
+        responses = pipeline.execute()
+        if output:
+            for name, data in zip(boards, responses[::2]):
+                results[name].output = data
+        return results
+
+    def collect_output(self, results):
+        """
+        Read the console output of the boards into the results in one round
+        trip
+
+        Parameters
+        ----------
+        results : dict
+            Dictionary of board name to Result as returned by wait()
+        """
+        # Only one of GET and XRANGE works, depending on the console backend
+        # of the board, the other reply is a WRONGTYPE error
+        pipeline = Pipeline(self.redis, raise_on_error=False)
+        names = list(results.keys())
+        for name in names:
+            stdout_key = board_keys(name)['stdout']
+            pipeline.execute_command('GET', stdout_key)
+            pipeline.execute_command('GET', stdout_key + b'.encoding')
+            pipeline.execute_command('XRANGE', stdout_key, '-', '+')
+        replies = pipeline.execute()
+        for index, name in enumerate(names):
+            output, encoding, entries = replies[index * 3:index * 3 + 3]
+            if isinstance(output, Exception):
+                output, encoding = console_entries_output(entries)
+            if output and encoding:
+                output = decompress_members(output, encoding)
+            results[name].output = output
+
+    def collect_profiles(self, results, keys):
+        """
+        Read the execution profiles of the boards into the results in one
+        round trip
+
+        The boards only write profiles when their cloudmanager_profile
+        setting is enabled.
+
+        Parameters
+        ----------
+        results : dict
+            Dictionary of board name to Result as returned by wait()
+
+        keys : dict
+            Dictionary of board name to the key of its profile hash
+        """
+        pipeline = self.pipeline()
+        names = list(results.keys())
+        for name in names:
+            pipeline.execute_command('HGETALL', keys[name])
+        for name, fields in zip(names, pipeline.execute()):
+            profile = {}
+            for index in range(0, len(fields or []), 2):
+                value = fields[index + 1]
+                profile[fields[index].decode()] = int(value) if value.lstrip(b'-').isdigit() else value
+            results[name].profile = profile or None
+
+    def _command_profile_keys(self, boards, command):
+        if isinstance(command, str):
+            command = command.encode()
+        digest = code_digest(command)
+        return dict((name, board_keys(name)['base'] + b'.result.' + digest) for name in boards)
+
+    def run_command(self, boards, command, timeout=30, output=True, profile=False):
+        """
+        Run a command on all of the boards
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        command : bytes
+            The python code to execute
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        output : bool, optional
+            Collect the console output, default=True
+
+        profile : bool, optional
+            Collect the execution profiles, default=False
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result
+        """
+        if isinstance(command, str):
+            command = command.encode()
+        boards = self._names(boards)
+        self.push(boards, b'command', [command] * len(boards))
+        results = self.wait(boards, timeout=timeout)
+        if output:
+            self.collect_output(results)
+        if profile:
+            self.collect_profiles(results, self._command_profile_keys(boards, command))
+        return results
+
+    def store_command(self, command):
+        """
+        Store the source of a command so boards can run it by digest
+
+        Parameters
+        ----------
+        command : bytes
+            The python code
+
+        Returns
+        -------
+        bytes
+            The digest to send to the exec_hash operation
+        """
+        if isinstance(command, str):
+            command = command.encode()
+        digest = code_digest(command)
+        self.redis.execute_command('SET', code_key(digest), command)
+        return digest
+
+    def run_hash(self, boards, command, timeout=30, output=True, profile=False):
+        """
+        Run a command on all of the boards by its digest
+
+        Only the digest is sent to the boards, boards that already have the
+        command compiled in their code cache don't read the source.
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        command : bytes
+            The python code to execute
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        output : bool, optional
+            Collect the console output, default=True
+
+        profile : bool, optional
+            Collect the execution profiles, default=False
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result
+        """
+        boards = self._names(boards)
+        digest = self.store_command(command)
+        self.push(boards, b'exec_hash', [digest] * len(boards))
+        results = self.wait(boards, timeout=timeout)
+        if output:
+            self.collect_output(results)
+        if profile:
+            self.collect_profiles(results, self._command_profile_keys(boards, command))
+        return results
+
+    def copy_file(self, boards, data, dest, compression=None, timeout=30, profile=False):
+        """
+        Copy a file to all of the boards
+
+        The file contents are stored once and each board gets its own copy
+        transaction referencing them.
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        data : bytes
+            The file contents, already compressed if compression is set
+
+        dest : str
+            The filename on the boards
+
+        compression : bytes, optional
+            The compression of data, b'zlib', b'deflate' or b'gzip'
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=30
+
+        profile : bool, optional
+            Collect the execution profiles, default=False
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result
+        """
+        boards = self._names(boards)
+        transaction_id = binascii.hexlify(os.urandom(6))
+        source_key = b'fleet:file:' + transaction_id
+        pipeline = self.pipeline()
+        pipeline.execute_command('SETEX', source_key, timeout + 60, data)
+        transactions = []
+        for name in boards:
+            transaction_key = b'fleet:copy:' + transaction_id + b':' + name
+            fields = ['source', source_key, 'dest', dest]
+            if compression:
+                fields += ['compression', compression]
+            pipeline.execute_command('HSET', transaction_key, *fields)
+            pipeline.execute_command('EXPIRE', transaction_key, timeout + 60)
+            transactions.append(transaction_key)
+        pipeline.execute()
+        self.push(boards, b'copy', transactions)
+        results = self.wait(boards, timeout=timeout)
+        self.redis.execute_command('DEL', source_key)
+        if profile:
+            self.collect_profiles(
+                results, dict((name, key + b'.result') for name, key in zip(boards, transactions))
+            )
+        return results
+
+    def upload_file(self, boards, source, timeout=60):
+        """
+        Read a file from all of the boards
+
+        Each board streams the file to its own key and records the length
+        and sha256 digest of what it sent, the data is checked against them
+        before it is returned.
+
+        Parameters
+        ----------
+        boards : list
+            The board names
+
+        source : str
+            The filename on the boards
+
+        timeout : int, optional
+            Seconds to wait for all of the boards, default=60
+
+        Returns
+        -------
+        dict
+            Dictionary of board name to Result, the output is the file
+            contents.  The rc is 1 if the board couldn't read the file or
+            the data doesn't match its length and digest.
+        """
+        boards = self._names(boards)
+        transaction_id = binascii.hexlify(os.urandom(6))
+        pipeline = self.pipeline()
+        transactions = []
+        for name in boards:
+            transaction_key = b'fleet:upload:' + transaction_id + b':' + name
+            data_key = b'fleet:data:' + transaction_id + b':' + name
+            pipeline.execute_command('HSET', transaction_key, 'source', source, 'dest', data_key)
+            pipeline.execute_command('EXPIRE', transaction_key, timeout + 60)
+            transactions.append((transaction_key, data_key))
+        pipeline.execute()
+        self.push(boards, b'upload', [transaction_key for transaction_key, data_key in transactions])
+        results = self.wait(boards, timeout=timeout)
+
+        pipeline = self.pipeline()
+        for transaction_key, data_key in transactions:
+            pipeline.execute_command('HMGET', transaction_key, 'length', 'sha256')
+        footers = pipeline.execute()
+        for name, (transaction_key, data_key), (length, digest) in zip(boards, transactions, footers):
+            result = results[name]
+            if result.rc != 0:
+                continue
+            if length is None:
+                result.rc = 1
+                continue
+            # Large values are read in windowed chunks
+            data = b''.join(ChunkReader(
+                self.redis, data_key, chunk_size=2048, window=16, size=int(length)
+            ))
+            if len(data) != int(length) or code_digest(data) != digest:
+                result.rc = 1
+                continue
+            result.output = data
+        pipeline = self.pipeline()
+        for transaction_key, data_key in transactions:
+            pipeline.execute_command('DEL', transaction_key, data_key)
+        pipeline.execute()
+        return results
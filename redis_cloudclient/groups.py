@@ -0,0 +1,73 @@
+"""
+Board group functionality
+
+Boards join the groups listed in their cloudmanager_groups setting.  An
+operation for a whole group is a single entry added to the group stream:
+
+    XADD group:<group> MAXLEN ~ 1000 * operation <operation> value <value>
+
+Every member reads the stream along with its own queues, runs the entry
+with the same handler as its repl:<name>.<operation> queue and reports the
+return code by pushing b'<name> <rc>' onto the completion list of the
+entry:
+
+    group:<group>.complete:<entry id>
+
+so the server is written to once per operation however many boards are in
+the group.  Members are indexed in the boards:group:<group> liveness index,
+see liveness.
+"""
+# Seconds the completion list of an entry is kept
+COMPLETE_TTL = 3600
+
+
+def stream_key(group):
+    """
+    Get the stream key of a group
+
+    Parameters
+    ----------
+    group : str or bytes
+        The group name
+
+    Returns
+    -------
+    bytes
+        The stream key
+    """
+    if isinstance(group, str):
+        group = group.encode()
+    return b'group:' + group
+
+
+def complete_key(group, entry_id):
+    """
+    Get the completion list key of a group stream entry
+
+    Parameters
+    ----------
+    group : str or bytes
+        The group name
+
+    entry_id : bytes
+        The stream entry id
+
+    Returns
+    -------
+    bytes
+        The list key
+    """
+    return stream_key(group) + b'.complete:' + entry_id
+
+
+def parse_completion(value):
+    """
+    Split a completion list element into the board name and return code
+
+    Returns
+    -------
+    tuple
+        The board name (bytes) and return code (int)
+    """
+    name, rc = value.rsplit(b' ', 1)
+    return name, int(rc)
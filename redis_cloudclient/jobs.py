@@ -0,0 +1,186 @@
+"""
+Background job functionality
+
+A job is python code that runs without blocking the eventloop.  It is
+described by a hash that the value pushed onto repl:<name>.job names:
+
+    HSET <job> command <code>
+
+The output of the job is written to <job>.stdout and its return code is
+pushed onto <job>.complete, so the results of jobs running at the same
+time are kept apart.  Both keys expire ttl seconds after the job ends.
+
+On ports with _thread the jobs run on up to workers threads, each with its
+own redis connection.  Without _thread, or with no workers, they run in the
+eventloop like any other operation.  print() in the job code writes to the
+job output.  Other output, such as print() in the modules a job imports,
+goes to the console, which holds it for the eventloop thread to send (see
+console.RedisStream).
+
+The repl:<name>.job operation is handled by handle_job(), which the
+eventloop imports when the first job arrives.
+"""
+try:
+    import _thread
+except ImportError:
+    _thread = None
+
+from .console import RedisStream
+from .pipeline import Pipeline
+
+
+def run_job(redis, job_key, ttl=3600):
+    """
+    Run a job
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection to use
+
+    job_key : bytes
+        The job hash key
+
+    ttl : int, optional
+        Seconds the output and completion keys are kept, default=3600
+
+    Returns
+    -------
+    int
+        The return code, 0 if the code completed and 1 if it raised an
+        exception
+    """
+    output = RedisStream(redis, job_key)
+
+    def job_print(*args, **kwargs):
+        if 'file' not in kwargs:
+            kwargs['file'] = output
+        print(*args, **kwargs)
+
+    rc = 0
+    try:
+        command = redis.execute_command('HGET', job_key, 'command')
+        if command is None:
+            raise ValueError('Job %r has no command' % job_key)
+        exec(compile(command, '<job>', 'exec'), {'__name__': '__job__', 'print': job_print})
+    except Exception as exc:
+        from sys import print_exception
+        print_exception(exc, output)
+        rc = 1
+    output.flush()
+    complete_key = job_key + b'.complete'
+    pipeline = Pipeline(redis)
+    pipeline.execute_command('RPUSH', complete_key, rc)
+    pipeline.execute_command('EXPIRE', complete_key, ttl)
+    pipeline.execute_command('EXPIRE', output.redis_stdout_key, ttl)
+    pipeline.execute()
+    return rc
+
+
+def handle_job(eventloop, job_key):
+    """
+    Eventloop handler that runs a job on a worker thread
+
+    Without workers the job runs in the eventloop.  While every worker is
+    busy the job queue is paused so the other operations are still handled.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the job
+
+    job_key : bytes
+        The job hash key
+    """
+    if eventloop.jobs is None:
+        eventloop.heartbeat(state=b'running', ttl=30)
+        run_job(eventloop.redis_connection, job_key, eventloop.job_ttl)
+        eventloop.heartbeat(state=b'idle')
+        return
+    eventloop.jobs.submit(job_key)
+    if not eventloop.jobs.available:
+        # Leave further jobs in the queue until a worker is free
+        eventloop.pause_queue(b'job')
+
+
+class JobRunner(object):
+    """
+    Run jobs on a bounded number of worker threads
+
+    Jobs submitted while all of the workers are busy wait in a backlog, a
+    worker takes the next job from it when it finishes.
+
+    Parameters
+    ----------
+    connect : callable
+        Function that opens a new redis connection, the connections are
+        reused by later jobs
+
+    workers : int, optional
+        The most jobs to run at once, default=1
+
+    ttl : int, optional
+        Seconds the job output and completion keys are kept, default=3600
+    """
+    def __init__(self, connect, workers=1, ttl=3600):
+        if _thread is None:
+            raise ImportError('This port does not support threads')
+        self.connect = connect
+        self.workers = workers
+        self.ttl = ttl
+        self.running = 0
+        self.completed = 0
+        self._backlog = []
+        self._connections = []
+        self._lock = _thread.allocate_lock()
+
+    @property
+    def available(self):
+        """
+        True if a submitted job would start straight away
+        """
+        return self.running < self.workers and not self._backlog
+
+    def submit(self, job_key):
+        """
+        Start a job on a worker, or add it to the backlog if all of the
+        workers are busy
+
+        Parameters
+        ----------
+        job_key : bytes
+            The job hash key
+        """
+        with self._lock:
+            if self.running >= self.workers:
+                self._backlog.append(job_key)
+                return
+            self.running += 1
+        _thread.start_new_thread(self._work, (job_key,))
+
+    def _work(self, job_key):
+        """
+        Worker thread, runs jobs until the backlog is empty
+        """
+        while job_key is not None:
+            with self._lock:
+                redis = self._connections.pop() if self._connections else None
+            try:
+                if redis is None:
+                    redis = self.connect()
+                run_job(redis, job_key, self.ttl)
+            except Exception as exc:
+                # The connection is in an unknown state, don't reuse it.
+                # The console holds output from this thread for the
+                # eventloop thread to send.
+                print('Job %r failed: %s' % (job_key, exc))
+                redis = None
+            with self._lock:
+                self.completed += 1
+                if redis is not None:
+                    self._connections.append(redis)
+                if self._backlog:
+                    job_key = self._backlog.pop(0)
+                else:
+                    job_key = None
+                    self.running -= 1
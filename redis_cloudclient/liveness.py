@@ -0,0 +1,119 @@
+"""
+Liveness index functionality
+
+Boards add themselves to sorted sets scored by the redis server time (in
+seconds) they were last seen, every time they send a heartbeat:
+
+    boards:seen                  every board
+    boards:platform:<platform>   boards running on a platform
+    boards:tag:<tag>             boards with a tag from cloudmanager_tags
+    boards:group:<group>         members of a group from cloudmanager_groups
+
+so the boards seen recently can be found with ZRANGEBYSCORE instead of
+scanning the keyspace for board:<name> keys.  Entries are not expired by
+the server, boards that are gone for good are removed with
+ZREMRANGEBYSCORE, see Fleet.prune().
+"""
+SEEN_KEY = b'boards:seen'
+
+
+def platform_key(platform):
+    """
+    Get the index key of the boards running on a platform
+
+    Parameters
+    ----------
+    platform : str or bytes
+        The platform name, for example 'esp8266'
+
+    Returns
+    -------
+    bytes
+        The sorted set key
+    """
+    if isinstance(platform, str):
+        platform = platform.encode()
+    return b'boards:platform:' + platform.lower()
+
+
+def tag_key(tag):
+    """
+    Get the index key of the boards with a tag
+
+    Parameters
+    ----------
+    tag : str or bytes
+        The tag name
+
+    Returns
+    -------
+    bytes
+        The sorted set key
+    """
+    if isinstance(tag, str):
+        tag = tag.encode()
+    return b'boards:tag:' + tag
+
+
+def group_key(group):
+    """
+    Get the index key of the members of a group
+
+    Parameters
+    ----------
+    group : str or bytes
+        The group name
+
+    Returns
+    -------
+    bytes
+        The sorted set key
+    """
+    if isinstance(group, str):
+        group = group.encode()
+    return b'boards:group:' + group
+
+
+def parse_tags(value):
+    """
+    Parse a cloudmanager_tags or cloudmanager_groups setting
+
+    Parameters
+    ----------
+    value : str
+        Comma separated names, for example 'lab,sensor'
+
+    Returns
+    -------
+    list
+        The names as bytes
+    """
+    tags = []
+    for tag in value.split(','):
+        tag = tag.strip()
+        if tag:
+            tags.append(tag.encode())
+    return tags
+
+
+def index_keys(platform, tags=(), groups=()):
+    """
+    Get all of the index keys a board is added to
+
+    Parameters
+    ----------
+    platform : str or bytes
+        The board platform
+
+    tags : list, optional
+        The board tags
+
+    groups : list, optional
+        The groups the board is a member of
+
+    Returns
+    -------
+    list
+        The sorted set keys
+    """
+    return [SEEN_KEY, platform_key(platform)] + [tag_key(tag) for tag in tags] + [group_key(group) for group in groups]
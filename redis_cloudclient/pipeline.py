@@ -0,0 +1,428 @@
+"""
+Pipelined command functionality
+"""
+import sys
+
+
+# Micropython sockets read into a buffer with readinto(), cpython ones with
+# recv_into()
+_READINTO = sys.implementation.name == 'micropython'
+
+# Reply lines are read into these buffers so reading the replies that don't
+# carry any data doesn't allocate
+_line = bytearray(32)
+_byte = bytearray(1)
+
+# The exceptions of the redis client, imported by _errors() the first time
+# they are needed instead of on every reply
+_ERRORS = None
+
+
+def _errors():
+    """
+    Get the InvalidResponse and RedisError exceptions of the redis client
+    """
+    global _ERRORS
+    if _ERRORS is None:
+        from uredis_modular.client import InvalidResponse, RedisError
+        _ERRORS = (InvalidResponse, RedisError)
+    return _ERRORS
+
+
+def to_bytes(value):
+    """
+    Convert a command argument to bytes the same way the redis client does
+
+    Parameters
+    ----------
+    value
+        The command argument, bytearray and memoryview values are returned
+        as-is
+
+    Returns
+    -------
+    bytes
+        The argument as bytes
+    """
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    try:
+        if isinstance(value, float):
+            return repr(value).encode()
+    except NameError:
+        # Platform doesn't support floating point
+        pass
+    return str(value).encode()
+
+
+def encode_command(stream, command):
+    """
+    Add the RESP representation of a command to a stream
+
+    Parameters
+    ----------
+    stream : bytearray
+        The stream to add the command to
+
+    command : tuple
+        The command name followed by the arguments
+    """
+    stream += b'*' + str(len(command)).encode() + b'\r\n'
+    for item in command:
+        item = to_bytes(item)
+        stream += b'$' + str(len(item)).encode() + b'\r\n'
+        stream += item
+        stream += b'\r\n'
+
+
+def read_exactly(sock, size):
+    """
+    Read a number of bytes from a socket, the data of a reply can arrive in
+    several segments so a single recv() may return less.
+
+    Parameters
+    ----------
+    sock : socket
+        The socket to read from
+
+    size : int
+        The number of bytes to read
+
+    Returns
+    -------
+    bytes
+        The data read
+    """
+    from uredis_modular.client import InvalidResponse
+
+    data = sock.recv(size)
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            raise InvalidResponse('Protocol Error: connection closed in a reply')
+        data += chunk
+    return data
+
+
+def read_line(sock):
+    """
+    Read one reply line from a socket into the reused line buffer
+
+    Parameters
+    ----------
+    sock : socket
+        The socket to read from
+
+    Returns
+    -------
+    int
+        The length of the line in the buffer, without the trailing CRLF
+    """
+    global _line
+    line = _line
+    size = 0
+    while size < 2 or line[size - 2] != 13 or line[size - 1] != 10:
+        received = sock.readinto(_byte) if _READINTO else sock.recv_into(_byte)
+        if not received:
+            raise _errors()[0]('Protocol Error: connection closed in a reply')
+        if size == len(line):
+            line = _line = line + bytearray(len(line))
+        line[size] = _byte[0]
+        size += 1
+    return size - 2
+
+
+def _line_integer(size):
+    """
+    Parse the integer after the type byte of the line in the buffer
+    without slicing it
+    """
+    InvalidResponse = _errors()[0]
+    line = _line
+    position = 1
+    negative = size > 1 and line[1] == 45
+    if negative:
+        position = 2
+    if position == size:
+        raise InvalidResponse('Protocol Error: %s' % bytes(line[:size]).decode())
+    value = 0
+    while position < size:
+        digit = line[position] - 48
+        if digit < 0 or digit > 9:
+            raise InvalidResponse('Protocol Error: %s' % bytes(line[:size]).decode())
+        value = value * 10 + digit
+        position += 1
+    return -value if negative else value
+
+
+def read_response(redis):
+    """
+    Read one reply from a redis connection
+
+    This is the reply parsing of the redis client, except that bulk replies
+    are read until all of their data has arrived and that the replies
+    without data (OK, integers and nil) are parsed without allocating.
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection
+
+    Returns
+    -------
+    The reply
+
+    Raises
+    ------
+    RedisError
+        If the reply is an error
+    """
+    InvalidResponse, RedisError = _errors()
+    connection = redis.connection
+    size = read_line(connection.socket)
+    line = _line
+    response_type = line[0] if size else None
+    if response_type == 43:
+        # +
+        if size == 3 and line[1] == 79 and line[2] == 75:
+            return b'OK'
+        return bytes(line[1:size])
+    elif response_type == 45:
+        # -
+        raise RedisError(bytes(line[1:size]))
+    elif response_type == 58:
+        # :
+        return _line_integer(size)
+    elif response_type == 36:
+        # $
+        length = _line_integer(size)
+        if length == -1:
+            return None
+        return read_exactly(connection.socket, length + 2)[:-2]
+    elif response_type == 42:
+        # *
+        length = _line_integer(size)
+        if length == -1:
+            return None
+        return [read_response(redis) for item in range(length)]
+    raise InvalidResponse('Protocol Error: %s' % bytes(line[:size]).decode())
+
+
+class EncodedCommands(object):
+    """
+    Commands that are encoded once and can then be queued on pipelines
+    again and again without building their arguments or encoding them.
+
+    Parameters
+    ----------
+    commands
+        Each command as a tuple of the command name followed by the
+        arguments
+    """
+    __slots__ = ('commands', 'data')
+
+    def __init__(self, *commands):
+        self.commands = commands
+        stream = bytearray()
+        for command in commands:
+            encode_command(stream, command)
+        self.data = bytes(stream)
+
+
+class Pipeline(object):
+    """
+    Queue redis commands and send them to the server in a single write,
+    then read all of the replies back.
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection to send the commands on
+
+    raise_on_error : bool, optional
+        Raise the first error reply after all replies have been read,
+        default=True.  If False the exception objects are returned in
+        place of the replies.
+    """
+    def __init__(self, redis, raise_on_error=True):
+        self._connection = redis
+        self.raise_on_error = raise_on_error
+        # Instrumented connections record every command sent and reply
+        # read, see stats.InstrumentedClient
+        self._instrumented = hasattr(redis, 'commands_sent')
+        self.commands = []
+        # Reused for joining encoded commands
+        self._buffer = None
+        self._view = None
+
+    def __len__(self):
+        count = 0
+        for command in self.commands:
+            if isinstance(command, EncodedCommands):
+                count += len(command.commands)
+            else:
+                count += 1
+        return count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+        else:
+            self.reset()
+
+    def execute_command(self, command, *args):
+        """
+        Add a command to the pipeline
+
+        Parameters
+        ----------
+        command : str or EncodedCommands
+            The redis command to queue, or already encoded commands
+
+        args
+            The command arguments
+
+        Returns
+        -------
+        Pipeline
+            This pipeline, so calls can be chained
+        """
+        if isinstance(command, EncodedCommands):
+            self.commands.append(command)
+        else:
+            self.commands.append((command,) + args)
+        return self
+
+    def reset(self):
+        """
+        Discard all queued commands
+        """
+        self.commands = []
+
+    def encode(self):
+        """
+        Encode the queued commands as a single RESP bytestream
+
+        Returns
+        -------
+        bytes
+            The RESP representation of all the queued commands
+        """
+        stream = bytearray()
+        for command in self.commands:
+            if isinstance(command, EncodedCommands):
+                stream += command.data
+            else:
+                encode_command(stream, command)
+        return stream
+
+    def _join(self):
+        """
+        Get the queued commands as one bytestream, pipelines that only hold
+        EncodedCommands are copied into a buffer that is reused between
+        sends.
+        """
+        size = 0
+        for command in self.commands:
+            if not isinstance(command, EncodedCommands):
+                return self.encode()
+            size += len(command.data)
+        if self._buffer is None or len(self._buffer) < size:
+            self._buffer = bytearray(size)
+            self._view = memoryview(self._buffer)
+        position = 0
+        for command in self.commands:
+            end = position + len(command.data)
+            self._view[position:end] = command.data
+            position = end
+        return self._view[:size]
+
+    def send(self):
+        """
+        Send all of the queued commands to the server in one write without
+        reading the replies.
+
+        Returns
+        -------
+        int
+            The number of replies the caller must read with read_responses()
+        """
+        count = len(self)
+        if not count:
+            return 0
+        if len(self.commands) == 1 and isinstance(self.commands[0], EncodedCommands):
+            # Send the encoded commands as they are instead of copying them
+            data = self.commands[0].data
+        else:
+            data = self._join()
+        sock = self._connection.connection.socket
+        sent = sock.send(data)
+        if sent < len(data):
+            data = memoryview(data)[sent:]
+            while data:
+                sent = sock.send(data)
+                data = data[sent:]
+        if self._instrumented:
+            self._connection.commands_sent(self.commands)
+        self.commands.clear()
+        return count
+
+    def read_responses(self, count, responses=None):
+        """
+        Read replies for commands that have already been sent
+
+        Parameters
+        ----------
+        count : int
+            The number of replies to read
+
+        responses : list, optional
+            A list to read the replies into instead of a new one, it is
+            cleared first.  Lets a caller that reads replies on every pass
+            reuse the same list.
+
+        Returns
+        -------
+        list
+            The replies in the order the commands were queued
+        """
+        RedisError = _errors()[1]
+        if responses is None:
+            responses = []
+        else:
+            responses.clear()
+        error = None
+        for item in range(count):
+            try:
+                responses.append(read_response(self._connection))
+            except RedisError as exc:
+                # Keep reading so the connection stays in sync
+                responses.append(exc)
+                if error is None:
+                    error = exc
+            if self._instrumented:
+                self._connection.reply_received()
+        if error is not None and self.raise_on_error:
+            raise error
+        return responses
+
+    def execute(self, responses=None):
+        """
+        Send all queued commands and read back their replies
+
+        Parameters
+        ----------
+        responses : list, optional
+            A list to read the replies into, see read_responses()
+
+        Returns
+        -------
+        list
+            The replies in the order the commands were queued
+        """
+        return self.read_responses(self.send(), responses)
@@ -0,0 +1,147 @@
+"""
+Lazily loaded handlers
+
+Operations can be declared with a ``module:function`` string instead of an
+EventLoop method name.  The module is only imported when the first value
+arrives on the operation queue and can be unloaded again afterwards, so
+optional features don't use any memory until they are needed.
+
+The function is called with the eventloop and the queue value:
+
+    def handle(eventloop, value):
+        ...
+        eventloop.signal_completion(0)
+"""
+import gc
+import sys
+
+from .clock import ticks_diff, ticks_ms
+
+
+def is_lazy_spec(value):
+    """
+    Check if a handler declaration is a module:function string
+
+    Parameters
+    ----------
+    value : bytes or str
+        The handler declaration
+
+    Returns
+    -------
+    bool
+        True if the value names a function in a module
+    """
+    if isinstance(value, bytes):
+        return b':' in value
+    return isinstance(value, str) and ':' in value
+
+
+def parse_handler_setting(value):
+    """
+    Parse a handler declaration setting
+
+    Parameters
+    ----------
+    value : str
+        Comma separated operation=module:function declarations, for example
+        'gpio=handlers.gpio:handle,ota=handlers.ota:update'
+
+    Returns
+    -------
+    dict
+        Dictionary of operation name (bytes) to module:function (str)
+    """
+    handlers = {}
+    for declaration in value.split(','):
+        declaration = declaration.strip()
+        if not declaration:
+            continue
+        operation, spec = declaration.split('=', 1)
+        handlers[operation.strip().encode()] = spec.strip()
+    return handlers
+
+
+class LazyHandler(object):
+    """
+    Handler that imports its module the first time it is called
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop passed to the handler function
+
+    spec : str
+        The handler function as module:function
+    """
+    def __init__(self, eventloop, spec):
+        if isinstance(spec, bytes):
+            spec = spec.decode()
+        self.eventloop = eventloop
+        self.spec = spec
+        self.module, self.function = spec.split(':', 1)
+        self.handler = None
+        self.last_used = None
+
+    def __repr__(self):
+        return 'LazyHandler(%r, loaded=%r)' % (self.spec, self.loaded)
+
+    @property
+    def loaded(self):
+        return self.handler is not None
+
+    def load(self):
+        """
+        Import the module and look up the handler function
+        """
+        __import__(self.module)
+        self.handler = getattr(sys.modules[self.module], self.function)
+
+    def unload(self):
+        """
+        Drop the handler function and remove its module from sys.modules so
+        the memory can be reclaimed.  The module is imported again the next
+        time the handler is called.
+        """
+        if self.handler is None:
+            return
+        self.handler = None
+        try:
+            del sys.modules[self.module]
+        except KeyError:
+            pass
+        if '.' in self.module:
+            # The parent package keeps a reference to the submodule
+            package, name = self.module.rsplit('.', 1)
+            package = sys.modules.get(package)
+            try:
+                delattr(package, name)
+            except (AttributeError, TypeError):
+                pass
+        gc.collect()
+
+    def idle(self):
+        """
+        Get the milliseconds since the handler was last called
+
+        Returns
+        -------
+        int
+            Milliseconds since the last call, None if it was never called
+        """
+        if self.last_used is None:
+            return None
+        return ticks_diff(ticks_ms(), self.last_used)
+
+    def __call__(self, value):
+        if self.handler is None:
+            try:
+                self.load()
+            except (ImportError, AttributeError):
+                print('Unable to load the handler %r' % self.spec)
+                self.eventloop.signal_completion(1)
+                return 1
+        try:
+            return self.handler(self.eventloop, value)
+        finally:
+            self.last_used = ticks_ms()
@@ -0,0 +1,112 @@
+"""
+Timer scheduling functionality
+"""
+from .clock import ticks_diff, ticks_ms
+
+
+class Scheduler(object):
+    """
+    Run named callbacks when their deadline passes.
+
+    The scheduler doesn't run anything by itself, the eventloop calls run()
+    on every pass and uses timeout() to decide how long it can block.
+    Neither of them allocates memory unless a task is added or removed.
+    """
+    __slots__ = ('tasks', '_pending')
+
+    def __init__(self):
+        self.tasks = {}
+        # The tasks as a tuple so run() can iterate them while callbacks add
+        # or remove tasks
+        self._pending = ()
+
+    def add(self, name, interval, callback, delay=None):
+        """
+        Add a task
+
+        Parameters
+        ----------
+        name : str
+            The task name, replaces an existing task with the same name
+
+        interval : int
+            Milliseconds between runs of the task
+
+        callback : callable
+            Function to call when the task is due, it gets the arguments
+            passed to run()
+
+        delay : int, optional
+            Milliseconds until the first run, defaults to the interval
+        """
+        if delay is None:
+            delay = interval
+        self.tasks[name] = [ticks_ms() + delay, interval, callback]
+        self._pending = tuple(self.tasks.values())
+
+    def remove(self, name):
+        """
+        Remove a task, does nothing if there is no such task
+        """
+        if self.tasks.pop(name, None) is not None:
+            self._pending = tuple(self.tasks.values())
+
+    def reschedule(self, name, delay=None, interval=None):
+        """
+        Move the next run of a task
+
+        Parameters
+        ----------
+        name : str
+            The task name
+
+        delay : int, optional
+            Milliseconds until the next run, defaults to the interval
+
+        interval : int, optional
+            Change the interval of the task
+        """
+        task = self.tasks[name]
+        if interval is not None:
+            task[1] = interval
+        if delay is None:
+            delay = task[1]
+        task[0] = ticks_ms() + delay
+
+    def timeout(self, maximum=None):
+        """
+        Get the time until the next task is due
+
+        Parameters
+        ----------
+        maximum : int, optional
+            The largest value to return if no task is due before it
+
+        Returns
+        -------
+        int
+            Milliseconds until the next task is due, 0 if a task is overdue
+            or None if there are no tasks and no maximum
+        """
+        now = ticks_ms()
+        timeout = maximum
+        for task in self._pending:
+            remaining = max(ticks_diff(task[0], now), 0)
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return timeout
+
+    def run(self, *args):
+        """
+        Run all of the tasks that are due
+
+        Parameters
+        ----------
+        args
+            Arguments to pass to the task callbacks
+        """
+        now = ticks_ms()
+        for task in self._pending:
+            if ticks_diff(task[0], now) <= 0:
+                task[0] = now + task[1]
+                task[2](*args)
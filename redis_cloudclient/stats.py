@@ -0,0 +1,320 @@
+"""
+Instrumentation functionality
+
+Records counts, bytes and latency histograms for redis commands and
+eventloop handlers, so they can be published to a stats:<name> hash, and
+profiles of individual operations.
+"""
+import gc
+
+from .clock import mem_free, ticks_diff, ticks_ms
+from .pipeline import EncodedCommands, encode_command
+
+
+class Stats(object):
+    """
+    Collection of counters and latency histograms
+
+    Each name gets the fields:
+
+        <name>.count      number of operations
+        <name>.ms         total milliseconds
+        <name>.out        bytes sent
+        <name>.in         bytes received
+        <name>.le_<ms>    operations that took at most <ms> milliseconds
+        <name>.le_inf     operations slower than the largest bucket
+
+    All values are cumulative since the stats were created.  Operations
+    added with count() only add to <name>.count.
+    """
+    buckets = (5, 20, 50, 100, 250, 1000)
+
+    def __init__(self):
+        self.counters = {}
+
+    def record(self, name, elapsed, bytes_out=0, bytes_in=0, count=1):
+        """
+        Record an operation
+
+        Parameters
+        ----------
+        name : str
+            The operation name, for example 'redis.GET' or 'handler.exec_command'
+
+        elapsed : int
+            Milliseconds the operation took
+
+        bytes_out : int, optional
+            Bytes sent
+
+        bytes_in : int, optional
+            Bytes received
+
+        count : int, optional
+            The number of operations to add, default=1
+        """
+        counter = self._counter(name)
+        counter[0] += count
+        counter[1] += elapsed
+        counter[2] += bytes_out
+        counter[3] += bytes_in
+        index = 0
+        for bucket in self.buckets:
+            if elapsed <= bucket:
+                break
+            index += 1
+        counter[4 + index] += count
+
+    def count(self, name, count=1):
+        """
+        Count operations without a latency or byte measurement
+
+        Parameters
+        ----------
+        name : str
+            The operation name
+
+        count : int, optional
+            The number of operations to add, default=1
+        """
+        self._counter(name)[0] += count
+
+    def _counter(self, name):
+        counter = self.counters.get(name)
+        if counter is None:
+            counter = [0] * (5 + len(self.buckets))
+            self.counters[name] = counter
+        return counter
+
+    def fields(self):
+        """
+        Get the stats as a flat list of hash fields and values
+
+        Returns
+        -------
+        list
+            Alternating field names and values
+        """
+        names = ['count', 'ms', 'out', 'in'] + ['le_%d' % bucket for bucket in self.buckets] + ['le_inf']
+        fields = []
+        for name, counter in self.counters.items():
+            for index in range(len(names)):
+                fields.append(name + '.' + names[index])
+                fields.append(counter[index])
+        return fields
+
+    def publish(self, redis, key):
+        """
+        Write the stats to a hash with a single HSET
+
+        Parameters
+        ----------
+        redis : uredis_modular.client.Client or Pipeline
+            The connection or pipeline to send the command on
+
+        key : bytes
+            The hash key
+        """
+        fields = self.fields()
+        if fields:
+            redis.execute_command('HSET', key, *fields)
+
+
+class CountingSocket(object):
+    """
+    Socket wrapper that counts the bytes sent and received
+    """
+    def __init__(self, sock):
+        self._socket = sock
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def send(self, data):
+        sent = self._socket.send(data)
+        self.bytes_sent += sent
+        return sent
+
+    def recv(self, size):
+        data = self._socket.recv(size)
+        self.bytes_received += len(data)
+        return data
+
+    def recv_into(self, buffer):
+        received = self._socket.recv_into(buffer)
+        self.bytes_received += received
+        return received
+
+    def readinto(self, buffer):
+        received = self._socket.readinto(buffer)
+        if received:
+            self.bytes_received += received
+        return received
+
+    def __getattr__(self, name):
+        return getattr(self._socket, name)
+
+
+class InstrumentedClient(object):
+    """
+    Wrapper around a redis client that records the count, bytes and latency
+    of every command per redis verb.
+
+    Commands sent with a Pipeline, including the windowed transfers, are
+    recorded as their replies are read.  The latency of a command is the
+    time from when it was sent, or when the reply before it was read if
+    that was later, until its reply was read, so the wait of a blocking
+    command such as BLPOP only shows in its own entry.  'redis.PIPELINE'
+    counts the pipelined writes.
+
+    Parameters
+    ----------
+    client : uredis_modular.client.Client
+        The client to instrument
+
+    stats : Stats
+        Where to record the measurements
+    """
+    def __init__(self, client, stats):
+        self.client = client
+        self.stats = stats
+        self.connection = client.connection
+        self.socket = CountingSocket(self.connection.socket)
+        self.connection.socket = self.socket
+        # (verb, bytes sent, ticks sent) of the pipelined commands waiting
+        # for their replies, in the order the replies arrive
+        self._in_flight = []
+        self._reply_start = 0
+        self._reply_received = 0
+
+    def execute_command(self, command, *args):
+        socket = self.socket
+        sent = socket.bytes_sent
+        received = socket.bytes_received
+        start = ticks_ms()
+        try:
+            return self.client.execute_command(command, *args)
+        finally:
+            self.stats.record(
+                'redis.' + command.upper(), ticks_diff(ticks_ms(), start),
+                socket.bytes_sent - sent, socket.bytes_received - received
+            )
+
+    def commands_sent(self, commands):
+        """
+        Called by Pipeline.send() with the commands it sent
+
+        Parameters
+        ----------
+        commands : list
+            The command tuples and EncodedCommands
+        """
+        now = ticks_ms()
+        if not self._in_flight:
+            self._reply_start = now
+            self._reply_received = self.socket.bytes_received
+        for command in commands:
+            if isinstance(command, EncodedCommands):
+                encoded = command.commands
+            else:
+                encoded = (command,)
+            for item in encoded:
+                stream = bytearray()
+                encode_command(stream, item)
+                self._in_flight.append((item[0], len(stream), now))
+        self.stats.count('redis.PIPELINE')
+
+    def reply_received(self):
+        """
+        Called by Pipeline.read_responses() after each reply is read
+        """
+        verb, sent, sent_at = self._in_flight.pop(0)
+        now = ticks_ms()
+        start = self._reply_start
+        if ticks_diff(sent_at, start) > 0:
+            start = sent_at
+        received = self.socket.bytes_received
+        self.stats.record('redis.' + verb.upper(), ticks_diff(now, start), sent, received - self._reply_received)
+        self._reply_start = now
+        self._reply_received = received
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class ExecutionProfile(object):
+    """
+    Wall time, bytes transferred, free memory and console output of a single
+    operation
+
+    Parameters
+    ----------
+    socket : CountingSocket, optional
+        The socket to read the byte counters from
+
+    console : RedisStream, optional
+        The console to read the output counters from
+    """
+    __slots__ = (
+        'socket', 'console', 'start', 'elapsed', 'sent', 'received', 'mem_before', 'mem_after', 'console_bytes',
+        'console_peak'
+    )
+
+    def __init__(self, socket=None, console=None):
+        self.socket = socket
+        self.console = console
+        self.elapsed = 0
+        self.mem_after = None
+
+    def begin(self):
+        """
+        Start measuring, the console counters are reset
+        """
+        gc.collect()
+        self.mem_before = mem_free()
+        if self.console is not None:
+            self.console.bytes_written = 0
+            self.console.peak_buffered = 0
+        self.sent = self.received = 0
+        if self.socket is not None:
+            self.sent = self.socket.bytes_sent
+            self.received = self.socket.bytes_received
+        self.start = ticks_ms()
+        return self
+
+    def end(self):
+        """
+        Stop measuring
+        """
+        self.elapsed = ticks_diff(ticks_ms(), self.start)
+        if self.socket is not None:
+            self.sent = self.socket.bytes_sent - self.sent
+            self.received = self.socket.bytes_received - self.received
+        self.mem_after = mem_free()
+        self.console_bytes = self.console_peak = 0
+        if self.console is not None:
+            self.console_bytes = self.console.bytes_written
+            self.console_peak = self.console.peak_buffered
+        return self
+
+    def fields(self, rc):
+        """
+        Get the measurements as a flat list of hash fields and values
+
+        Parameters
+        ----------
+        rc : int
+            The return code of the operation
+
+        Returns
+        -------
+        list
+            Alternating field names and values, the memory fields are left
+            out on platforms that can't report the free memory
+        """
+        fields = [
+            'rc', rc, 'ms', self.elapsed, 'out', self.sent, 'in', self.received, 'console_bytes', self.console_bytes,
+            'console_peak', self.console_peak,
+        ]
+        if self.mem_before is not None:
+            fields += ['mem_free_before', self.mem_before, 'mem_free_after', self.mem_after]
+        return fields
@@ -0,0 +1,134 @@
+"""
+Telemetry functionality
+
+Samples are recorded into a fixed size ring buffer on the board and sent
+to the server in one pipelined batch when the buffer is flushed, so
+recording a sample never waits for the network.
+
+Samples are written either to a redis stream, one entry per sample:
+
+    XADD repl:<name>.telemetry MAXLEN ~ <maxlen> * name <name> value <value> age <ms>
+
+or to a list, one element per sample:
+
+    RPUSH repl:<name>.telemetry b'<name> <value> <ms>'
+
+age is the number of milliseconds between recording the sample and
+flushing it, the time the sample was taken is the time of the stream entry
+id minus the age.
+"""
+from .clock import ticks_diff, ticks_ms
+from .pipeline import to_bytes
+
+
+class Telemetry(object):
+    """
+    Ring buffer of samples that is flushed to a redis stream or list
+
+    When the buffer is full the oldest samples are overwritten, the number
+    of samples lost that way is sent as a 'telemetry.dropped' sample with
+    the next flush.
+
+    Parameters
+    ----------
+    redis_key : bytes
+        The stream or list key
+
+    size : int, optional
+        The number of samples the buffer holds, default=64
+
+    backend : str, optional
+        'stream' to XADD the samples or 'list' to RPUSH them,
+        default='stream'
+
+    maxlen : int, optional
+        The approximate maximum length of the stream or list, default=1000
+    """
+    def __init__(self, redis_key, size=64, backend='stream', maxlen=1000):
+        if isinstance(redis_key, str):
+            redis_key = redis_key.encode()
+        self.redis_key = redis_key
+        self.size = size
+        self.backend = backend
+        self.maxlen = maxlen
+        self._names = [None] * size
+        self._values = [None] * size
+        self._ticks = [0] * size
+        self._start = 0
+        self._count = 0
+        self.dropped = 0
+
+    def __len__(self):
+        return self._count
+
+    def record(self, name, value):
+        """
+        Add a sample to the buffer
+
+        Parameters
+        ----------
+        name : str
+            The sample name, for example 'temperature'
+
+        value : int, float, str or bytes
+            The sample value
+        """
+        index = self._start + self._count
+        if index >= self.size:
+            index -= self.size
+        if self._count == self.size:
+            # Overwrite the oldest sample
+            self._start = index + 1 if index + 1 < self.size else 0
+            self.dropped += 1
+        else:
+            self._count += 1
+        self._names[index] = name
+        self._values[index] = value
+        self._ticks[index] = ticks_ms()
+
+    def flush(self, pipeline):
+        """
+        Queue the buffered samples on a pipeline and empty the buffer
+
+        Parameters
+        ----------
+        pipeline : Pipeline
+            The pipeline to queue the commands on, the caller executes it
+
+        Returns
+        -------
+        int
+            The number of samples queued
+        """
+        count = self._count
+        if self.dropped:
+            self._queue(pipeline, [('telemetry.dropped', self.dropped, 0)])
+            self.dropped = 0
+        if not count:
+            return 0
+        now = ticks_ms()
+        samples = []
+        index = self._start
+        for item in range(count):
+            samples.append((self._names[index], self._values[index], ticks_diff(now, self._ticks[index])))
+            self._names[index] = self._values[index] = None
+            index += 1
+            if index == self.size:
+                index = 0
+        self._start = 0
+        self._count = 0
+        self._queue(pipeline, samples)
+        return count
+
+    def _queue(self, pipeline, samples):
+        if self.backend == 'list':
+            values = []
+            for name, value, age in samples:
+                values.append(to_bytes(name) + b' ' + to_bytes(value) + b' ' + to_bytes(age))
+            pipeline.execute_command('RPUSH', self.redis_key, *values)
+            pipeline.execute_command('LTRIM', self.redis_key, -self.maxlen, -1)
+            return
+        for name, value, age in samples:
+            pipeline.execute_command(
+                'XADD', self.redis_key, 'MAXLEN', '~', self.maxlen, '*', 'name', name, 'value', value, 'age', age
+            )
@@ -0,0 +1,464 @@
+"""
+Windowed transfer functionality for moving redis values to and from the
+device
+"""
+try:
+    from uio import IOBase
+except ImportError:
+    try:
+        from io import IOBase
+    except ImportError:
+        IOBase = object
+try:
+    import ubinascii as binascii
+except ImportError:
+    import binascii
+try:
+    import uhashlib as hashlib
+except ImportError:
+    import hashlib
+
+from .clock import mem_free, ticks_diff, ticks_ms
+from .pipeline import Pipeline
+
+
+class ChunkReader(object):
+    """
+    Iterate over the contents of a redis string key in chunks, keeping
+    several GETRANGE requests in flight at once.
+
+    The chunk size is adjusted as the transfer runs, it keeps moving in the
+    direction that improves the measured throughput and is capped by the
+    amount of free memory.
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection
+
+    key : bytes
+        The redis string key to read
+
+    chunk_size : int, optional
+        The starting chunk size in bytes, default=256
+
+    window : int, optional
+        The number of chunk requests to keep in flight, default=4
+
+    min_chunk_size : int, optional
+        The smallest chunk size to use, default=64
+
+    max_chunk_size : int, optional
+        The largest chunk size to use, default=2048
+
+    size : int, optional
+        The size of the value, if not specified it is fetched with STRLEN
+
+    Attributes
+    ----------
+    error : Exception
+        The error that stopped the transfer if reading from the server
+        failed, so it can be told apart from errors writing the data
+    """
+    def __init__(self, redis, key, chunk_size=256, window=4, min_chunk_size=64, max_chunk_size=2048, size=None):
+        self._connection = redis
+        self.key = key
+        self.chunk_size = chunk_size
+        self.window = window
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.size = size
+        self.received = 0
+        self._requested = 0
+        self._in_flight = 0
+        # Error replies are returned so the rest of the window can still be
+        # read when one is raised
+        self._pipeline = Pipeline(redis, raise_on_error=False)
+        self._direction = 1
+        self._rate = 0
+        self._sample_bytes = 0
+        self._sample_chunks = 0
+        self._sample_start = 0
+        self.error = None
+
+    def __iter__(self):
+        return self.chunks()
+
+    def chunks(self):
+        """
+        Generator that returns the chunks of the value in order
+
+        Returns
+        -------
+        generator
+            Yields bytes chunks
+        """
+        try:
+            if self.size is None:
+                self.size = int(self._connection.execute_command('STRLEN', self.key))
+            self._sample_start = ticks_ms()
+            self._request()
+        except Exception as exc:
+            self.error = exc
+            raise
+        while self._in_flight:
+            try:
+                data = self._pipeline.read_responses(1)[0]
+                self._in_flight -= 1
+                if isinstance(data, Exception):
+                    # The connection is still usable after an error reply
+                    self._drain()
+                    raise data
+                if not data:
+                    # The value shrank underneath us, stop at what we have
+                    self._drain()
+                    return
+                self.received += len(data)
+                self._measure(len(data))
+                # Keep the window full before handing the data to the caller
+                self._request()
+            except Exception as exc:
+                self.error = exc
+                raise
+            yield data
+
+    def _request(self):
+        """
+        Send GETRANGE requests until the window is full
+        """
+        while self._in_flight < self.window and self._requested < self.size:
+            end = min(self._requested + self.chunk_size, self.size)
+            # GETRANGE end offsets are inclusive
+            self._pipeline.execute_command('GETRANGE', self.key, self._requested, end - 1)
+            self._requested = end
+            self._in_flight += 1
+        self._pipeline.send()
+
+    def drain(self):
+        """
+        Read and discard any replies still in flight, call it if the chunks
+        are not all read so the connection stays in sync.  Does nothing if
+        reading from the server failed.
+        """
+        if self.error is None:
+            self._drain()
+
+    def _drain(self):
+        """
+        Read and discard any replies still in flight
+        """
+        if self._in_flight:
+            self._pipeline.read_responses(self._in_flight)
+            self._in_flight = 0
+
+    def _measure(self, length):
+        """
+        Update the throughput measurements and adapt the chunk size once a
+        full window of chunks has been received.
+        """
+        self._sample_bytes += length
+        self._sample_chunks += 1
+        if self._sample_chunks < self.window:
+            return
+        now = ticks_ms()
+        elapsed = max(ticks_diff(now, self._sample_start), 1)
+        rate = self._sample_bytes * 1000 // elapsed
+        if rate < self._rate:
+            self._direction = -self._direction
+        self._rate = rate
+        self._sample_bytes = 0
+        self._sample_chunks = 0
+        self._sample_start = now
+        self._resize()
+
+    def _resize(self):
+        """
+        Move the chunk size one step in the current direction, keeping it
+        within the configured limits and the available memory.
+        """
+        if self._direction > 0:
+            chunk_size = self.chunk_size * 2
+        else:
+            chunk_size = self.chunk_size // 2
+        limit = self.max_chunk_size
+        free = mem_free()
+        if free is not None:
+            # Leave room for every chunk in the window plus the file write
+            limit = min(limit, free // (2 * (self.window + 1)))
+        self.chunk_size = max(self.min_chunk_size, min(chunk_size, limit))
+
+
+def copy_to_file(redis, key, file_handle, **kwargs):
+    """
+    Copy the contents of a redis string key into an open file
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection
+
+    key : bytes
+        The redis string key to copy
+
+    file_handle : file
+        The file to write to, opened in binary mode
+
+    kwargs
+        Additional ChunkReader arguments
+
+    Returns
+    -------
+    int
+        The number of bytes written
+    """
+    reader = ChunkReader(redis, key, **kwargs)
+    for data in reader:
+        file_handle.write(data)
+    return reader.received
+
+
+def handle_upload(eventloop, transaction_key, buffer_size=2048):
+    """
+    Eventloop handler that copies a file from the board to a redis key.
+
+    The transaction hash has the file to read in the 'source' field and
+    the key to write in the 'dest' field.  When the upload is done the
+    'length' and 'sha256' fields of the transaction hash are set to the
+    size and hex digest of the data, so the server can check the
+    contents of the key.
+
+    Parameters
+    ----------
+    eventloop : EventLoop
+        The eventloop that received the operation
+
+    transaction_key : bytes
+        The transaction hash key
+
+    buffer_size : int, optional
+        The size of the chunks read from the file, default=2048
+    """
+    profile = eventloop._start_profile()
+    pipeline = eventloop.pipeline()
+    eventloop.heartbeat(state=b'uploading', ttl=60, pipeline=pipeline)
+    pipeline.execute_command('HGET', transaction_key, 'source')
+    pipeline.execute_command('HGET', transaction_key, 'dest')
+    filename, dest_key = pipeline.execute()[-2:]
+    rc = 1
+    if filename and dest_key:
+        from uredis_modular.client import RedisError
+
+        try:
+            file_handle = open(filename, 'rb')
+        except OSError:
+            file_handle = None
+            print('No such file %s' % filename)
+            pipeline.execute_command('DEL', dest_key)
+        if file_handle is not None:
+            # Socket errors are left for run() to reconnect
+            try:
+                length, digest = copy_from_file(
+                    eventloop.redis_connection, dest_key, file_handle, chunk_size=buffer_size
+                )
+                pipeline.execute_command('HSET', transaction_key, 'length', length, 'sha256', digest)
+                rc = 0
+            except RedisError as exc:
+                print('Upload of %s failed: %s' % (filename, exc))
+                pipeline.execute_command('DEL', dest_key)
+            finally:
+                file_handle.close()
+    eventloop._queue_profile(profile, rc, transaction_key + b'.result', pipeline)
+    eventloop.signal_completion(rc, pipeline=pipeline)
+    eventloop.heartbeat(state=b'idle', pipeline=pipeline)
+    pipeline.execute()
+
+
+def copy_from_file(redis, key, file_handle, chunk_size=1024, window=4):
+    """
+    Copy the contents of an open file into a redis string key
+
+    The file is read into a buffer that is reused for the whole transfer
+    and written with pipelined APPEND commands, one batch of window chunks
+    is sent while the replies to the previous batch are read.
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection
+
+    key : bytes
+        The redis string key to write, any existing value is replaced
+
+    file_handle : file
+        The file to read, opened in binary mode
+
+    chunk_size : int, optional
+        The size of each APPEND in bytes, default=1024.  It is reduced if
+        there isn't enough free memory for the buffer.
+
+    window : int, optional
+        The number of APPEND commands sent in each batch, default=4
+
+    Returns
+    -------
+    tuple
+        The number of bytes copied and the hex sha256 digest of the data
+
+    Raises
+    ------
+    RedisError
+        If an APPEND failed, raised once all of the replies are read so the
+        connection stays in sync
+    """
+    free = mem_free()
+    if free is not None:
+        chunk_size = max(64, min(chunk_size, free // (2 * (window + 1))))
+    view = memoryview(bytearray(chunk_size * window))
+    digest = hashlib.sha256()
+    pipeline = Pipeline(redis, raise_on_error=False)
+    pipeline.execute_command('DEL', key)
+    error = None
+    length = 0
+    pending = 0
+    slot = 0
+    while True:
+        chunk = view[slot * chunk_size:(slot + 1) * chunk_size]
+        count = file_handle.readinto(chunk)
+        if not count:
+            break
+        chunk = chunk[:count]
+        digest.update(chunk)
+        pipeline.execute_command('APPEND', key, chunk)
+        length += count
+        slot += 1
+        if slot == window:
+            # The batch is copied to the socket by send(), so the buffer
+            # can be refilled while it is in flight
+            sent = pipeline.send()
+            error = _first_error(pipeline.read_responses(pending), error)
+            pending = sent
+            slot = 0
+    error = _first_error(pipeline.read_responses(pending + pipeline.send()), error)
+    if error is not None:
+        raise error
+    return length, binascii.hexlify(digest.digest())
+
+
+def _first_error(responses, error=None):
+    """
+    Get the earlier error, or the first error reply in responses
+    """
+    if error is None:
+        for response in responses:
+            if isinstance(response, Exception):
+                return response
+    return error
+
+
+class ValueReader(IOBase):
+    """
+    File like object that reads the contents of a redis string key using a
+    ChunkReader.
+
+    This is a stream on micropython so it can be wrapped by the native
+    decompression streams.
+
+    Parameters
+    ----------
+    redis : uredis_modular.client.Client
+        The redis connection
+
+    key : bytes
+        The redis string key to read
+
+    kwargs
+        Additional ChunkReader arguments
+    """
+    def __init__(self, redis, key, **kwargs):
+        self.reader = ChunkReader(redis, key, **kwargs)
+        self._chunks = self.reader.chunks()
+        self._buffer = b''
+        self._offset = 0
+
+    @property
+    def error(self):
+        """
+        The error reading from the server, see ChunkReader
+        """
+        return self.reader.error
+
+    def drain(self):
+        """
+        Read and discard the chunks still in flight, see ChunkReader.drain()
+        """
+        self.reader.drain()
+
+    def _fill(self):
+        """
+        Replace the consumed buffer with the next chunk
+
+        Returns
+        -------
+        bool
+            False if there is no more data
+        """
+        try:
+            self._buffer = next(self._chunks)
+        except StopIteration:
+            self._buffer = b''
+        self._offset = 0
+        return bool(self._buffer)
+
+    def read(self, size=-1):
+        """
+        Read from the value
+
+        Parameters
+        ----------
+        size : int, optional
+            The number of bytes to read, reads everything remaining if not
+            specified
+
+        Returns
+        -------
+        bytes
+            The data read, shorter than size only at the end of the value
+        """
+        parts = []
+        while size is None or size < 0 or size > 0:
+            if self._offset >= len(self._buffer) and not self._fill():
+                break
+            if size is None or size < 0:
+                end = len(self._buffer)
+            else:
+                end = min(self._offset + size, len(self._buffer))
+                size -= end - self._offset
+            parts.append(self._buffer[self._offset:end])
+            self._offset = end
+        return b''.join(parts)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf, nbytes=None):
+        """
+        Read data from the value into a buffer
+
+        Parameters
+        ----------
+        buf : bytearray
+            The buffer to read into
+
+        nbytes : int, optional
+            The maximum number of bytes to read, default is len(buf)
+
+        Returns
+        -------
+        int
+            The number of bytes read
+        """
+        if nbytes is None:
+            nbytes = len(buf)
+        data = self.read(nbytes)
+        buf[:len(data)] = data
+        return len(data)
@@ -0,0 +1,71 @@
+"""
+Helpers shared by the tests
+
+The tests run on cpython against the fake redis server from the benchmarks.
+"""
+import os
+import sys
+import traceback
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'benchmarks'))
+
+from fakeredis import FakeRedis  # noqa: E402
+from uredis_modular.client import Client  # noqa: E402
+from redis_cloudclient.eventloop import EventLoop  # noqa: E402
+
+if not hasattr(sys, 'print_exception'):
+    # The micropython function the eventloop uses to print tracebacks
+    def print_exception(exc, file=None):
+        traceback.print_exception(type(exc), exc, exc.__traceback__, file=file or sys.stdout)
+    sys.print_exception = print_exception
+
+CONFIG = {
+    'name': 'test',
+    'cloudmanager_reset_after': '',
+    'cloudmanager_debug_exec': '',
+}
+
+
+class EventLoopTestCase(unittest.TestCase):
+    """
+    Test case with a fake redis server and a connected EventLoop
+    """
+    config = {}
+
+    def setUp(self):
+        self.server = FakeRedis()
+        self.eventloop = self.new_eventloop()
+
+    def tearDown(self):
+        self.server.close()
+
+    def new_eventloop(self, config=None):
+        """
+        Create an EventLoop connected to the fake server
+        """
+        settings = dict(CONFIG)
+        settings.update(self.config)
+        settings.update(config or {})
+        eventloop = EventLoop(
+            redis_server=self.server.host, redis_port=self.server.port,
+            redis_connection=Client(self.server.host, self.server.port), config=settings
+        )
+        eventloop.connect()
+        eventloop.console.claim()
+        return eventloop
+
+    def push(self, operation, *values):
+        """
+        Add values to an operation queue of the eventloop
+        """
+        self.server.execute([b'RPUSH', self.eventloop.base_key + b'.' + operation] + list(values))
+
+    def completions(self):
+        """
+        Get and remove the return codes on the completion list
+        """
+        codes = self.server.data.pop(self.eventloop.complete_key, [])
+        return [int(code) for code in codes]
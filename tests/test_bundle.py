@@ -0,0 +1,63 @@
+"""
+Tests for unpacking bundles of files
+"""
+import os
+import shutil
+import tempfile
+import zlib
+
+from support import EventLoopTestCase
+from redis_cloudclient.bundle import make_bundle
+
+
+class BundleTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.files = [
+            (os.path.join(self.directory, 'main.py'), b'print(1)\n'),
+            (os.path.join(self.directory, 'lib', 'module.py'), os.urandom(3000)),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def send_bundle(self, bundle, compression=None):
+        self.server.data[b'test:bundle'] = bundle
+        transaction = {b'source': b'test:bundle'}
+        if compression:
+            transaction[b'compression'] = compression
+        self.server.data[b'test:tx'] = transaction
+        self.push(b'bundle', b'test:tx')
+        self.eventloop.handle_queues(timeout=1)
+
+    def assert_files(self):
+        for filename, data in self.files:
+            with open(filename, 'rb') as file_handle:
+                self.assertEqual(file_handle.read(), data)
+
+    def assert_still_in_sync(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+
+    def test_bundle(self):
+        self.send_bundle(make_bundle(self.files))
+        self.assertEqual(self.completions(), [0])
+        self.assert_files()
+
+    def test_compressed_bundle(self):
+        self.send_bundle(zlib.compress(make_bundle(self.files)), compression=b'zlib')
+        self.assertEqual(self.completions(), [0])
+        self.assert_files()
+
+    def test_truncated_bundle(self):
+        self.send_bundle(make_bundle(self.files)[:-1000])
+        self.assertEqual(self.completions(), [1])
+        self.assert_still_in_sync()
+
+    def test_bad_magic(self):
+        self.send_bundle(b'XXXX' + make_bundle(self.files)[4:])
+        self.assertEqual(self.completions(), [1])
+        self.assert_still_in_sync()
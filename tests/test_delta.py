@@ -0,0 +1,59 @@
+import io
+import os
+import shutil
+import tempfile
+
+from support import EventLoopTestCase
+from redis_cloudclient.delta import apply_delta, file_signature, make_delta
+
+
+class DeltaTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'file.bin')
+        self.old = os.urandom(20000)
+        self.new = self.old[:5000] + b'changed' + self.old[6000:] + os.urandom(3000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def send_delta(self, delta):
+        self.server.data[b'test:delta'] = delta
+        self.server.data[b'test:tx'] = {b'source': b'test:delta', b'dest': self.filename.encode()}
+        self.push(b'delta', b'test:tx')
+        self.eventloop.handle_queues(timeout=1)
+
+    def assert_still_in_sync(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+
+    def test_apply_delta(self):
+        delta = make_delta(file_signature(io.BytesIO(self.old)), self.new)
+        output = io.BytesIO()
+        apply_delta(io.BytesIO(delta), io.BytesIO(self.old), output)
+        self.assertEqual(output.getvalue(), self.new)
+
+    def test_delta_update(self):
+        with open(self.filename, 'wb') as file_handle:
+            file_handle.write(self.old)
+        self.send_delta(make_delta(file_signature(io.BytesIO(self.old)), self.new))
+        self.assertEqual(self.completions(), [0])
+        with open(self.filename, 'rb') as file_handle:
+            self.assertEqual(file_handle.read(), self.new)
+
+    def test_missing_old_file(self):
+        # The delta references blocks of a file the board doesn't have
+        self.send_delta(make_delta(file_signature(io.BytesIO(self.old)), self.new))
+        self.assertEqual(self.completions(), [1])
+        self.assertFalse(os.path.exists(self.filename))
+        self.assertFalse(os.path.exists(self.filename + '.delta'))
+        self.assert_still_in_sync()
+
+    def test_truncated_delta(self):
+        delta = make_delta(file_signature(io.BytesIO(b'')), self.new)
+        self.send_delta(delta[:-100])
+        self.assertEqual(self.completions(), [1])
+        self.assert_still_in_sync()
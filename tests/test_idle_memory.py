@@ -0,0 +1,46 @@
+"""
+Tests for the allocations and commands of an idle eventloop pass
+"""
+import unittest
+
+from support import EventLoopTestCase
+
+import idle_memory
+
+
+class IdleMemoryTest(unittest.TestCase):
+    def test_idle_iteration_limit(self):
+        allocated = idle_memory.measure_fake_server()
+        self.assertLess(allocated, idle_memory.DEFAULT_LIMIT)
+
+
+class LivenessTest(EventLoopTestCase):
+    def refresh(self):
+        pipeline = self.eventloop.pipeline()
+        self.eventloop._refresh_heartbeat(pipeline)
+        pipeline.execute()
+
+    def assert_scores(self, expected):
+        for key in self.eventloop._index_keys:
+            self.assertEqual(self.server.data[key][self.eventloop.name], expected)
+
+    def test_score_follows_clock(self):
+        clock = self.eventloop.clock
+        self.refresh()
+        self.assert_scores(clock.time())
+        commands = self.eventloop._encoded_liveness[3]
+        clock._milliseconds += 7000
+        self.refresh()
+        self.assert_scores(clock.time())
+        # Moving the score only patched the encoded commands
+        self.assertIs(self.eventloop._encoded_liveness[3], commands)
+
+    def test_score_carries_past_patched_digits(self):
+        clock = self.eventloop.clock
+        clock.base = 1799999998
+        self.refresh()
+        self.assert_scores(clock.time())
+        clock._milliseconds += 5000
+        self.refresh()
+        self.assert_scores(clock.time())
+        self.assertEqual(self.server.data[self.eventloop._index_keys[0]][self.eventloop.name] // 1000000, 1800)
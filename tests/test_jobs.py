@@ -0,0 +1,45 @@
+"""
+Tests for running background jobs
+"""
+import time
+
+from support import EventLoopTestCase
+
+
+class JobTest(EventLoopTestCase):
+    def submit(self, job_key, command):
+        self.server.data[job_key] = {b'command': command}
+        self.push(b'job', job_key)
+        self.eventloop.handle_queues(timeout=1)
+
+    def wait_complete(self, job_key, timeout=5):
+        deadline = time.time() + timeout
+        while job_key + b'.complete' not in self.server.data:
+            if time.time() > deadline:
+                self.fail('Job %r did not complete' % job_key)
+            time.sleep(0.01)
+        return [int(rc) for rc in self.server.data[job_key + b'.complete']]
+
+    def test_job_in_eventloop(self):
+        self.submit(b'test:job', b'print("hello")')
+        self.assertEqual(self.wait_complete(b'test:job'), [0])
+        self.assertEqual(self.server.data[b'test:job.stdout'], b'hello\n')
+
+    def test_failing_job(self):
+        self.submit(b'test:job', b'raise ValueError("no")')
+        self.assertEqual(self.wait_complete(b'test:job'), [1])
+        self.assertIn(b'ValueError', self.server.data[b'test:job.stdout'])
+
+
+class WorkerJobTest(JobTest):
+    config = {'cloudmanager_workers': '1'}
+
+    def test_queue_paused_while_busy(self):
+        self.submit(b'test:slow', b'import time\ntime.sleep(0.5)')
+        self.push(b'job', b'test:next')
+        self.push(b'command', b'x = 1')
+        # The job queue is paused, the command still runs
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+        self.assertEqual(self.server.data[self.eventloop.base_key + b'.job'], [b'test:next'])
+        self.assertEqual(self.wait_complete(b'test:slow'), [0])
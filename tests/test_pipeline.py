@@ -0,0 +1,66 @@
+"""
+Tests for sending pipelined commands and parsing their replies
+"""
+from support import EventLoopTestCase
+from redis_cloudclient.pipeline import EncodedCommands, Pipeline
+from uredis_modular.client import RedisError
+
+
+class PipelineTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = self.eventloop.redis_connection
+
+    def test_reply_types(self):
+        pipeline = Pipeline(self.redis)
+        pipeline.execute_command('SET', b'test:key', b'line\r\nbreak')
+        pipeline.execute_command('GET', b'test:key')
+        pipeline.execute_command('GET', b'test:missing')
+        pipeline.execute_command('PING')
+        pipeline.execute_command('SET', b'test:count', -5)
+        pipeline.execute_command('INCR', b'test:count')
+        pipeline.execute_command('RPUSH', b'test:list', b'a', b'')
+        pipeline.execute_command('LRANGE', b'test:list', 0, -1)
+        pipeline.execute_command('BLPOP', b'test:empty', 1)
+        self.assertEqual(
+            pipeline.execute(),
+            [b'OK', b'line\r\nbreak', None, b'PONG', b'OK', -4, 2, [b'a', b''], None]
+        )
+
+    def test_error_replies_in_place(self):
+        self.server.data[b'test:list'] = [b'a']
+        pipeline = Pipeline(self.redis, raise_on_error=False)
+        pipeline.execute_command('GET', b'test:list')
+        pipeline.execute_command('LLEN', b'test:list')
+        responses = pipeline.execute()
+        self.assertIsInstance(responses[0], RedisError)
+        self.assertEqual(responses[1], 1)
+
+    def test_raise_after_reading_replies(self):
+        self.server.data[b'test:list'] = [b'a']
+        pipeline = Pipeline(self.redis)
+        pipeline.execute_command('GET', b'test:list')
+        pipeline.execute_command('RPUSH', b'test:list', b'b')
+        with self.assertRaises(RedisError):
+            pipeline.execute()
+        # The reply after the error was read and the command ran
+        self.assertEqual(pipeline.execute_command('LLEN', b'test:list').execute(), [2])
+
+    def test_encoded_commands(self):
+        encoded = EncodedCommands(('RPUSH', b'test:list', b'a'), ('LLEN', b'test:list'))
+        pipeline = Pipeline(self.redis)
+        self.assertEqual(len(pipeline.execute_command(encoded).execute_command('PING')), 3)
+        responses = []
+        self.assertIs(pipeline.execute(responses), responses)
+        self.assertEqual(responses, [1, 1, b'PONG'])
+        # Reusing the list replaces the earlier replies
+        pipeline.execute_command(encoded).execute_command(encoded).execute(responses)
+        self.assertEqual(responses, [2, 2, 3, 3])
+
+    def test_send_and_read_later(self):
+        pipeline = Pipeline(self.redis)
+        pipeline.execute_command('SET', b'test:key', b'value')
+        pipeline.execute_command('GET', b'test:key')
+        self.assertEqual(pipeline.send(), 2)
+        self.assertEqual(pipeline.send(), 0)
+        self.assertEqual(pipeline.read_responses(2), [b'OK', b'value'])
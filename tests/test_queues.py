@@ -0,0 +1,142 @@
+"""
+Tests for reading and draining the operation queues
+"""
+from support import EventLoopTestCase
+from redis_cloudclient.groups import complete_key, stream_key
+
+
+class HandlerError(Exception):
+    pass
+
+
+class DrainTest(EventLoopTestCase):
+    config = {'cloudmanager_drain_limit': '3'}
+
+    def setUp(self):
+        super().setUp()
+        self.seen = []
+        self.eventloop.register_handler(b'record', self.record)
+        self.eventloop.register_handler(b'other', self.other)
+
+    def record(self, value):
+        if value == b'fail':
+            raise HandlerError(value)
+        self.seen.append(value)
+
+    def other(self, value):
+        self.seen.append((b'other', value))
+
+    def queued(self, operation):
+        return self.server.data.get(self.eventloop.base_key + b'.' + operation, [])
+
+    def test_first_pass_only_pops(self):
+        self.push(b'record', b'a', b'b', b'c')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'a'])
+        self.assertEqual(self.queued(b'record'), [b'b', b'c'])
+
+    def test_drain_limit(self):
+        self.push(b'record', *[b'%d' % index for index in range(7)])
+        passes = []
+        for count in range(4):
+            self.eventloop.handle_queues(timeout=1)
+            passes.append(len(self.seen))
+        # A BLPOP, then the BLPOP and drain_limit - 1 drained items
+        self.assertEqual(passes, [1, 4, 7, 7])
+        self.assertEqual(self.seen, [b'%d' % index for index in range(7)])
+
+    def test_drain_several_queues(self):
+        self.push(b'record', b'a', b'b')
+        self.push(b'other', b'x', b'y')
+        self.eventloop.handle_queues(timeout=1)
+        self.eventloop.handle_queues(timeout=1)
+        # Each queue keeps its order
+        self.assertEqual([value for value in self.seen if not isinstance(value, tuple)], [b'a', b'b'])
+        self.assertEqual([value[1] for value in self.seen if isinstance(value, tuple)], [b'x', b'y'])
+
+    def test_drained_completions_batched(self):
+        self.push(b'command', b'x = 1', b'x = 2', b'x = 3')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0, 0])
+
+    def test_failing_handler_requeues(self):
+        self.push(b'record', b'a', b'fail', b'b', b'c')
+        self.eventloop.handle_queues(timeout=1)
+        with self.assertRaises(HandlerError):
+            self.eventloop.handle_queues(timeout=1)
+        # The items after the failure go back in their original order
+        self.assertEqual(self.queued(b'record'), [b'b', b'c'])
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'a', b'b', b'c'])
+
+
+class GroupDrainTest(DrainTest):
+    config = {'cloudmanager_drain_limit': '3', 'cloudmanager_groups': 'lab'}
+
+    def add_entry(self, operation, value):
+        return self.server.execute([b'XADD', stream_key('lab'), b'*', b'operation', operation, b'value', value])
+
+    def test_group_entries_run_first(self):
+        self.push(b'record', b'a', b'b')
+        self.add_entry(b'record', b'g1')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'g1', b'a'])
+        # The second pass drains, the group reply is at another index
+        self.add_entry(b'record', b'g2')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'g1', b'a', b'g2', b'b'])
+
+    def test_group_completion(self):
+        entry_id = self.add_entry(b'command', b'x = 1')
+        self.push(b'command', b'x = 2')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.server.data[complete_key('lab', entry_id)], [b'test 0'])
+        self.assertEqual(self.completions(), [0])
+
+
+class RenameTest(EventLoopTestCase):
+    config = {'cloudmanager_drain_limit': '3'}
+
+    def setUp(self):
+        super().setUp()
+        self.seen = []
+        self.eventloop.register_handler(b'record', self.seen.append)
+
+    def queued(self, name, operation):
+        return self.server.data.get(b'repl:' + name + b'.' + operation, [])
+
+    def test_rename_moves_queues(self):
+        self.push(b'rename', b'renamed')
+        self.push(b'record', b'a', b'b')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.eventloop.name, b'renamed')
+        self.assertEqual(self.queued(b'test', b'record'), [])
+        self.assertEqual(self.queued(b'renamed', b'record'), [b'a', b'b'])
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'a', b'b'])
+
+    def test_rename_in_drained_batch(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.push(b'rename', b'renamed')
+        self.push(b'record', b'a', b'b', b'c')
+        self.eventloop.handle_queues(timeout=1)
+        # The rest of the batch ran under the old name before the rename
+        self.assertEqual(self.seen, [b'a', b'b'])
+        self.assertEqual(self.eventloop.name, b'renamed')
+        self.assertEqual(self.queued(b'test', b'record'), [])
+        self.assertEqual(self.queued(b'renamed', b'record'), [b'c'])
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.seen, [b'a', b'b', b'c'])
+
+    def test_rename_keeps_completions(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.push(b'rename', b'renamed')
+        self.push(b'command', b'x = 2')
+        self.eventloop.handle_queues(timeout=1)
+        # The completion of the command drained with the rename
+        self.assertEqual(self.server.data[b'repl:test.complete'], [b'0'])
+        self.assertIn(b'repl:test.complete', self.server.expires)
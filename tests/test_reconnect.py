@@ -0,0 +1,26 @@
+"""
+Tests for reconnecting the eventloop after losing the connection
+"""
+from support import EventLoopTestCase
+from uredis_modular.client import InvalidResponse
+
+
+class ReconnectTest(EventLoopTestCase):
+    def drop_connection(self):
+        self.eventloop.redis_connection.connection.socket.close()
+
+    def test_reconnect_keeps_queue(self):
+        self.push(b'command', b'x = 1')
+        self.drop_connection()
+        with self.assertRaises((OSError, InvalidResponse)):
+            self.eventloop.handle_queues(timeout=1)
+        self.eventloop.reconnect(timeout=5)
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+
+    def test_reconnect_keeps_console_output(self):
+        self.eventloop.console.write(b'buffered')
+        self.drop_connection()
+        self.eventloop.reconnect(timeout=5)
+        self.eventloop.console.flush()
+        self.assertIn(b'buffered', self.server.data[self.eventloop.console_key + b'.stdout'])
@@ -0,0 +1,40 @@
+import os
+import shutil
+import tempfile
+
+from support import EventLoopTestCase
+
+
+class InstrumentedClientTest(EventLoopTestCase):
+    config = {'cloudmanager_stats_interval': '60'}
+
+    def counter(self, name):
+        names = ['count', 'ms', 'out', 'in']
+        return dict(zip(names, self.eventloop.stats.counters[name]))
+
+    def test_blocking_wait_only_in_blpop(self):
+        self.eventloop.heartbeat()
+        pipeline = self.eventloop.pipeline()
+        self.eventloop.heartbeat(pipeline=pipeline)
+        self.eventloop.handle_queues(timeout=1, pipeline=pipeline)
+        self.assertGreaterEqual(self.counter('redis.BLPOP')['ms'], 900)
+        setex = self.counter('redis.SETEX')
+        self.assertLess(setex['ms'], 500 * setex['count'])
+        self.assertGreater(setex['out'], 0)
+        self.assertGreater(setex['in'], 0)
+
+    def test_windowed_transfer(self):
+        directory = tempfile.mkdtemp()
+        try:
+            data = os.urandom(20000)
+            self.server.data[b'test:source'] = data
+            filename = os.path.join(directory, 'copy.bin').encode()
+            self.server.data[b'test:tx'] = {b'source': b'test:source', b'dest': filename}
+            self.push(b'copy', b'test:tx')
+            self.eventloop.handle_queues(timeout=1)
+            self.assertEqual(self.completions(), [0])
+        finally:
+            shutil.rmtree(directory)
+        getrange = self.counter('redis.GETRANGE')
+        self.assertGreater(getrange['count'], 1)
+        self.assertGreaterEqual(getrange['in'], len(data))
@@ -0,0 +1,161 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import zlib
+
+from support import EventLoopTestCase
+from fakeredis import FakeRedisError
+from redis_cloudclient.pipeline import Pipeline
+from redis_cloudclient.transfer import ChunkReader
+from uredis_modular.client import RedisError
+
+
+class UploadTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'upload.bin')
+        self.data = os.urandom(50000)
+        with open(self.filename, 'wb') as file_handle:
+            file_handle.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def upload(self, filename):
+        self.server.data[b'test:tx'] = {b'source': filename.encode(), b'dest': b'test:uploaded'}
+        self.push(b'upload', b'test:tx')
+        self.eventloop.handle_queues(timeout=1)
+
+    def assert_still_in_sync(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+
+    def test_upload(self):
+        self.upload(self.filename)
+        self.assertEqual(self.completions(), [0])
+        self.assertEqual(self.server.data[b'test:uploaded'], self.data)
+        transaction = self.server.data[b'test:tx']
+        self.assertEqual(int(transaction[b'length']), len(self.data))
+        self.assertEqual(transaction[b'sha256'], hashlib.sha256(self.data).hexdigest().encode())
+
+    def test_missing_file(self):
+        self.upload(self.filename + '.missing')
+        self.assertEqual(self.completions(), [1])
+        self.assertNotIn(b'test:uploaded', self.server.data)
+        self.assert_still_in_sync()
+
+    def test_append_error(self):
+        append = self.server.cmd_APPEND
+
+        def cmd_APPEND(key, value):
+            if key == b'test:uploaded':
+                raise FakeRedisError('OOM command not allowed when used memory > maxmemory')
+            return append(key, value)
+        self.server.cmd_APPEND = cmd_APPEND
+        self.upload(self.filename)
+        self.assertEqual(self.completions(), [1])
+        self.assertNotIn(b'test:uploaded', self.server.data)
+        self.assert_still_in_sync()
+
+
+class CopyFileTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, 'copy.bin')
+        self.data = os.urandom(20000)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        super().tearDown()
+
+    def copy(self, value, compression=None):
+        self.server.data[b'test:source'] = value
+        transaction = {b'source': b'test:source', b'dest': self.filename.encode()}
+        if compression:
+            transaction[b'compression'] = compression
+        self.server.data[b'test:tx'] = transaction
+        self.push(b'copy', b'test:tx')
+        self.eventloop.handle_queues(timeout=1)
+
+    def assert_still_in_sync(self):
+        self.push(b'command', b'x = 1')
+        self.eventloop.handle_queues(timeout=1)
+        self.assertEqual(self.completions(), [0])
+
+    def read_file(self):
+        with open(self.filename, 'rb') as file_handle:
+            return file_handle.read()
+
+    def test_copy(self):
+        self.copy(self.data)
+        self.assertEqual(self.completions(), [0])
+        self.assertEqual(self.read_file(), self.data)
+        self.assertNotIn(b'test:tx', self.server.data)
+
+    def test_copy_compressed(self):
+        self.copy(zlib.compress(self.data), compression=b'zlib')
+        self.assertEqual(self.completions(), [0])
+        self.assertEqual(self.read_file(), self.data)
+
+    def test_corrupt_compressed(self):
+        compressed = zlib.compress(self.data)
+        self.copy(compressed[:100] + b'garbage' * 10 + compressed[170:], compression=b'zlib')
+        self.assertEqual(self.completions(), [1])
+        self.assert_still_in_sync()
+
+    def test_unsupported_compression(self):
+        self.copy(self.data, compression=b'lzma')
+        self.assertEqual(self.completions(), [1])
+        self.assert_still_in_sync()
+
+    def test_missing_directory(self):
+        self.filename = os.path.join(self.directory, 'file.bin', 'copy.bin')
+        with open(os.path.join(self.directory, 'file.bin'), 'wb'):
+            pass
+        self.copy(self.data)
+        self.assertEqual(self.completions(), [0])
+        self.assert_still_in_sync()
+
+
+class ChunkReaderTest(EventLoopTestCase):
+    def setUp(self):
+        super().setUp()
+        self.redis = self.eventloop.redis_connection
+        self.data = os.urandom(10000)
+        self.server.data[b'test:value'] = self.data
+
+    def assert_still_in_sync(self):
+        self.assertEqual(Pipeline(self.redis).execute_command('STRLEN', b'test:value').execute(), [len(self.data)])
+
+    def test_chunks(self):
+        reader = ChunkReader(self.redis, b'test:value', chunk_size=100, window=3)
+        self.assertEqual(b''.join(reader), self.data)
+        self.assertEqual(reader.received, len(self.data))
+        self.assert_still_in_sync()
+
+    def test_drain_partial_read(self):
+        reader = ChunkReader(self.redis, b'test:value', chunk_size=100, window=4)
+        chunks = reader.chunks()
+        self.assertEqual(next(chunks), self.data[:100])
+        reader.drain()
+        self.assert_still_in_sync()
+
+    def test_value_shrinks(self):
+        reader = ChunkReader(self.redis, b'test:value', chunk_size=1000, size=len(self.data) + 5000)
+        self.assertEqual(b''.join(reader), self.data)
+        self.assert_still_in_sync()
+
+    def test_read_error(self):
+        self.server.data[b'test:list'] = [b'a']
+        reader = ChunkReader(self.redis, b'test:list', size=1000, window=4)
+        with self.assertRaises(RedisError):
+            b''.join(reader)
+        self.assertIsInstance(reader.error, RedisError)
+        # Nothing is left in flight to drain
+        reader.drain()
+        self.assert_still_in_sync()